@@ -1,24 +1,216 @@
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain  # 暂时保留以避免大规模重构
-from langchain.memory import ConversationBufferMemory
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_community.chat_models import ChatOpenAI
-from typing import Dict, List, Optional, Any, Mapping, Callable
+from typing import Dict, List, Optional, Any, Mapping, Callable, Awaitable, AsyncIterator, Union
 import warnings
-import requests
+import httpx
 import os
-from langchain_community.llms import OpenAI
 import json
 import time
 import asyncio
 import inspect
+import contextvars
 
 # 临时抑制LangChain弃用警告，等待完整迁移
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="langchain")
 
+from http_pool import OPENROUTER_BASE_URL, get_async_client, get_sync_client, get_timeout
+from resilience import (UpstreamStatusError, UpstreamUnavailable, get_breaker, check_deadline, timeout_for, is_retryable,
+                        translate_error, retry_attempts, backoff_delay, parse_retry_after,
+                        resilient_call, resilient_call_sync)
+from prompts import PROMPTS, SYSTEM_PROMPTS, CONTEXT_TEMPLATE
+from llm_cache import (AsyncTTLCache, PersistentTTLCache, SimilarityCache, RefillingPool,
+                       problem_fingerprint, text_digest)
+from challenges import CHALLENGE_RESPONSE_FORMAT, parse_challenge_batch
+from scheduler import SCHEDULER, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, effective_priority
+from routing import ROUTER, LatencyTimer
+from context_window import count_tokens
+from tracing import TRACER, span
+from metrics import (CHAIN_DURATION, UPSTREAM_DURATION, TIME_TO_FIRST_TOKEN, STREAM_TOKENS_PER_SECOND,
+                     UPSTREAM_RESPONSES)
+from usage import USAGE, normalize_usage
+from code_normalizer import normalize_code, code_digest
+from streaming import emit_text
+from sse import iter_event_batches, aiter_event_batches
+
 # 使用LangChain的自定义LLM类
 from langchain.llms.base import LLM
-from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain_core.outputs import GenerationChunk
+
+
+OPENROUTER_API_URL = f"{OPENROUTER_BASE_URL}/chat/completions"
+
+# 单次调用级别的参数（model、streaming_callback、messages、response_format、max_tokens，以及由 LLM 回填的 usage），
+# 由 InteractiveLearningAssistant 在调用链时设置。
+# 共享的 OpenRouterLLM 实例本身不保存任何会话状态；使用 contextvar 保证并发请求互不干扰
+_call_options_var: contextvars.ContextVar = contextvars.ContextVar("openrouter_call_options", default=None)
+
+
+def _get_call_options() -> Dict[str, Any]:
+    return _call_options_var.get() or {}
+
+
+def _input_chars(inputs: Dict[str, Any], history: Optional[List[Dict[str, str]]] = None) -> int:
+    """Size of a chain's inputs, recorded on trace spans."""
+    return (sum(len(value) for value in inputs.values() if isinstance(value, str))
+            + sum(len(msg["content"]) for msg in history or []))
+
+
+# 需要显式标记缓存断点的模型前缀（OpenRouter 上的 Anthropic 和 Gemini）；OpenAI、DeepSeek
+# 等提供商对足够长的相同前缀自动缓存，不需要也不接受标记
+PROMPT_CACHE_CONTROL_MODELS = tuple(
+    prefix.strip() for prefix in os.getenv("PROMPT_CACHE_CONTROL_MODELS", "anthropic/,google/gemini").split(",")
+    if prefix.strip()
+)
+
+
+def _prompt_prefix(chain_name: str, inputs: Dict[str, Any],
+                   history: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+    """
+    Leading messages of a chain call, most stable first: the static system prompt, the
+    session's problem context, then prior conversation turns.
+    """
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPTS[chain_name]},
+        {"role": "user", "content": CONTEXT_TEMPLATE.format(
+            problem=inputs["problem"], language=inputs["language"], skill_level=inputs["skill_level"]
+        )},
+    ]
+    messages.extend(history or [])
+    return messages
+
+
+def _chat_messages(prefix: List[Dict[str, str]], prompt: str, model: str) -> List[Dict[str, Any]]:
+    """
+    Build the request messages from a prefix and the rendered prompt, marking prompt-cache
+    breakpoints after the system prompt and right before the prompt.
+    """
+    # 连续的同角色消息合并为一条（例如题目上下文后紧跟本次请求），有的提供商要求角色交替；
+    # 合并前的每段保留为单独的内容块，缓存断点可以落在段与段之间
+    merged: List[Dict[str, Any]] = []
+    for message in prefix + [{"role": "user", "content": prompt}]:
+        if merged and merged[-1]["role"] == message["role"]:
+            merged[-1]["parts"].append(message["content"])
+        else:
+            merged.append({"role": message["role"], "parts": [message["content"]]})
+
+    if not model.startswith(PROMPT_CACHE_CONTROL_MODELS):
+        return [{"role": message["role"], "content": "\n\n".join(message["parts"])} for message in merged]
+
+    # 第二个断点随对话前移：下一轮请求的前缀包含本轮之前的全部内容，可以命中本轮写入的缓存
+    last = len(merged) - 1
+    breakpoints = {(0, len(merged[0]["parts"]) - 1)}
+    if len(merged[last]["parts"]) > 1:
+        breakpoints.add((last, len(merged[last]["parts"]) - 2))
+    else:
+        breakpoints.add((last - 1, len(merged[last - 1]["parts"]) - 1))
+
+    messages = []
+    for i, message in enumerate(merged):
+        content = []
+        for j, text in enumerate(message["parts"]):
+            part: Dict[str, Any] = {"type": "text", "text": text}
+            if (i, j) in breakpoints:
+                part["cache_control"] = {"type": "ephemeral"}
+            content.append(part)
+        messages.append({"role": message["role"], "content": content})
+    return messages
+
+
+def _history_messages(conversation_history: Union[str, List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    # 兼容旧的调用方式：历史以文本传入时作为一条 user 消息
+    if isinstance(conversation_history, str):
+        if not conversation_history.strip():
+            return []
+        return [{"role": "user", "content": f"Conversation History:\n{conversation_history}"}]
+    return list(conversation_history)
+
+
+# 每条链的调度优先级：学生正在等待的请求优先；后台任务（进度总结刷新、预取）通过
+# scheduler.lane 整体降为 background
+CHAIN_PRIORITIES = {
+    "initial_guidance": PRIORITY_INTERACTIVE,
+    "conversation_continuation": PRIORITY_INTERACTIVE,
+    "stage_transition": PRIORITY_INTERACTIVE,
+    "code_feedback": PRIORITY_INTERACTIVE,
+    "concept_explanation": PRIORITY_INTERACTIVE,
+    "hint_generation": PRIORITY_INTERACTIVE,
+    "mini_challenge": PRIORITY_NORMAL,
+    "learning_summary": PRIORITY_NORMAL,
+    "progress_summary": PRIORITY_NORMAL,
+    "progress_summary_update": PRIORITY_NORMAL,
+}
+
+# 每条链的输出 token 上限（max_tokens），按模板中的字数要求留出余量（英文约 1.3 token/词，
+# 另加 Markdown 格式）。可以用 CHAIN_MAX_TOKENS='{"hint_generation": 150}' 按链覆盖
+DEFAULT_CHAIN_MAX_TOKENS = {
+    "initial_guidance": 400,           # max 150 words
+    "conversation_continuation": 400,  # max 150 words
+    "stage_transition": 250,           # max 100 words
+    "code_feedback": 250,              # under 100 words
+    "concept_explanation": 500,        # max 150 words plus a short code example
+    "hint_generation": 200,            # max 70 words
+    "progress_summary": 250,           # max 100 words
+    "progress_summary_update": 250,    # max 100 words
+    "learning_summary": 900,           # 300-400 words
+}
+# 挑战按批生成，上限按每个挑战计算
+MINI_CHALLENGE_MAX_TOKENS_EACH = 250
+
+# 流式输出时本地估算的 token 数超过上限的这个倍数就主动断开（本地计数与上游分词器有偏差，
+# 上游遵守 max_tokens 时不会触发，只用于兜底不遵守的提供商）
+EARLY_STOP_RATIO = 1.1
+
+
+def chain_max_tokens(chain_name: str) -> Optional[int]:
+    """Return the output token limit for a chain, or None for no limit."""
+    overrides = os.getenv("CHAIN_MAX_TOKENS")
+    if overrides:
+        try:
+            limits = json.loads(overrides)
+            if chain_name in limits:
+                return int(limits[chain_name]) or None
+        except (ValueError, TypeError) as e:
+            print(f"Invalid CHAIN_MAX_TOKENS: {e}")
+    return DEFAULT_CHAIN_MAX_TOKENS.get(chain_name)
+
+
+# 初始引导按 (题目指纹, 语言, 水平, 模型) 缓存并持久化到磁盘：同一堂课上大量学生会粘贴同一道题，
+# 重启后的 worker 也能直接命中。可以用 prewarm_guidance.py 在上课前预热
+GUIDANCE_CACHE = PersistentTTLCache(
+    "initial_guidance",
+    maxsize=int(os.getenv("GUIDANCE_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("GUIDANCE_CACHE_TTL", str(30 * 24 * 3600))),
+    path=os.getenv("GUIDANCE_CACHE_PATH", "guidance_cache.db")
+)
+
+# 代码反馈按规范化后的代码精确匹配缓存（忽略空白、注释和变量名）。近似重复默认不命中：
+# 短代码里改一个 token（例如 range(len(nums)) 改成 range(len(nums) - 1)）就是另一份需要不同反馈的提交。
+# 设置 FEEDBACK_SIMILARITY_THRESHOLD < 1 可以开启近似匹配，阈值按代码长度收紧
+# （不短于 FEEDBACK_SIMILARITY_FULL_LENGTH 个 token 的代码才使用这个阈值）
+FEEDBACK_CACHE = SimilarityCache(
+    "code_feedback",
+    max_buckets=int(os.getenv("FEEDBACK_CACHE_BUCKETS", "256")),
+    bucket_size=int(os.getenv("FEEDBACK_CACHE_BUCKET_SIZE", "64")),
+    ttl=float(os.getenv("FEEDBACK_CACHE_TTL", "86400")),
+    threshold=float(os.getenv("FEEDBACK_SIMILARITY_THRESHOLD", "1.0")),
+    full_length=int(os.getenv("FEEDBACK_SIMILARITY_FULL_LENGTH", "400"))
+)
+
+# 概念解释只取决于 (概念, 语言, 水平, 题目, 模型)，在所有会话之间共享
+EXPLANATION_CACHE = AsyncTTLCache(
+    "explain_concept",
+    maxsize=int(os.getenv("EXPLAIN_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("EXPLAIN_CACHE_TTL", "86400"))
+)
+
+# 微型挑战按 (题目指纹, 阶段, 水平, 语言, 模型) 成批生成，每个挑战只发给一个学生；
+# 池中剩余数量低于水位时在后台生成下一批
+CHALLENGE_BATCH_SIZE = int(os.getenv("CHALLENGE_BATCH_SIZE", "5"))
+CHALLENGE_POOL = RefillingPool(
+    "mini_challenge",
+    max_keys=int(os.getenv("CHALLENGE_POOL_KEYS", "512")),
+    low_watermark=int(os.getenv("CHALLENGE_POOL_LOW_WATERMARK", "2")),
+    ttl=float(os.getenv("CHALLENGE_POOL_TTL", "86400"))
+)
 
 
 class OpenRouterLLM(LLM):
@@ -31,110 +223,306 @@ class OpenRouterLLM(LLM):
     def _llm_type(self) -> str:
         return "openrouter"
 
-    def _call(
-            self,
-            prompt: str,
-            stop: Optional[List[str]] = None,
-            run_manager: Optional[CallbackManagerForLLMRun] = None,
-            **kwargs: Any,
-    ) -> str:
-        headers = {
+    def _build_headers(self) -> Dict[str, str]:
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}",
             "HTTP-Referer": "http://localhost:8000", # 后端地址
             "X-Title": "Programming Learning Assistant"
         }
 
-        # 决定 data 中的 stream 参数
-        is_streaming = self.streaming_callback is not None
+    def _build_payload(self, prompt: str, stop: Optional[List[str]], stream: bool) -> Dict[str, Any]:
+        options = _get_call_options()
+        model = options.get("model") or self.model
+        prefix = options.get("messages")
         data = {
-            "model": self.model,
-            "messages": [{"role": "user", "content": prompt}],
+            "model": model,
+            "messages": _chat_messages(prefix, prompt, model) if prefix else [{"role": "user", "content": prompt}],
             "temperature": self.temperature,
-            "stream": is_streaming
+            "stream": stream
         }
-
         if stop:
             data["stop"] = stop
+        if options.get("response_format"):
+            data["response_format"] = options["response_format"]
+        if options.get("max_tokens"):
+            data["max_tokens"] = options["max_tokens"]
+        # 让 OpenRouter 在响应中返回 token 用量和费用（流式时在最后一个分块中）
+        data["usage"] = {"include": True}
+        return data
+
+    @staticmethod
+    def _chunk_content(chunk: Dict[str, Any], usage: Optional[Dict[str, Any]]) -> Optional[str]:
+        """
+        Return the text delta of a stream chunk, copying its usage block and
+        finish reason into the call's usage record.
+        """
+        if usage is not None:
+            if chunk.get("usage"):
+                usage.update(normalize_usage(chunk["usage"]))
+        choices = chunk.get("choices") or []
+        if not choices:
+            return None
+        if usage is not None and choices[0].get("finish_reason") == "length":
+            usage["truncated"] = "max_tokens"
+        return (choices[0].get("delta") or {}).get("content")
+
+    @staticmethod
+    def _record_response_usage(body: Dict[str, Any], usage: Optional[Dict[str, Any]]) -> None:
+        if usage is None:
+            return
+        if body.get("usage"):
+            usage.update(normalize_usage(body["usage"]))
+        choices = body.get("choices") or []
+        if choices and choices[0].get("finish_reason") == "length":
+            usage["truncated"] = "max_tokens"
+
+    @staticmethod
+    def _estimate_usage(data: Dict[str, Any], completion: str, usage: Optional[Dict[str, Any]],
+                        truncated: str = "early_stop") -> None:
+        # 提前断开或被取消的请求不会收到上游的 usage，按本地计数估算
+        if usage is None or usage.get("completion_tokens"):
+            return
+        prompt_tokens = 0
+        for message in data["messages"]:
+            content = message["content"]
+            if isinstance(content, list):
+                content = "".join(part["text"] for part in content)
+            prompt_tokens += count_tokens(content)
+        usage.update(prompt_tokens=prompt_tokens, completion_tokens=count_tokens(completion),
+                     truncated=truncated, estimated=True)
+
+    def _call(
+            self,
+            prompt: str,
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> str:
+        headers = self._build_headers()
+
+        # 决定 data 中的 stream 参数
+        options = _get_call_options()
+        streaming_callback = options.get("streaming_callback") or self.streaming_callback
+        usage = options.get("usage")
+        is_streaming = streaming_callback is not None
+        data = self._build_payload(prompt, stop, is_streaming)
 
         if is_streaming:
             # --- 流式输出模式 ---
-            full_response = ""
+            if inspect.iscoroutinefunction(streaming_callback):
+                try:
+                    asyncio.get_running_loop()
+                except RuntimeError:
+                    pass
+                else:
+                    # 在事件循环内无法同步等待异步回调，分块会乱序或丢失
+                    raise ValueError("Async streaming callbacks require the async code path (ainvoke/_acall)")
+            parts: List[str] = []
+            breaker = get_breaker(data["model"])
+            breaker.before_call()
             try:
-                with requests.post(
-                        "https://openrouter.ai/api/v1/chat/completions",
-                        headers=headers,
-                        json=data,
-                        stream=True,
-                        timeout=30,  # 添加超时
-                        verify=True  # 确保SSL验证
-                ) as response:
+                with get_sync_client().stream("POST", OPENROUTER_API_URL, headers=headers, json=data,
+                                              timeout=timeout_for(get_timeout())) as response:
+                    UPSTREAM_RESPONSES.inc(data["model"], str(response.status_code))
                     if response.status_code != 200:
-                        raise ValueError(f"Error: {response.status_code}, {response.text}")
-
-                    for line in response.iter_lines():
-                        if line:
-                            line_text = line.decode('utf-8')
-                            if line_text.startswith("data: "):
-                                line_text = line_text[6:]
-                            if line_text.strip() == "[DONE]":
-                                continue
-                            try:
-                                chunk = json.loads(line_text)
-                                if "choices" in chunk and len(chunk["choices"]) > 0:
-                                    if "delta" in chunk["choices"][0] and "content" in chunk["choices"][0]["delta"]:
-                                        content = chunk["choices"][0]["delta"]["content"]
-                                        full_response += content
-                                        if self.streaming_callback:
-                                            # 检查回调是否是异步函数
-                                            if inspect.iscoroutinefunction(self.streaming_callback):
-                                                # 如果是异步函数，需要在事件循环中运行
-                                                try:
-                                                    loop = asyncio.get_event_loop()
-                                                    if loop.is_running():
-                                                        # 如果事件循环正在运行，等待任务完成
-                                                        task = asyncio.create_task(self.streaming_callback(content))
-                                                        # 这里我们需要等待任务完成，但不能在这里直接await
-                                                        # 所以我们暂时保持原来的行为，但添加异常处理
-                                                        pass
-                                                    else:
-                                                        # 如果没有运行的事件循环，直接运行
-                                                        asyncio.run(self.streaming_callback(content))
-                                                except Exception as e:
-                                                    print(f"Error in async streaming callback: {e}")
-                                            else:
-                                                # 如果是普通函数，直接调用
-                                                self.streaming_callback(content)
-                            except json.JSONDecodeError:
-                                pass
-            except (requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
-                print(f"Connection error: {e}")
-                raise ValueError(f"Failed to connect to OpenRouter API: {str(e)}")
+                        response.read()
+                        raise UpstreamStatusError(response.status_code, response.text, parse_retry_after(response))
+
+                    limit = data.get("max_tokens")
+                    emitted_tokens = 0
+                    stopped = False
+                    for events in iter_event_batches(response.iter_bytes()):
+                        check_deadline()
+                        for event in events:
+                            content = self._chunk_content(event, usage)
+                            if content:
+                                parts.append(content)
+                                emitted_tokens += count_tokens(content)
+                                if inspect.iscoroutinefunction(streaming_callback):
+                                    # 同步路径中没有正在运行的事件循环，直接运行异步回调
+                                    asyncio.run(streaming_callback(content))
+                                else:
+                                    streaming_callback(content)
+                                if limit and emitted_tokens >= limit * EARLY_STOP_RATIO:
+                                    # 上游没有遵守 max_tokens：主动断开，释放连接和调度槽位
+                                    self._estimate_usage(data, "".join(parts), usage)
+                                    stopped = True
+                                    break
+                        if stopped:
+                            break
             except Exception as e:
-                print(f"Unexpected error: {e}")
-                raise ValueError(f"Unexpected error: {str(e)}")
-                
-            return full_response
+                print(f"Streaming request failed: {e}")
+                if isinstance(e, httpx.TransportError):
+                    UPSTREAM_RESPONSES.inc(data["model"], "error")
+                if is_retryable(e):
+                    breaker.record_failure()
+                else:
+                    breaker.release_probe()
+                raise translate_error(e)
+            breaker.record_success()
+            return "".join(parts)
         else:
-            # --- 非流式输出模式 ---
+            # --- 非流式输出模式：幂等，失败时按退避重试 ---
+            def send() -> str:
+                with span("openrouter.request", model=data["model"], stream=False,
+                          prompt_chars=len(prompt)) as request_span:
+                    try:
+                        response = get_sync_client().post(OPENROUTER_API_URL, headers=headers, json=data,
+                                                          timeout=timeout_for(get_timeout()))
+                    except httpx.TransportError:
+                        UPSTREAM_RESPONSES.inc(data["model"], "error")
+                        raise
+                    UPSTREAM_RESPONSES.inc(data["model"], str(response.status_code))
+                    request_span.set_attributes(status_code=response.status_code, http_version=response.http_version)
+                    if response.status_code != 200:
+                        raise UpstreamStatusError(response.status_code, response.text, parse_retry_after(response))
+                    body = response.json()
+                    self._record_response_usage(body, usage)
+                    content = body["choices"][0]["message"]["content"]
+                    request_span.set_attribute("response_chars", len(content))
+                    return content
+
+            return resilient_call_sync(data["model"], send)
+
+    async def _astream(
+            self,
+            prompt: str,
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """
+        原生异步流式输出，不阻塞事件循环。
+
+        在还没有输出任何内容之前失败（连接错误、429、5xx）可以安全地重试；
+        一旦开始输出，失败会直接抛出。
+        """
+        data = self._build_payload(prompt, stop, True)
+        usage = _get_call_options().get("usage")
+        limit = data.get("max_tokens")
+        breaker = get_breaker(data["model"])
+        attempts = retry_attempts()
+        for attempt in range(1, attempts + 1):
+            breaker.before_call()
+            emitted = False
+            # 异步生成器在 yield 之间可能切换上下文，这里的 span 不设为当前 span
+            request_span = TRACER.start_span("openrouter.request", model=data["model"], stream=True,
+                                             prompt_chars=len(prompt), attempt=attempt)
+            started = time.monotonic()
+            response_chars = 0
+            emitted_tokens = 0
+            completion = []
             try:
-                response = requests.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=30,  # 添加超时
-                    verify=True  # 确保SSL验证
-                )
-                
-                response.raise_for_status()  # 如果状态码不是2xx，则引发HTTPError
-
-                return response.json()["choices"][0]["message"]["content"]
-            except (requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
-                print(f"Connection error in non-streaming mode: {e}")
-                raise ValueError(f"Failed to connect to OpenRouter API: {str(e)}")
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed in non-streaming mode: {e}")
-                raise ValueError(f"Request to OpenRouter API failed: {str(e)}")
+                async with get_async_client().stream("POST", OPENROUTER_API_URL, headers=self._build_headers(),
+                                                     json=data, timeout=timeout_for(get_timeout())) as response:
+                    UPSTREAM_RESPONSES.inc(data["model"], str(response.status_code))
+                    request_span.set_attributes(status_code=response.status_code, http_version=response.http_version,
+                                                headers_ms=round((time.monotonic() - started) * 1000, 3))
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        raise UpstreamStatusError(response.status_code, body.decode("utf-8", "replace"),
+                                                  parse_retry_after(response))
+
+                    stopped = False
+                    async for events in aiter_event_batches(response.aiter_bytes()):
+                        check_deadline()
+                        for event in events:
+                            content = self._chunk_content(event, usage)
+                            if not content:
+                                continue
+                            if not emitted:
+                                request_span.set_attribute("ttft_ms", round((time.monotonic() - started) * 1000, 3))
+                            emitted = True
+                            response_chars += len(content)
+                            emitted_tokens += count_tokens(content)
+                            completion.append(content)
+                            chunk = GenerationChunk(text=content)
+                            if run_manager:
+                                await run_manager.on_llm_new_token(content, chunk=chunk)
+                            yield chunk
+                            if limit and emitted_tokens >= limit * EARLY_STOP_RATIO:
+                                # 上游没有遵守 max_tokens：主动断开，释放连接和调度槽位
+                                self._estimate_usage(data, "".join(completion), usage)
+                                request_span.set_attribute("early_stop", True)
+                                stopped = True
+                                break
+                        if stopped:
+                            break
+            except (asyncio.CancelledError, GeneratorExit) as e:
+                # 上游已经开始计费：按已收到的内容估算用量（例如对冲中落败的请求）
+                self._estimate_usage(data, "".join(completion), usage, truncated="cancelled")
+                breaker.release_probe()
+                request_span.set_attribute("response_chars", response_chars)
+                TRACER.end_span(request_span, e)
+                raise
+            except Exception as e:
+                request_span.set_attribute("response_chars", response_chars)
+                TRACER.end_span(request_span, e)
+                if isinstance(e, httpx.TransportError):
+                    UPSTREAM_RESPONSES.inc(data["model"], "error")
+                if not is_retryable(e):
+                    breaker.release_probe()
+                    raise translate_error(e)
+                breaker.record_failure()
+                delay = backoff_delay(attempt, e) if attempt < attempts and not emitted else None
+                if delay is None:
+                    print(f"Streaming request failed: {e}")
+                    raise translate_error(e)
+                print(f"Retrying stream for {data['model']} after error ({attempt}/{attempts - 1}): {e}")
+                await asyncio.sleep(delay)
+            else:
+                request_span.set_attribute("response_chars", response_chars)
+                TRACER.end_span(request_span)
+                breaker.record_success()
+                return
+
+    async def _acall(
+            self,
+            prompt: str,
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> str:
+        streaming_callback = _get_call_options().get("streaming_callback") or self.streaming_callback
+        if streaming_callback is not None:
+            # --- 流式输出模式：按顺序等待每个回调完成，回调阻塞时即形成背压 ---
+            parts: List[str] = []
+            async for chunk in self._astream(prompt, stop, run_manager, **kwargs):
+                parts.append(chunk.text)
+                if inspect.iscoroutinefunction(streaming_callback):
+                    await streaming_callback(chunk.text)
+                else:
+                    streaming_callback(chunk.text)
+            return "".join(parts)
+
+        # --- 非流式输出模式：幂等，失败时按退避重试 ---
+        data = self._build_payload(prompt, stop, False)
+        usage = _get_call_options().get("usage")
+
+        async def send() -> str:
+            with span("openrouter.request", model=data["model"], stream=False, prompt_chars=len(prompt)) as request_span:
+                try:
+                    response = await get_async_client().post(OPENROUTER_API_URL, headers=self._build_headers(),
+                                                             json=data, timeout=timeout_for(get_timeout()))
+                except httpx.TransportError:
+                    UPSTREAM_RESPONSES.inc(data["model"], "error")
+                    raise
+                except asyncio.CancelledError:
+                    # 对冲中落败的请求在这里被取消：提示词已经发出，补计估算的用量（补全部分无法得知）
+                    self._estimate_usage(data, "", usage, truncated="cancelled")
+                    raise
+                UPSTREAM_RESPONSES.inc(data["model"], str(response.status_code))
+                request_span.set_attributes(status_code=response.status_code, http_version=response.http_version)
+                if response.status_code != 200:
+                    raise UpstreamStatusError(response.status_code, response.text, parse_retry_after(response))
+                body = response.json()
+                self._record_response_usage(body, usage)
+                content = body["choices"][0]["message"]["content"]
+                request_span.set_attribute("response_chars", len(content))
+                return content
+
+        return await resilient_call(data["model"], send)
 
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
@@ -145,24 +533,56 @@ class OpenRouterLLM(LLM):
         }
 
 
+class ChainRegistry:
+    """
+    Process-wide registry of compiled chains.
+
+    Every chain is built once from the shared templates in prompts.PROMPTS on top of a
+    single OpenRouterLLM; the model and streaming callback are chosen per call, so
+    sessions only need to remember which model they use.
+    """
+
+    def __init__(self, api_key: str):
+        self.llm = OpenRouterLLM(
+            api_key=api_key,
+            temperature=0.2
+        )
+        self.chains = {name: prompt | self.llm for name, prompt in PROMPTS.items()}
+
+    def get(self, name: str):
+        return self.chains[name]
+
+
+_CHAIN_REGISTRIES: Dict[str, ChainRegistry] = {}
+
+
+def get_chain_registry(api_key: str) -> ChainRegistry:
+    """Return the shared ChainRegistry for this API key, building it on first use."""
+    registry = _CHAIN_REGISTRIES.get(api_key)
+    if registry is None:
+        registry = ChainRegistry(api_key)
+        _CHAIN_REGISTRIES[api_key] = registry
+    return registry
+
+
 class InteractiveLearningAssistant:
     def __init__(self, api_key, model="anthropic/claude-3-opus"):
         """
         Initialize Interactive Learning Assistant using LangChain.
 
+        The assistant only holds per-session settings; prompts, chains and the LLM
+        client are shared process-wide through ChainRegistry.
+
         Args:
             api_key: OpenRouter API key
             model: Model to use
         """
         self.api_key = api_key
         self.model = model
-        self.llm = OpenRouterLLM(
-            api_key=api_key,
-            model=model,
-            temperature=0.2
-        )
-        self.memory = ConversationBufferMemory(return_messages=True)
-        self._initialize_chains()
+        self.streaming_callback = None
+        # 所属会话，用于调度器在会话之间公平轮转
+        self.session_id = ""
+        self.registry = get_chain_registry(api_key)
 
     def set_streaming_callback(self, callback):
         """
@@ -171,7 +591,7 @@ class InteractiveLearningAssistant:
         Args:
             callback: Function that takes a string chunk as input
         """
-        self.llm.streaming_callback = callback
+        self.streaming_callback = callback
 
     def update_model(self, model):
         """
@@ -180,301 +600,167 @@ class InteractiveLearningAssistant:
         Args:
             model: New model name
         """
+        # 链在调用时才绑定模型，无需重新构建
         self.model = model
-        # Preserve the streaming callback if it exists
-        streaming_callback = getattr(self.llm, 'streaming_callback', None)
 
-        self.llm = OpenRouterLLM(
-            api_key=self.api_key,
-            model=model,
-            temperature=0.2
-        )
-
-        # Restore the streaming callback
-        if streaming_callback:
-            self.llm.streaming_callback = streaming_callback
-
-        # 重新初始化所有链以使用新的LLM
-        self._initialize_chains()
-
-    def _initialize_chains(self):
-        """Initialize all the LangChain chains needed for the assistant."""
-
-        # 初始引导链 - 用于分析问题并提供有价值的初始指导
-        initial_guidance_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
-        Your goal is to provide insightful analysis and helpful guidance to students.
-
-        # Initial Problem Analysis
-
-        Problem: {problem}
-        Language: {language}
-        User Context: {skill_level}
-
-        ## CRITICAL INSTRUCTIONS:
-        - START by analyzing the problem: identify the core challenge, key requirements, and potential approaches
-        - Provide 2-3 specific insights about the problem (patterns, data structures, algorithms that might be relevant)
-        - Give concrete guidance on how to approach this type of problem
-        - End with ONE focused question that helps them take the next step
-        - Keep your response helpful and concise (max 150 words)
-        - Be encouraging and constructive
-        - Focus on being genuinely helpful rather than just asking questions
-
-        ## Response Structure:
-        1. **Problem Analysis:** (What type of problem this is, key challenges)
-        2. **Approach Suggestions:** (Specific techniques or strategies)
-        3. **Next Step:** (One clear question to guide them forward)
-
-        Provide valuable analysis first, then guide them with one thoughtful question.
-        """
-
-        initial_guidance_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level"],
-            template=initial_guidance_template
-        )
-
-        # Use new RunnableSequence syntax instead of deprecated LLMChain
-        self.initial_guidance_chain = initial_guidance_prompt | self.llm
-
-        # 对话继续链 - 用于持续对话
-        conversation_continuation_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
-        You're currently engaged in a step-by-step conversation with a student about solving a programming problem.
-
-        # Conversation Context
-
-        Problem: {problem}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Current Stage: {current_stage}
-        Conversation History:
-        {conversation_history}
-
-        Student's Latest Response: {student_response}
-
-        ## CRITICAL INSTRUCTIONS:
-        - DO NOT solve the problem for the student.
-        - Keep your response brief (max 150 words).
-        - Respond directly to the student's latest input.
-        - Ask ONE follow-up question to guide their thinking to the next step.
-        - If they're stuck, provide a small hint that guides but doesn't give away the solution.
-        - If they have a misconception, ask a Socratic question to help them discover the issue.
-        - Match the technical level to their skill level.
-        - Your goal is to maintain an engaging dialogue that leads to learning through discovery.
-
-        Respond conversationally as a helpful tutor would, keeping the student engaged and moving forward in their thinking process.
-        """
-
-        conversation_continuation_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level", "current_stage", "conversation_history",
-                             "student_response"],
-            template=conversation_continuation_template
-        )
-
-        self.conversation_continuation_chain = conversation_continuation_prompt | self.llm
-
-        # 阶段转换链 - 用于在学习阶段之间平滑过渡
-        stage_transition_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
-        You're guiding a student through solving a programming problem step-by-step.
-
-        # Stage Transition Guidance
-
-        Problem: {problem}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Previous Stage: {previous_stage}
-        New Stage: {new_stage}
-        Progress Summary: {progress_summary}
-
-        ## CRITICAL INSTRUCTIONS:
-        - Create a brief transition message (max 100 words) between learning stages.
-        - Acknowledge what was accomplished in the previous stage.
-        - Briefly explain the purpose of the new stage.
-        - Ask ONE targeted question to begin the new stage.
-        - Keep the tone encouraging and supportive.
-        - DO NOT solve any part of the problem for the student.
-        - Include a simple emoji relevant to the new stage at the beginning of your message.
+    def _call_options(self, streaming_callback: Optional[Callable[[str], Any]], **options: Any) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "streaming_callback": streaming_callback or self.streaming_callback,
+            **options
+        }
 
-        Write a concise, energizing transition that maintains learning momentum while shifting focus to the new stage.
+    def _invoke(self, chain_name: str, inputs: Dict[str, Any],
+                history: Optional[List[Dict[str, str]]] = None, **options: Any) -> str:
+        """Invoke a shared chain synchronously with this session's model."""
+        options.setdefault("max_tokens", chain_max_tokens(chain_name))
+        usage: Dict[str, Any] = {}
+        with span(f"chain {chain_name}", chain=chain_name, model=self.model,
+                  input_chars=_input_chars(inputs, history)) as chain_span:
+            token = _call_options_var.set(self._call_options(
+                None, messages=_prompt_prefix(chain_name, inputs, history), usage=usage, **options
+            ))
+            started = time.perf_counter()
+            try:
+                result = self.registry.get(chain_name).invoke(inputs)
+            finally:
+                _call_options_var.reset(token)
+                USAGE.record(self.session_id, chain_name, self.model, usage, time.perf_counter() - started)
+            chain_span.set_attributes(response_chars=len(result), **usage)
+            return result
+
+    async def _ainvoke(self, chain_name: str, inputs: Dict[str, Any],
+                       streaming_callback: Optional[Callable[[str], Any]] = None,
+                       history: Optional[List[Dict[str, str]]] = None, **options: Any) -> str:
         """
-
-        stage_transition_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level", "previous_stage", "new_stage", "progress_summary"],
-            template=stage_transition_template
-        )
-
-        self.stage_transition_chain = stage_transition_prompt | self.llm
-
-        # 代码反馈链 - 回归苏格拉底式引导
-        code_feedback_template = """
-        You are an expert programming tutor who uses the Socratic method to guide students.
-        Your goal is to help students find and fix their own bugs, not to give them the answers.
-
-        # Socratic Code Feedback
-
-        Problem: {problem}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Student's Code: {student_code}
-
-        ## CRITICAL INSTRUCTIONS:
-        - **NEVER provide the correct code or a direct solution.**
-        - **DO NOT point out the exact line number of the error.** Your goal is to help them think, not just spot mistakes.
-        - Start by acknowledging their effort and finding something positive to say about their code.
-        - If there is a logic error, gently point towards the area of the issue and ask a guiding question. For example: "That's a good start. I see you're using nested loops to check pairs. Have you considered what happens with the range of your loops? Does it cover all necessary elements?"
-        - If the code is functionally correct but inefficient (e.g., a brute-force solution for a problem that has an optimal O(n) solution), first praise them for finding a working solution. Then, ask a question to prompt them to think about optimization. For example: "Excellent, this solution works! Now, can you think of a way to solve this without using nested loops? Perhaps a data structure could help you remember numbers you've already seen?"
-        - If the code is correct and optimal, confirm it and praise their work. You can then suggest exploring edge cases or alternative implementations.
-        - Your response should be a short, encouraging paragraph followed by ONE guiding question.
-        - Keep your response under 100 words.
-
-        Guide the student to their own "aha!" moment. Be a coach, not a code-corrector.
+        Invoke a shared chain asynchronously, streaming this call's output to streaming_callback.
+
+        The model, callback and extra options (e.g. response_format) apply only to the
+        current call (and task), so concurrent requests never receive each other's chunks or models.
+        The request is sent as the chain's static system prompt, the problem context, any prior
+        turns in history, and finally the rendered chain prompt. Output is capped at the chain's
+        max_tokens unless the caller passes its own.
+        ROUTER picks the model(s) for the chain; each attempt waits for a slot from SCHEDULER
+        in the chain's priority lane.
         """
+        started = time.perf_counter()
+        outcome = "error"
+        options["messages"] = _prompt_prefix(chain_name, inputs, history)
+        options.setdefault("max_tokens", chain_max_tokens(chain_name))
+        with span(f"chain {chain_name}", chain=chain_name, session_model=self.model, session_id=self.session_id,
+                  input_chars=_input_chars(inputs, history)) as chain_span:
+            try:
+                result = await self._ainvoke_routed(chain_name, inputs, streaming_callback, **options)
+                outcome = "ok"
+                chain_span.set_attribute("response_chars", len(result))
+                return result
+            finally:
+                CHAIN_DURATION.observe(time.perf_counter() - started, chain_name, outcome)
+
+    async def _ainvoke_routed(self, chain_name: str, inputs: Dict[str, Any],
+                              streaming_callback: Optional[Callable[[str], Any]], **options: Any) -> str:
+        candidates = ROUTER.candidates(chain_name, self.model)
+        callback = streaming_callback or self.streaming_callback
+        if callback is None:
+            return await ROUTER.call(
+                candidates, lambda model: self._ainvoke_model(model, chain_name, inputs, None, **options)
+            )
+
+        # 流式调用：只有在还没有输出任何内容时才能切换到下一个候选模型
+        for index, model in enumerate(candidates):
+            emitted = False
+
+            async def tracked_callback(chunk: str) -> None:
+                nonlocal emitted
+                emitted = True
+                await emit_text(callback, chunk)
 
-        code_feedback_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level", "current_stage", "student_code"],
-            template=code_feedback_template
-        )
-
-        self.code_feedback_chain = code_feedback_prompt | self.llm
-
-        # 概念解释链 - 用于解释学生请求的特定编程概念
-        concept_explanation_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
-
-        # Concept Explanation
-
-        Concept to explain: {concept}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Current Problem Context: {problem}
-
-        ## CRITICAL INSTRUCTIONS:
-        - Explain the requested concept clearly and concisely (max 150 words).
-        - Adapt explanation complexity to the student's skill level.
-        - Include a very small, simple code example (3-5 lines) demonstrating the concept.
-        - Relate the concept back to the current problem if relevant, but DO NOT solve the problem.
-        - Include one thought-provoking question at the end about applying this concept.
-        - Your explanation should illuminate understanding, not provide direct solutions.
-        - For visual concepts, use text-based visualization if helpful (e.g., trees, arrays).
+            try:
+                return await self._ainvoke_model(model, chain_name, inputs, tracked_callback, **options)
+            except UpstreamUnavailable:
+                if emitted or index == len(candidates) - 1:
+                    raise
+                ROUTER.failovers += 1
+        raise AssertionError("unreachable")
+
+    async def _ainvoke_model(self, model: str, chain_name: str, inputs: Dict[str, Any],
+                             streaming_callback: Optional[Callable[[str], Any]], **options: Any) -> str:
+        # 熔断器打开时直接失败，不必在调度队列中等待
+        get_breaker(model).reject_if_open()
+        priority = effective_priority(CHAIN_PRIORITIES.get(chain_name, PRIORITY_NORMAL))
+        with span("llm.attempt", model=model, priority=priority) as attempt_span:
+            queued = time.perf_counter()
+            async with SCHEDULER.slot(model, priority, self.session_id):
+                attempt_span.set_attribute("queue_wait_ms", round((time.perf_counter() - queued) * 1000, 3))
+                return await self._ainvoke_slot(model, chain_name, inputs, streaming_callback, attempt_span, **options)
+
+    async def _ainvoke_slot(self, model: str, chain_name: str, inputs: Dict[str, Any],
+                            streaming_callback: Optional[Callable[[str], Any]], attempt_span: Any,
+                            **options: Any) -> str:
+        timer = LatencyTimer()
+
+        async def timed_callback(chunk: str) -> None:
+            timer.mark_chunk()
+            await streaming_callback(chunk)
+
+        # LLM 把上游返回的 token 用量写回这个字典
+        usage: Dict[str, Any] = {}
+        token = _call_options_var.set(self._call_options(
+            timed_callback if streaming_callback is not None else None, model=model, usage=usage, **options
+        ))
+        try:
+            result = await self.registry.get(chain_name).ainvoke(inputs)
+        except asyncio.CancelledError:
+            UPSTREAM_DURATION.observe(timer.elapsed(), chain_name, model, "cancelled")
+            # 被取消的调用（例如对冲落败）已经产生了上游费用，LLM 会填入估算的用量
+            if usage:
+                USAGE.record(self.session_id, chain_name, model, usage, timer.elapsed())
+            raise
+        except Exception:
+            ROUTER.record(model, None, False)
+            UPSTREAM_DURATION.observe(timer.elapsed(), chain_name, model, "error")
+            USAGE.record(self.session_id, chain_name, model, usage, timer.elapsed())
+            raise
+        finally:
+            _call_options_var.reset(token)
+        ROUTER.record(model, timer.latency(), True)
+        total = timer.elapsed()
+        UPSTREAM_DURATION.observe(total, chain_name, model, "ok")
+        USAGE.record(self.session_id, chain_name, model, usage, total)
+        attempt_span.set_attributes(**usage)
+        if timer.first_chunk is not None:
+            TIME_TO_FIRST_TOKEN.observe(timer.first_chunk, chain_name, model)
+            generation = total - timer.first_chunk
+            if generation > 0:
+                STREAM_TOKENS_PER_SECOND.observe(count_tokens(result) / generation, chain_name, model)
+            attempt_span.set_attribute("ttft_ms", round(timer.first_chunk * 1000, 3))
+        attempt_span.set_attribute("response_chars", len(result))
+        return result
 
-        Explain the concept in a way that promotes understanding, rather than just providing information.
+    async def _acached(self, get_or_compute: Callable[..., Awaitable[str]], chain_name: str,
+                       inputs: Dict[str, Any], streaming_callback: Optional[Callable[[str], Any]]) -> str:
         """
+        Invoke a chain through a shared cache.
 
-        concept_explanation_prompt = PromptTemplate(
-            input_variables=["concept", "language", "skill_level", "problem"],
-            template=concept_explanation_template
-        )
-
-        self.concept_explanation_chain = concept_explanation_prompt | self.llm
-
-        # 提示生成链 - 用于提供小提示而不是完整解决方案
-        hint_generation_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
-
-        # Hint Generation
-
-        Problem: {problem}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Current Stage: {current_stage}
-        Specific Hint Request: {hint_request}
-        Progress So Far: {progress_summary}
-
-        ## CRITICAL INSTRUCTIONS:
-        - Provide exactly ONE small, targeted hint (max 70 words).
-        - The hint should nudge them forward without revealing the solution.
-        - Never provide actual code that solves the problem or major components.
-        - For beginners: more concrete direction but still requires thinking.
-        - For intermediate: point to a concept or approach, but leave implementation details open.
-        - For advanced: very subtle hint about algorithm strategy or optimization direction.
-        - Format as a question or suggestion that promotes discovery, not a direct answer.
-        - If they're asking for a complete solution, gently redirect with a thinking prompt instead.
-
-        Create a hint that gives just enough information to help them progress without doing the thinking for them.
+        get_or_compute(compute, on_chunk) looks the result up and runs compute once for all
+        concurrent callers. The upstream call streams into the cache's buffer; this caller
+        replays the chunks at its own pace, or receives a cached result as one chunk.
         """
+        callback = streaming_callback or self.streaming_callback
+        streamed = False
 
-        hint_generation_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level", "current_stage", "hint_request", "progress_summary"],
-            template=hint_generation_template
-        )
-
-        self.hint_generation_chain = LLMChain(
-            llm=self.llm,
-            prompt=hint_generation_prompt,
-            output_key="hint"
-        )
-
-        # 进度总结链 - 用于总结学生迄今为止的进展
-        progress_summary_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
+        async def compute(emit: Optional[Callable[[str], Awaitable[None]]]) -> str:
+            return await self._ainvoke(chain_name, inputs, emit)
 
-        # Progress Summary
+        async def on_chunk(chunk: str) -> None:
+            nonlocal streamed
+            streamed = True
+            await emit_text(callback, chunk)
 
-        Problem: {problem}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Conversation History:
-        {conversation_history}
-
-        ## CRITICAL INSTRUCTIONS:
-        - Create a very brief summary (max 100 words) of the student's progress so far.
-        - Identify key insights or approaches the student has discovered or discussed.
-        - Note any specific challenges or misconceptions that have been addressed.
-        - DO NOT include any new solutions or approaches not already mentioned by the student.
-        - Focus on what the STUDENT has accomplished, not what you have explained.
-        - Write in a third-person analytical style (not directly addressing the student).
-
-        Provide an objective assessment of the current state of the student's understanding and progress on the problem.
-        """
-
-        progress_summary_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level", "conversation_history"],
-            template=progress_summary_template
-        )
-
-        self.progress_summary_chain = LLMChain(
-            llm=self.llm,
-            prompt=progress_summary_prompt,
-            output_key="progress_summary"
-        )
-
-        # 微型挑战创建链 - 创建与当前问题相关的小型挑战
-        mini_challenge_template = """
-        You are an Interactive Programming Learning Assistant with expertise in algorithmic problem-solving.
-
-        # Mini-Challenge Creation
-
-        Problem: {problem}
-        Language: {language}
-        User Skill Level: {skill_level}
-        Current Stage: {current_stage}
-        Focus Area: {focus_area}
-
-        ## CRITICAL INSTRUCTIONS:
-        - Create a small, focused coding challenge related to the current problem or concept.
-        - The challenge should take less than 5 minutes to solve.
-        - It should test understanding of a specific concept relevant to the main problem.
-        - Include a clear, brief problem statement (max 50 words).
-        - Provide 2-4 multiple choice options OR ask for a very small code snippet (max 3 lines).
-        - Include the correct answer (marked as "CORRECT_ANSWER: ") and a brief explanation (marked as "EXPLANATION: ").
-        - These markers should not be visible to the student - they'll be extracted programmatically.
-        - The challenge difficulty should match the student's skill level.
-        - This should help with a specific concept needed for the main problem without solving it.
-
-        Design a mini-challenge that reinforces learning through active practice of a relevant concept.
-        """
-
-        mini_challenge_prompt = PromptTemplate(
-            input_variables=["problem", "language", "skill_level", "current_stage", "focus_area"],
-            template=mini_challenge_template
-        )
-
-        self.mini_challenge_chain = LLMChain(
-            llm=self.llm,
-            prompt=mini_challenge_prompt,
-            output_key="mini_challenge"
-        )
+        result = await get_or_compute(compute, on_chunk if callback is not None else None)
+        if not streamed:
+            await emit_text(callback, result)
+        return result
 
     def get_initial_guidance(self, problem: str, language: str, skill_level: str) -> str:
         """
@@ -488,15 +774,34 @@ class InteractiveLearningAssistant:
         Returns:
             Initial analysis with helpful insights and one focused question
         """
-        result = self.initial_guidance_chain.invoke({
-            "problem": problem,
-            "language": language,
-            "skill_level": skill_level
-        })
-        return result
+        key = self._guidance_cache_key(problem, language, skill_level)
+        guidance = GUIDANCE_CACHE.get(key)
+        if guidance is None:
+            guidance = self._invoke("initial_guidance", {
+                "problem": problem,
+                "language": language,
+                "skill_level": skill_level
+            })
+            GUIDANCE_CACHE.set(key, guidance)
+        return guidance
+
+    async def aget_initial_guidance(self, problem: str, language: str, skill_level: str,
+                                    streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of get_initial_guidance; cached per problem fingerprint and shared across sessions."""
+        key = self._guidance_cache_key(problem, language, skill_level)
+        return await self._acached(
+            lambda compute, on_chunk: GUIDANCE_CACHE.get_or_compute(key, compute, on_chunk),
+            "initial_guidance", {
+                "problem": problem,
+                "language": language,
+                "skill_level": skill_level
+            }, streaming_callback)
+
+    def _guidance_cache_key(self, problem: str, language: str, skill_level: str) -> tuple:
+        return (problem_fingerprint(problem), language, skill_level, self.model)
 
     def continue_conversation(self, problem: str, language: str, skill_level: str,
-                              current_stage: str, conversation_history: str,
+                              current_stage: str, conversation_history: Union[str, List[Dict[str, str]]],
                               student_response: str) -> str:
         """
         Generate a response to continue the conversation with the student.
@@ -506,21 +811,33 @@ class InteractiveLearningAssistant:
             language: The programming language
             skill_level: User's skill level
             current_stage: The current learning stage
-            conversation_history: Prior conversation formatted as text
+            conversation_history: Prior turns as chat messages (see Session.build_conversation_messages),
+                or formatted as text
             student_response: The student's latest response
 
         Returns:
             AI response to continue the conversation
         """
-        result = self.conversation_continuation_chain.invoke({
+        return self._invoke("conversation_continuation", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
             "current_stage": current_stage,
-            "conversation_history": conversation_history,
             "student_response": student_response
-        })
-        return result
+        }, history=_history_messages(conversation_history))
+
+    async def acontinue_conversation(self, problem: str, language: str, skill_level: str,
+                                     current_stage: str, conversation_history: Union[str, List[Dict[str, str]]],
+                                     student_response: str,
+                                     streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of continue_conversation; chunks go to streaming_callback if given."""
+        return await self._ainvoke("conversation_continuation", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "current_stage": current_stage,
+            "student_response": student_response
+        }, streaming_callback, history=_history_messages(conversation_history))
 
     def generate_stage_transition(self, problem: str, language: str, skill_level: str,
                                   previous_stage: str, new_stage: str, progress_summary: str) -> str:
@@ -538,7 +855,7 @@ class InteractiveLearningAssistant:
         Returns:
             Transition message to the new stage
         """
-        result = self.stage_transition_chain.invoke({
+        return self._invoke("stage_transition", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
@@ -546,7 +863,19 @@ class InteractiveLearningAssistant:
             "new_stage": new_stage,
             "progress_summary": progress_summary
         })
-        return result
+
+    async def agenerate_stage_transition(self, problem: str, language: str, skill_level: str,
+                                         previous_stage: str, new_stage: str, progress_summary: str,
+                                         streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of generate_stage_transition."""
+        return await self._ainvoke("stage_transition", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "previous_stage": previous_stage,
+            "new_stage": new_stage,
+            "progress_summary": progress_summary
+        }, streaming_callback)
 
     def provide_code_feedback(self, problem: str, language: str, skill_level: str,
                               current_stage: str, student_code: str) -> str:
@@ -563,14 +892,25 @@ class InteractiveLearningAssistant:
         Returns:
             Direct feedback with specific issues, solutions, and improvements
         """
-        result = self.code_feedback_chain.invoke({
+        return self._invoke("code_feedback", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
             "current_stage": current_stage,
             "student_code": student_code
         })
-        return result
+
+    async def aprovide_code_feedback(self, problem: str, language: str, skill_level: str,
+                                     current_stage: str, student_code: str,
+                                     streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of provide_code_feedback."""
+        return await self._ainvoke("code_feedback", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "current_stage": current_stage,
+            "student_code": student_code
+        }, streaming_callback)
 
     def explain_concept(self, concept: str, language: str, skill_level: str, problem: str) -> str:
         """
@@ -585,13 +925,38 @@ class InteractiveLearningAssistant:
         Returns:
             Explanation of the concept
         """
-        result = self.concept_explanation_chain.invoke({
-            "concept": concept,
-            "language": language,
-            "skill_level": skill_level,
-            "problem": problem
-        })
-        return result
+        key = self._explanation_cache_key(concept, language, skill_level, problem)
+        explanation = EXPLANATION_CACHE.get(key)
+        if explanation is None:
+            explanation = self._invoke("concept_explanation", {
+                "concept": concept,
+                "language": language,
+                "skill_level": skill_level,
+                "problem": problem
+            })
+            EXPLANATION_CACHE.set(key, explanation)
+        return explanation
+
+    async def aexplain_concept(self, concept: str, language: str, skill_level: str, problem: str,
+                               streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """
+        Async variant of explain_concept.
+
+        Results are shared across sessions; concurrent identical requests trigger a single
+        upstream call whose chunks are streamed to every one of them.
+        """
+        key = self._explanation_cache_key(concept, language, skill_level, problem)
+        return await self._acached(
+            lambda compute, on_chunk: EXPLANATION_CACHE.get_or_compute(key, compute, on_chunk),
+            "concept_explanation", {
+                "concept": concept,
+                "language": language,
+                "skill_level": skill_level,
+                "problem": problem
+            }, streaming_callback)
+
+    def _explanation_cache_key(self, concept: str, language: str, skill_level: str, problem: str) -> tuple:
+        return (concept.strip().lower(), language, skill_level, text_digest(problem), self.model)
 
     def generate_hint(self, problem: str, language: str, skill_level: str,
                       current_stage: str, hint_request: str, progress_summary: str) -> str:
@@ -609,7 +974,7 @@ class InteractiveLearningAssistant:
         Returns:
             A hint that guides without solving
         """
-        result = self.hint_generation_chain({
+        return self._invoke("hint_generation", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
@@ -617,7 +982,19 @@ class InteractiveLearningAssistant:
             "hint_request": hint_request,
             "progress_summary": progress_summary
         })
-        return result["hint"]
+
+    async def agenerate_hint(self, problem: str, language: str, skill_level: str,
+                             current_stage: str, hint_request: str, progress_summary: str,
+                             streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of generate_hint."""
+        return await self._ainvoke("hint_generation", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "current_stage": current_stage,
+            "hint_request": hint_request,
+            "progress_summary": progress_summary
+        }, streaming_callback)
 
     def summarize_progress(self, problem: str, language: str, skill_level: str,
                            conversation_history: str) -> str:
@@ -633,13 +1010,58 @@ class InteractiveLearningAssistant:
         Returns:
             A summary of the student's progress
         """
-        result = self.progress_summary_chain({
+        return self._invoke("progress_summary", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
             "conversation_history": conversation_history
         })
-        return result["progress_summary"]
+
+    async def asummarize_progress(self, problem: str, language: str, skill_level: str,
+                                  conversation_history: str,
+                                  streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of summarize_progress."""
+        return await self._ainvoke("progress_summary", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "conversation_history": conversation_history
+        }, streaming_callback)
+
+    def update_progress_summary(self, problem: str, language: str, skill_level: str,
+                                previous_summary: str, new_messages: str) -> str:
+        """
+        Fold new conversation messages into an existing progress summary.
+
+        Args:
+            problem: The programming problem description
+            language: The programming language
+            skill_level: User's skill level
+            previous_summary: The summary produced for the earlier part of the conversation
+            new_messages: Messages added since that summary, formatted as text
+
+        Returns:
+            The updated summary of the student's progress
+        """
+        return self._invoke("progress_summary_update", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "previous_summary": previous_summary,
+            "new_messages": new_messages
+        })
+
+    async def aupdate_progress_summary(self, problem: str, language: str, skill_level: str,
+                                       previous_summary: str, new_messages: str,
+                                       streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of update_progress_summary."""
+        return await self._ainvoke("progress_summary_update", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "previous_summary": previous_summary,
+            "new_messages": new_messages
+        }, streaming_callback)
 
     def create_mini_challenge(self, problem: str, language: str, skill_level: str,
                               current_stage: str, focus_area: str) -> dict:
@@ -656,39 +1078,59 @@ class InteractiveLearningAssistant:
         Returns:
             A dictionary containing the challenge, correct answer, and explanation
         """
-        result = self.mini_challenge_chain({
+        result = self._invoke("mini_challenge", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
             "current_stage": current_stage,
-            "focus_area": focus_area
-        })
+            "focus_area": focus_area,
+            "count": 1
+        }, response_format=CHALLENGE_RESPONSE_FORMAT, max_tokens=MINI_CHALLENGE_MAX_TOKENS_EACH)
+        return parse_challenge_batch(result)[0]
 
-        # Extract components from the result
-        raw_challenge = result["mini_challenge"]
+    async def acreate_mini_challenge(self, problem: str, language: str, skill_level: str,
+                                     current_stage: str, focus_area: str) -> dict:
+        """
+        Async variant of create_mini_challenge.
 
-        # Parse to extract the correct answer and explanation
-        correct_answer = ""
-        explanation = ""
-        challenge_text = ""
+        Challenges are served from CHALLENGE_POOL, which is shared across sessions and
+        filled CHALLENGE_BATCH_SIZE challenges at a time by one structured-output call.
+        """
+        key = self._challenge_pool_key(problem, language, skill_level, current_stage)
+        return await CHALLENGE_POOL.take(
+            key, lambda: self.acreate_mini_challenge_batch(problem, language, skill_level, current_stage, focus_area)
+        )
 
-        lines = raw_challenge.split('\n')
-        in_challenge = True
+    async def aprefill_mini_challenges(self, problem: str, language: str, skill_level: str,
+                                       current_stage: str, focus_area: str) -> None:
+        """Make sure the challenge pool for this stage is filled before the student asks for one."""
+        key = self._challenge_pool_key(problem, language, skill_level, current_stage)
+        await CHALLENGE_POOL.ensure(
+            key, lambda: self.acreate_mini_challenge_batch(problem, language, skill_level, current_stage, focus_area)
+        )
 
-        for line in lines:
-            if line.startswith("CORRECT_ANSWER:"):
-                in_challenge = False
-                correct_answer = line.replace("CORRECT_ANSWER:", "").strip()
-            elif line.startswith("EXPLANATION:"):
-                explanation = line.replace("EXPLANATION:", "").strip()
-            elif in_challenge:
-                challenge_text += line + "\n"
+    async def acreate_mini_challenge_batch(self, problem: str, language: str, skill_level: str,
+                                           current_stage: str, focus_area: str,
+                                           count: int = CHALLENGE_BATCH_SIZE) -> List[dict]:
+        """
+        Generate several mini-challenges in one call.
 
-        return {
-            "challenge": challenge_text.strip(),
-            "correct_answer": correct_answer,
-            "explanation": explanation
-        }
+        Returns:
+            List of dictionaries containing the challenge, correct answer, and explanation;
+            entries failing schema validation are dropped
+        """
+        result = await self._ainvoke("mini_challenge", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "current_stage": current_stage,
+            "focus_area": focus_area,
+            "count": count
+        }, response_format=CHALLENGE_RESPONSE_FORMAT, max_tokens=MINI_CHALLENGE_MAX_TOKENS_EACH * count)
+        return parse_challenge_batch(result)
+
+    def _challenge_pool_key(self, problem: str, language: str, skill_level: str, current_stage: str) -> tuple:
+        return (problem_fingerprint(problem), current_stage, skill_level, language, self.model)
 
     def generate_learning_summary(self, problem: str, language: str, skill_level: str,
                                 conversation_history: str) -> str:
@@ -704,63 +1146,23 @@ class InteractiveLearningAssistant:
         Returns:
             A comprehensive learning summary message
         """
-        # 首先检查是否已经初始化了学习总结链
-        if not hasattr(self, 'learning_summary_chain'):
-            self._initialize_learning_summary_chain()
-        
-        result = self.learning_summary_chain({
+        return self._invoke("learning_summary", {
             "problem": problem,
             "language": language,
             "skill_level": skill_level,
             "conversation_history": conversation_history
         })
 
-        return result["summary"]
-
-    def _initialize_learning_summary_chain(self):
-        """Initialize the learning summary chain."""
-        learning_summary_template = """
-        You are an Interactive Programming Learning Assistant. Your task is to generate a comprehensive learning summary for a student who has just completed a programming problem.
-
-        Based on the following information, create a personalized learning summary:
-
-        Problem: {problem}
-        Language: {language}
-        Student Skill Level: {skill_level}
-        
-        Complete Learning Journey:
-        {conversation_history}
-
-        ## Instructions:
-        Create a comprehensive learning summary that includes:
-
-        1. **Problem Overview**: Briefly recap what the student accomplished
-        2. **Key Concepts Learned**: List the main programming concepts and techniques covered
-        3. **Learning Highlights**: Identify the student's strongest moments and breakthroughs
-        4. **Areas of Growth**: Mention areas where the student showed improvement
-        5. **Skills Developed**: Technical and problem-solving skills gained
-        6. **Next Steps**: Suggest what types of problems or concepts to explore next
-
-        ## Requirements:
-        - Be encouraging and celebrate the student's achievement
-        - Make it personal based on their actual learning journey
-        - Keep it concise but comprehensive (300-400 words)
-        - End with congratulations and motivation for continued learning
-        - Use a warm, supportive tone that builds confidence
-
-        Generate the learning summary:
-        """
-
-        learning_summary_prompt = PromptTemplate(
-            template=learning_summary_template,
-            input_variables=["problem", "language", "skill_level", "conversation_history"]
-        )
-
-        self.learning_summary_chain = LLMChain(
-            llm=self.llm,
-            prompt=learning_summary_prompt,
-            output_key="summary"
-        )
+    async def agenerate_learning_summary(self, problem: str, language: str, skill_level: str,
+                                         conversation_history: str,
+                                         streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of generate_learning_summary."""
+        return await self._ainvoke("learning_summary", {
+            "problem": problem,
+            "language": language,
+            "skill_level": skill_level,
+            "conversation_history": conversation_history
+        }, streaming_callback)
 
     def provide_direct_code_feedback(self, problem: str, language: str, skill_level: str,
                                    current_stage: str, student_code: str) -> str:
@@ -778,16 +1180,36 @@ class InteractiveLearningAssistant:
         Returns:
             Direct feedback with specific issues, solutions, and improvements
         """
-        # Use the updated code_feedback_chain which now provides direct feedback
-        result = self.code_feedback_chain.invoke({
-            "problem": problem,
-            "language": language,
-            "skill_level": skill_level,
-            "current_stage": current_stage,
-            "student_code": student_code
-        })
-        return result
-
-
-
-
+        bucket, digest, tokens = self._feedback_cache_key(problem, language, skill_level, student_code)
+        feedback = FEEDBACK_CACHE.get(bucket, digest, tokens)
+        if feedback is None:
+            # Use the updated code_feedback_chain which now provides direct feedback
+            feedback = self._invoke("code_feedback", {
+                "problem": problem,
+                "language": language,
+                "skill_level": skill_level,
+                "current_stage": current_stage,
+                "student_code": student_code
+            })
+            FEEDBACK_CACHE.set(bucket, digest, tokens, feedback)
+        return feedback
+
+    async def aprovide_direct_code_feedback(self, problem: str, language: str, skill_level: str,
+                                            current_stage: str, student_code: str,
+                                            streaming_callback: Optional[Callable[[str], Any]] = None) -> str:
+        """Async variant of provide_direct_code_feedback; cached on the normalized code."""
+        bucket, digest, tokens = self._feedback_cache_key(problem, language, skill_level, student_code)
+        return await self._acached(
+            lambda compute, on_chunk: FEEDBACK_CACHE.get_or_compute(bucket, digest, tokens, compute, on_chunk),
+            "code_feedback", {
+                "problem": problem,
+                "language": language,
+                "skill_level": skill_level,
+                "current_stage": current_stage,
+                "student_code": student_code
+            }, streaming_callback)
+
+    def _feedback_cache_key(self, problem: str, language: str, skill_level: str, student_code: str) -> tuple:
+        canonical, tokens = normalize_code(student_code, language)
+        bucket = (problem_fingerprint(problem), language.lower(), skill_level, self.model)
+        return bucket, code_digest(canonical), tokens
@@ -0,0 +1,91 @@
+# backend/challenges.py
+"""
+微型挑战的结构化输出。
+
+挑战按批生成：一次调用返回 N 个挑战组成的 JSON，请求时通过 response_format
+附带 JSON Schema（支持结构化输出的模型会严格遵守），返回后再用 pydantic 校验。
+不合格的条目会被丢弃，整批都不合格时抛出 ValueError。
+"""
+import re
+import json
+from typing import Any, Dict, List
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+
+class MiniChallenge(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    challenge: str = Field(description="Problem statement shown to the student, including any answer options")
+    correct_answer: str = Field(description="The correct answer, e.g. the option letter or a short snippet")
+    explanation: str = Field(description="Brief explanation of why the answer is correct")
+
+
+class MiniChallengeBatch(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    challenges: List[MiniChallenge]
+
+
+# OpenRouter 的 response_format 参数（OpenAI 兼容的 json_schema 格式）
+CHALLENGE_RESPONSE_FORMAT: Dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "mini_challenge_batch",
+        "strict": True,
+        "schema": MiniChallengeBatch.model_json_schema()
+    }
+}
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.S)
+
+
+def _extract_json(raw: str) -> Any:
+    # 不支持结构化输出的模型经常把 JSON 包在代码块里或前后加说明文字
+    text = raw.strip()
+    fenced = _FENCE_RE.search(text)
+    if fenced:
+        text = fenced.group(1).strip()
+    if not text.startswith(("{", "[")):
+        start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+        if start < 0:
+            raise ValueError("Mini-challenge response contains no JSON")
+        text = text[start:]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        # 去掉 JSON 之后的多余文字再试一次
+        end = max(text.rfind("}"), text.rfind("]"))
+        try:
+            return json.loads(text[:end + 1])
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Mini-challenge response is not valid JSON: {e}")
+
+
+def parse_challenge_batch(raw: str) -> List[Dict[str, str]]:
+    """
+    Validate a batch response and return the challenges as dictionaries.
+
+    Args:
+        raw: The model output, ideally a MiniChallengeBatch JSON document
+
+    Returns:
+        List of {'challenge', 'correct_answer', 'explanation'} dictionaries
+    """
+    data = _extract_json(raw)
+    items = data.get("challenges", []) if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise ValueError("Mini-challenge response has no 'challenges' list")
+
+    challenges = []
+    for item in items:
+        try:
+            challenge = MiniChallenge.model_validate(item)
+        except ValidationError as e:
+            print(f"Dropping invalid mini-challenge: {e}")
+            continue
+        if challenge.challenge.strip() and challenge.correct_answer.strip():
+            challenges.append(challenge.model_dump())
+    if not challenges:
+        raise ValueError("Mini-challenge response contains no valid challenges")
+    return challenges
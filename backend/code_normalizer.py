@@ -0,0 +1,139 @@
+# backend/code_normalizer.py
+"""
+把学生代码规范化为与空白、注释和变量命名无关的形式，用作代码反馈缓存的 key。
+
+- Python：解析 AST，去掉文档字符串，按出现顺序把用户定义的标识符重命名为
+  v0、v1……，然后 ast.dump。
+- 其他语言（以及无法解析的 Python）：去掉注释，按词法切分为 token 序列，非关键字标识符同样按出现顺序重命名。
+
+两种情况都会返回规范化后的 token 序列，用于近似重复的相似度比较。
+"""
+import re
+import ast
+import builtins
+import hashlib
+from typing import Dict, List, Tuple
+
+# 常见语言的关键字和内置名称，不参与重命名（未知语言只会让 key 稍微保守一些）
+_GENERIC_KEYWORDS = {
+    # C / C++ / Java / C# / JavaScript / TypeScript / Go / Rust / Swift / Kotlin
+    "abstract", "as", "async", "auto", "await", "bool", "boolean", "break", "byte", "case", "catch",
+    "char", "class", "const", "continue", "def", "default", "defer", "delete", "do", "double", "elif",
+    "else", "enum", "export", "extends", "false", "final", "finally", "float", "fn", "for", "func",
+    "function", "go", "if", "impl", "implements", "import", "in", "include", "instanceof", "int",
+    "interface", "let", "long", "loop", "match", "mut", "namespace", "new", "nil", "null", "nullptr",
+    "override", "package", "private", "protected", "pub", "public", "range", "return", "self", "short",
+    "signed", "sizeof", "static", "std", "string", "String", "struct", "super", "switch", "this",
+    "throw", "throws", "true", "try", "type", "typedef", "typeof", "unsigned", "use", "using", "val",
+    "var", "vector", "void", "volatile", "while", "yield", "map", "make", "len", "append", "fun",
+    "println", "printf", "print", "cout", "cin", "endl", "console", "log", "System", "out", "Math",
+    "List", "ArrayList", "HashMap", "Map", "Set", "HashSet", "Vec", "Some", "None", "Ok", "Err",
+    "undefined", "length", "push", "pop", "size", "main",
+}
+
+_TOKEN_RE = re.compile(
+    r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`(?:\\.|[^`\\])*`'  # 字符串
+    r'|\d+(?:\.\d+)?'                                          # 数字
+    r'|[A-Za-z_]\w*'                                          # 标识符
+    r'|==|!=|<=|>=|&&|\|\||->|=>|::|\+\+|--|[+\-*/%=<>!&|^~?:;,.(){}\[\]]'
+)
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_]\w*")
+_C_COMMENT_RE = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+_HASH_COMMENT_RE = re.compile(r"#[^\n]*")
+_HASH_COMMENT_LANGUAGES = {"python", "ruby", "shell", "bash", "perl", "r"}
+
+_PYTHON_BUILTINS = set(dir(builtins))
+
+
+class _PythonRenamer(ast.NodeTransformer):
+    """Rename user-defined names in order of first appearance, keep builtins and attributes."""
+
+    def __init__(self):
+        self.names: Dict[str, str] = {}
+
+    def _rename(self, name: str) -> str:
+        if name in _PYTHON_BUILTINS:
+            return name
+        if name not in self.names:
+            self.names[name] = f"v{len(self.names)}"
+        return self.names[name]
+
+    def _strip_docstring(self, node):
+        body = getattr(node, "body", None)
+        if body and isinstance(body[0], ast.Expr) and isinstance(getattr(body[0], "value", None), ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+
+    def visit_Module(self, node):
+        self._strip_docstring(node)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self._strip_docstring(node)
+        node.name = self._rename(node.name)
+        return self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self._strip_docstring(node)
+        node.name = self._rename(node.name)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        node.id = self._rename(node.id)
+        return node
+
+    def visit_arg(self, node):
+        node.arg = self._rename(node.arg)
+        node.annotation = None
+        return node
+
+
+def _normalize_python(code: str) -> Tuple[str, List[str]]:
+    tree = _PythonRenamer().visit(ast.parse(code))
+    canonical = ast.dump(tree, annotate_fields=False)
+    tokens = _TOKEN_RE.findall(ast.unparse(tree))
+    return canonical, tokens
+
+
+def _normalize_generic(code: str, language: str) -> Tuple[str, List[str]]:
+    # 这些语言用 # 注释；其中 // 是运算符（Python 的整除、Perl 的 defined-or），不能当作注释去掉
+    if language.lower() in _HASH_COMMENT_LANGUAGES:
+        code = _HASH_COMMENT_RE.sub(" ", code)
+    else:
+        code = _C_COMMENT_RE.sub(" ", code)
+    names: Dict[str, str] = {}
+    tokens = []
+    for token in _TOKEN_RE.findall(code):
+        if _IDENTIFIER_RE.fullmatch(token) and token not in _GENERIC_KEYWORDS:
+            if token not in names:
+                names[token] = f"v{len(names)}"
+            token = names[token]
+        tokens.append(token)
+    return " ".join(tokens), tokens
+
+
+def normalize_code(code: str, language: str) -> Tuple[str, List[str]]:
+    """
+    Return the canonical form of a code submission and its normalized token stream.
+
+    Args:
+        code: The code submitted by the student
+        language: The programming language of the submission
+
+    Returns:
+        (canonical string, token list); submissions differing only in whitespace,
+        comments or identifier names share the same canonical string
+    """
+    if language.lower() == "python":
+        try:
+            return _normalize_python(code)
+        except (SyntaxError, ValueError):
+            # 语法错误的代码退回到通用的 token 规范化
+            pass
+    return _normalize_generic(code, language)
+
+
+def code_digest(canonical: str) -> str:
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
@@ -0,0 +1,170 @@
+# backend/context_window.py
+"""
+按 token 预算构建对话上下文。
+
+最近的若干轮对话原样保留；更早的部分优先用滚动进度总结代替，总结尚未覆盖到的
+旧消息会被截断压缩。每条消息只渲染和计数一次（增量缓存），布局和最终文本按
+(消息数, 预算, 总结位置) 缓存，因此长会话中每一轮的开销基本保持不变。
+render 返回文本，render_messages 返回多轮 chat 消息（对话链使用）。
+
+配置（环境变量）：
+    CONTEXT_TOKEN_BUDGET     默认的历史 token 预算（默认 4000）
+    CONTEXT_TOKEN_BUDGETS    按模型覆盖的预算，JSON，例如 {"openai/gpt-4o-mini": 8000}
+    CONTEXT_CONDENSED_CHARS  被压缩的旧消息保留的最大字符数（默认 200）
+"""
+import os
+import json
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken 是可选依赖
+    _ENCODING = None
+
+# 压缩后的旧消息最多占用的预算比例
+CONDENSED_BUDGET_RATIO = 0.25
+
+SUMMARY_HEADER = "[Summary of earlier conversation]"
+CONDENSED_HEADER = "[Earlier messages, condensed]"
+RECENT_HEADER = "[Recent messages]"
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken when installed, otherwise estimate them."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    # 估算：ASCII 约 4 个字符一个 token，其他字符（如中文）约一个字符一个 token
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def get_context_budget(model: str) -> int:
+    """Return the history token budget for a model."""
+    overrides = os.getenv("CONTEXT_TOKEN_BUDGETS")
+    if overrides:
+        try:
+            budgets = json.loads(overrides)
+            if model in budgets:
+                return int(budgets[model])
+        except (ValueError, TypeError) as e:
+            print(f"Invalid CONTEXT_TOKEN_BUDGETS: {e}")
+    return int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+
+
+class ContextWindow:
+    """Incrementally rendered, token-budgeted view of one session's conversation history."""
+
+    def __init__(self):
+        self._lines: List[str] = []
+        self._tokens: List[int] = []
+        self._cache_key: Optional[Tuple] = None
+        self._cache_layout: Tuple[List[str], int] = ([], 0)
+        self._cache_text: Optional[str] = None
+
+    def _sync(self, history: List[Dict[str, str]], end: int) -> None:
+        # 只渲染新增的消息；历史被截短或替换（例如重新加载会话）时重建缓存
+        if len(self._lines) > end:
+            self._lines = self._lines[:end]
+            self._tokens = self._tokens[:end]
+        for msg in history[len(self._lines):end]:
+            line = f"{msg['role']}: {msg['content']}"
+            self._lines.append(line)
+            self._tokens.append(count_tokens(line))
+
+    def _verbatim_window(self, end: int, budget: int) -> Tuple[int, int]:
+        used = 0
+        start = end
+        while start > 0 and used + self._tokens[start - 1] <= budget:
+            start -= 1
+            used += self._tokens[start]
+        return start, used
+
+    def _layout(self, history: List[Dict[str, str]], budget: int, end: int,
+                summary_state: Optional[Dict]) -> Tuple[List[str], int]:
+        """Return the sections standing in for older messages and the index of the first verbatim message."""
+        summary_text = (summary_state or {}).get("text", "")
+        summary_covered = (summary_state or {}).get("covered", 0) if summary_text else 0
+        cache_key = (end, budget, summary_covered)
+        if cache_key == self._cache_key and len(self._lines) >= end:
+            return self._cache_layout
+
+        self._sync(history, end)
+
+        # 1. 从最新的消息往前，尽量多地原样保留；放不下全部历史时给更早的上下文预留一部分预算
+        start, used = self._verbatim_window(end, budget)
+        if start > 0:
+            start, used = self._verbatim_window(end, budget - int(budget * CONDENSED_BUDGET_RATIO))
+
+        sections = []
+        if start > 0:
+            remaining = budget - used - count_tokens(RECENT_HEADER)
+            # 2. 总结覆盖到的旧消息用总结代替
+            condensed_from = 0
+            if summary_text and summary_covered > 0:
+                summary_section = f"{SUMMARY_HEADER}\n{summary_text}"
+                summary_tokens = count_tokens(summary_section)
+                if summary_tokens <= remaining:
+                    sections.append(summary_section)
+                    remaining -= summary_tokens
+                    condensed_from = min(summary_covered, start)
+
+            # 3. 总结之后、原样窗口之前的消息截断压缩，最新的优先保留
+            max_chars = int(os.getenv("CONTEXT_CONDENSED_CHARS", "200"))
+            condensed_budget = remaining - count_tokens(CONDENSED_HEADER)
+            condensed: List[str] = []
+            for i in range(start - 1, condensed_from - 1, -1):
+                line = self._lines[i]
+                if len(line) > max_chars:
+                    line = line[:max_chars] + "…"
+                tokens = count_tokens(line)
+                if tokens > condensed_budget:
+                    break
+                condensed_budget -= tokens
+                condensed.append(line)
+            if condensed:
+                condensed.reverse()
+                sections.append(CONDENSED_HEADER + "\n" + "\n".join(condensed))
+
+        self._cache_key = cache_key
+        self._cache_layout = (sections, start)
+        self._cache_text = None
+        return self._cache_layout
+
+    def render(self, history: List[Dict[str, str]], budget: int, end: Optional[int] = None,
+               summary_state: Optional[Dict] = None) -> str:
+        """
+        Render history[:end] within the token budget.
+
+        Args:
+            history: The session's conversation_history
+            budget: Maximum number of tokens for the rendered history
+            end: Only messages before this index are rendered (defaults to all)
+            summary_state: The session's rolling progress summary state, used for older turns
+
+        Returns:
+            The conversation history formatted as text
+        """
+        end = len(history) if end is None else end
+        sections, start = self._layout(history, budget, end, summary_state)
+        if self._cache_text is None:
+            parts = sections + [RECENT_HEADER] if start > 0 else list(sections)
+            parts.append("\n".join(self._lines[start:end]))
+            self._cache_text = "\n".join(part for part in parts if part)
+        return self._cache_text
+
+    def render_messages(self, history: List[Dict[str, str]], budget: int, end: Optional[int] = None,
+                        summary_state: Optional[Dict] = None) -> List[Dict[str, str]]:
+        """
+        Like render, but return chat messages: recent turns stay separate user/assistant
+        messages, older ones are folded into a leading user message.
+
+        While the whole history fits the budget every call extends the previous call's
+        messages (a stable, cacheable prefix); once older turns are folded the prefix
+        changes whenever the window slides.
+        """
+        end = len(history) if end is None else end
+        sections, start = self._layout(history, budget, end, summary_state)
+        messages = [{"role": "user", "content": "\n".join(sections)}] if sections else []
+        messages.extend({"role": msg["role"], "content": msg["content"]} for msg in history[start:end])
+        return messages
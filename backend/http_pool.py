@@ -0,0 +1,134 @@
+# backend/http_pool.py
+"""
+进程级共享的 OpenRouter HTTP 连接池。
+
+所有 Session 复用同一个 httpx 客户端（可用时启用 HTTP/2），避免每次链调用
+都重新建立 TCP/TLS 连接。上游地址、连接池大小和超时都可以通过环境变量配置：
+
+    OPENROUTER_BASE_URL           API 根地址（默认 https://openrouter.ai/api/v1），
+                                  压测时指向 loadtest/mock_openrouter.py
+    OPENROUTER_POOL_SIZE          最大连接数（默认 100）
+    OPENROUTER_POOL_KEEPALIVE     最大保活连接数（默认 20）
+    OPENROUTER_KEEPALIVE_EXPIRY   保活连接空闲过期秒数（默认 60）
+    OPENROUTER_CONNECT_TIMEOUT    建立连接超时秒数（默认 5）
+    OPENROUTER_READ_TIMEOUT       读取超时秒数（默认 30）
+    OPENROUTER_HTTP2              是否启用 HTTP/2（默认 1，需要安装 h2）
+    OPENROUTER_WARMUP_CONNECTIONS 启动时预热的连接数（默认 2；HTTP/2 下所有请求共用一个连接，只预热 1 个）
+"""
+import os
+import asyncio
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1").rstrip("/")
+OPENROUTER_ORIGIN = "{0.scheme}://{0.netloc}".format(urlsplit(OPENROUTER_BASE_URL))
+
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_client: Optional[httpx.Client] = None
+
+
+def _http2_enabled() -> bool:
+    if os.getenv("OPENROUTER_HTTP2", "1") != "1":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_timeout() -> httpx.Timeout:
+    """Return the default timeout with separate connect and read limits."""
+    read_timeout = float(os.getenv("OPENROUTER_READ_TIMEOUT", "30"))
+    return httpx.Timeout(
+        read_timeout,
+        connect=float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5")),
+        read=read_timeout,
+    )
+
+
+def _get_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv("OPENROUTER_POOL_SIZE", "100")),
+        max_keepalive_connections=int(os.getenv("OPENROUTER_POOL_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", "60")),
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Return the process-wide async client, creating it on first use.
+
+    An AsyncClient is bound to the event loop it was first used in, so a new one
+    is created if the running loop changes (e.g. a CLI calling asyncio.run twice).
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            http2=_http2_enabled(),
+            limits=_get_limits(),
+            timeout=get_timeout(),
+        )
+        _async_client_loop = loop
+    return _async_client
+
+
+def get_sync_client() -> httpx.Client:
+    """Return the process-wide blocking client used by the synchronous code path."""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(
+            http2=_http2_enabled(),
+            limits=_get_limits(),
+            timeout=get_timeout(),
+        )
+    return _sync_client
+
+
+async def warm_up() -> None:
+    """
+    Open connections to OpenRouter ahead of the first user request so the
+    TCP/TLS handshake is not paid on the critical path of a tutoring turn.
+
+    Over HTTP/2 every request shares one connection, so a single request is
+    enough; over HTTP/1.1 concurrent requests each open their own connection.
+    """
+    client = get_async_client()
+    count = int(os.getenv("OPENROUTER_WARMUP_CONNECTIONS", "2"))
+    if count <= 0:
+        return
+
+    async def _touch() -> Optional[str]:
+        try:
+            response = await client.head(OPENROUTER_ORIGIN)
+        except httpx.HTTPError as e:
+            print(f"OpenRouter connection warm-up failed: {e}")
+            return None
+        return response.http_version
+
+    # 先发一个请求确定协商到的协议（启用 http2 时服务器也可能只支持 HTTP/1.1）
+    http_version = await _touch()
+    if http_version is None:
+        return
+    connections = 1
+    if http_version != "HTTP/2" and count > 1:
+        # 并发请求中有一个会复用刚才的连接，其余各自新建连接
+        results = await asyncio.gather(*[_touch() for _ in range(count)])
+        connections = max(1, sum(1 for result in results if result is not None))
+    print(f"OpenRouter connection pool warmed up ({connections} {http_version} connection"
+          f"{'s' if connections != 1 else ''})")
+
+
+async def aclose() -> None:
+    """Close the shared clients, releasing pooled connections."""
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
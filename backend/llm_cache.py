@@ -0,0 +1,622 @@
+# backend/llm_cache.py
+"""
+进程级的 LLM 结果缓存。
+
+AsyncTTLCache 是带 TTL 的 LRU 缓存，并对相同 key 的并发请求做 single-flight
+合并：同一时间只有一个上游调用在执行，其他请求等待它的结果。所有缓存都注册
+在 CACHES 中，便于统计命中率并据此调整容量。
+
+合并由 SingleFlight 实现：上游调用运行在缓存自己的任务中，而不是第一个请求的任务中，
+因此第一个请求被取消（例如客户端断开）不会影响其他等待者，结果仍会写入缓存。
+流式输出先写入缓冲区，每个等待者按自己的速度回放，读得慢的客户端不会拖慢其他人。
+
+PersistentTTLCache 在此基础上把条目写入 SQLite，进程重启后可以直接命中（warm start）；
+异步接口的数据库读写都在专用线程中执行，不阻塞事件循环。
+SimilarityCache 用于代码反馈：按规范化后的代码精确匹配，可选地接受相似度超过阈值的近似重复。
+RefillingPool 保存按批预生成、每个只使用一次的结果（例如微型挑战），低于水位时在后台补充。
+"""
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import difflib
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from resilience import DeadlineExceeded, no_deadline, remaining
+from scheduler import lane, PRIORITY_BACKGROUND
+
+# 缓存名称 -> 缓存实例（都提供 stats()），用于统计输出
+CACHES: Dict[str, Any] = {}
+
+_MISSING = object()
+
+
+def text_digest(text: str) -> str:
+    """Short stable digest used to keep long texts (e.g. problem statements) out of cache keys."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def normalize_problem(text: str) -> str:
+    """Canonical form of a problem statement: NFKC, lower case, collapsed whitespace."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def problem_fingerprint(text: str) -> str:
+    """Fingerprint that is identical for problem texts differing only in case or whitespace."""
+    return text_digest(normalize_problem(text))
+
+
+class _Flight:
+    """One in-flight computation and the chunks it has streamed so far."""
+
+    __slots__ = ("task", "chunks", "_updated")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.chunks: List[str] = []
+        self._updated = asyncio.Event()
+
+    async def emit(self, chunk: str) -> None:
+        # 只写入缓冲区，从不等待任何客户端
+        self.chunks.append(chunk)
+        self.notify()
+
+    def notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def follow(self, on_chunk: Callable[[str], Awaitable[None]]) -> Any:
+        """Replay every chunk to on_chunk at the caller's pace, then return the result."""
+        sent = 0
+        while True:
+            updated = self._updated
+            while sent < len(self.chunks):
+                await on_chunk(self.chunks[sent])
+                sent += 1
+            if self.task.done():
+                return self.task.result()
+            await updated.wait()
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key, in a task owned by the cache rather than by
+    the first caller. Cancelling a caller only stops it waiting; the computation keeps
+    running for the remaining callers and its result is still stored.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    async def run(self, key: Hashable, compute: Callable[[Optional[Callable[[str], Awaitable[None]]]], Awaitable[Any]],
+                  store: Callable[[Any], None],
+                  on_chunk: Optional[Callable[[str], Awaitable[None]]] = None) -> Any:
+        """
+        Join the computation for key, starting it if none is running.
+
+        Args:
+            key: Key identifying the computation
+            compute: Coroutine function called with an emit callback (None when the caller
+                that starts it does not stream) and returning the value
+            store: Called with the value when the computation succeeds, even if no caller is left
+            on_chunk: Receives every streamed chunk, including those emitted before this caller joined
+
+        Returns:
+            The computed value; failures are raised to every caller and not stored
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, compute, store, on_chunk is not None))
+            # 没有等待者时也要取走异常，避免 "exception was never retrieved" 警告
+            flight.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        if on_chunk is None:
+            return await asyncio.shield(flight.task)
+        return await flight.follow(on_chunk)
+
+    async def _run(self, key: Hashable, flight: _Flight, compute: Callable, store: Callable[[Any], None],
+                   stream: bool) -> Any:
+        try:
+            value = await compute(flight.emit if stream else None)
+            store(value)
+            return value
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+
+
+class AsyncTTLCache:
+    """LRU cache with per-entry TTL and single-flight coalescing of concurrent misses."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        CACHES[name] = self
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value or None, counting a hit or a miss."""
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._remember(key, value, time.monotonic() + self.ttl)
+
+    def _remember(self, key: Hashable, value: Any, expires_at: float) -> None:
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[..., Awaitable[Any]],
+                             on_chunk: Optional[Callable[[str], Awaitable[None]]] = None) -> Any:
+        """
+        Return the cached value, or run compute once for all concurrent callers.
+
+        compute is called with an emit callback for streamed chunks (see SingleFlight.run);
+        on_chunk receives them for this caller. Cache hits return without calling on_chunk.
+        Failures are propagated to every waiting caller and are not cached.
+        """
+        value = await self._alookup(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        if key in self._inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        return await self._inflight.run(key, compute, lambda value: self._store(key, value), on_chunk)
+
+    async def _alookup(self, key: Hashable) -> Any:
+        return self._lookup(key)
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class PersistentTTLCache(AsyncTTLCache):
+    """
+    AsyncTTLCache backed by a SQLite file (WAL mode), shared by every worker and
+    surviving restarts. Memory is the first level; a miss falls through to disk.
+    Keys and values must be JSON-serializable.
+
+    get_or_compute() and astats() run every database call on a single dedicated thread:
+    a disk read is awaited, a write-through is queued and the result is returned without
+    waiting for it. The synchronous get/set/stats are for scripts and the sync chains;
+    get and set access the database on the calling thread, stats only reports the row
+    count from the last astats() (or from startup).
+
+    Expired rows are deleted when they are read and by a periodic purge (at most
+    once per purge_interval seconds, run after a write).
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, path: str, purge_interval: float = 3600.0):
+        super().__init__(name, maxsize, ttl)
+        self.path = path
+        self.purge_interval = purge_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)")
+        # 单线程执行器：连接只在这个线程中使用，写入按提交顺序执行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"cache-{name}")
+        self.purged = 0
+        self.persisted = 0
+        self.write_failures = 0
+        self.purge_expired()
+        self._count()
+
+    @staticmethod
+    def _db_key(key: Hashable) -> str:
+        return json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+
+    async def _run(self, func, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # --- 数据库操作（异步接口在专用线程中调用） ---
+
+    def purge_expired(self) -> int:
+        """Delete every expired row; returns the number of rows deleted."""
+        self._next_purge = time.time() + self.purge_interval
+        deleted = self._conn.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        self.purged += deleted
+        return deleted
+
+    def _read(self, db_key: str) -> Optional[Tuple[Any, float]]:
+        """Return (value, created_at) of a live row, deleting the row if it has expired."""
+        row = self._conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (db_key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] + self.ttl <= time.time():
+            # 条件中带上 created_at，避免删掉其他 worker 刚写入的新值
+            self._conn.execute("DELETE FROM cache WHERE key = ? AND created_at = ?", (db_key, row[1]))
+            self.purged += 1
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _write(self, db_key: str, value: Any, created_at: float) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)",
+            (db_key, json.dumps(value, ensure_ascii=False), created_at)
+        )
+        if time.time() >= self._next_purge:
+            self.purge_expired()
+
+    def _count(self) -> int:
+        self.persisted = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return self.persisted
+
+    # --- 读取 ---
+
+    def _restore(self, key: Hashable, row: Optional[Tuple[Any, float]]) -> Any:
+        if row is None:
+            return _MISSING
+        value, created_at = row
+        # 只放入内存层，不重复写盘；保留磁盘上的过期时间，而不是重新计算完整的 TTL
+        self._remember(key, value, time.monotonic() + created_at + self.ttl - time.time())
+        return value
+
+    def _lookup(self, key: Hashable) -> Any:
+        value = super()._lookup(key)
+        if value is not _MISSING:
+            return value
+        return self._restore(key, self._read(self._db_key(key)))
+
+    async def _alookup(self, key: Hashable) -> Any:
+        value = super()._lookup(key)
+        # 正在计算的 key 直接加入 single-flight，不必再读盘
+        if value is not _MISSING or key in self._inflight:
+            return value
+        row = await self._run(self._read, self._db_key(key))
+        # 读盘期间其他请求可能已经把结果放入内存
+        value = super()._lookup(key)
+        return value if value is not _MISSING else self._restore(key, row)
+
+    # --- 写入 ---
+
+    def set(self, key: Hashable, value: Any) -> None:
+        super().set(key, value)
+        self._write(self._db_key(key), value, time.time())
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        # 等待者立即从内存拿到结果；写盘排入专用线程，失败只影响 warm start
+        super().set(key, value)
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._write, self._db_key(key), value, time.time()
+        )
+        future.add_done_callback(self._write_done)
+
+    def _write_done(self, future: "asyncio.Future") -> None:
+        if future.cancelled() or future.exception() is None:
+            return
+        self.write_failures += 1
+        print(f"Failed to persist cache entry ({self.name}): {future.exception()}")
+
+    # --- 统计 ---
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["persisted"] = self.persisted
+        stats["purged"] = self.purged
+        stats["writeFailures"] = self.write_failures
+        return stats
+
+    async def astats(self) -> Dict[str, Any]:
+        """stats() with the persisted row count refreshed from the database."""
+        await self._run(self._count)
+        return self.stats()
+
+    def close(self) -> None:
+        # 等待排队中的写入完成
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+
+class SimilarityCache:
+    """
+    Cache for results keyed on normalized token sequences.
+
+    Entries are grouped into buckets (e.g. problem fingerprint + skill level + model).
+    A lookup tries the exact digest; with threshold < 1.0 it then scans the bucket for
+    an entry whose token sequence is similar enough. Buckets are LRU-bounded so the
+    scan stays cheap; exact keys get single-flight coalescing like AsyncTTLCache.
+
+    The similarity threshold scales with code length: sequences of full_length tokens
+    or more use `threshold`, shorter ones need proportionally closer matches, since a
+    single changed token in a short program usually changes what it does.
+    """
+
+    def __init__(self, name: str, max_buckets: int, bucket_size: int, ttl: float, threshold: float = 1.0,
+                 full_length: int = 400):
+        self.name = name
+        self.max_buckets = max_buckets
+        self.bucket_size = bucket_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.full_length = full_length
+        # bucket -> digest -> (expires_at, tokens, value)
+        self._buckets: "OrderedDict[Hashable, OrderedDict[str, Tuple[float, List[str], Any]]]" = OrderedDict()
+        self._inflight = SingleFlight()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        CACHES[name] = self
+
+    def required_ratio(self, length: int) -> float:
+        """Similarity a near match needs for token sequences of this length."""
+        return 1.0 - (1.0 - self.threshold) * min(1.0, length / self.full_length)
+
+    def _lookup(self, bucket_key: Hashable, digest: str, tokens: List[str]) -> Any:
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            return _MISSING
+        self._buckets.move_to_end(bucket_key)
+        now = time.monotonic()
+
+        entry = bucket.get(digest)
+        if entry is not None and entry[0] >= now:
+            bucket.move_to_end(digest)
+            self.hits += 1
+            return entry[2]
+
+        if self.threshold < 1.0:
+            best_ratio, best_value = 0.0, _MISSING
+            for expires_at, cached_tokens, value in bucket.values():
+                if expires_at < now:
+                    continue
+                required = self.required_ratio(max(len(tokens), len(cached_tokens)))
+                matcher = difflib.SequenceMatcher(None, tokens, cached_tokens, autojunk=False)
+                # quick_ratio 是上界，先用它过滤掉明显不相似的条目
+                if matcher.quick_ratio() < required:
+                    continue
+                ratio = matcher.ratio()
+                if ratio >= required and ratio > best_ratio:
+                    best_ratio, best_value = ratio, value
+            if best_value is not _MISSING:
+                self.near_hits += 1
+                return best_value
+        return _MISSING
+
+    def set(self, bucket_key: Hashable, digest: str, tokens: List[str], value: Any) -> None:
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = OrderedDict()
+        self._buckets.move_to_end(bucket_key)
+        bucket[digest] = (time.monotonic() + self.ttl, tokens, value)
+        bucket.move_to_end(digest)
+        while len(bucket) > self.bucket_size:
+            bucket.popitem(last=False)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+
+    def get(self, bucket_key: Hashable, digest: str, tokens: List[str]) -> Optional[Any]:
+        value = self._lookup(bucket_key, digest, tokens)
+        if value is _MISSING:
+            self.misses += 1
+            return None
+        return value
+
+    async def get_or_compute(self, bucket_key: Hashable, digest: str, tokens: List[str],
+                             compute: Callable[..., Awaitable[Any]],
+                             on_chunk: Optional[Callable[[str], Awaitable[None]]] = None) -> Any:
+        """Like AsyncTTLCache.get_or_compute; concurrent callers are coalesced on the exact digest."""
+        value = self._lookup(bucket_key, digest, tokens)
+        if value is not _MISSING:
+            return value
+
+        inflight_key = (bucket_key, digest)
+        if inflight_key in self._inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        return await self._inflight.run(inflight_key, compute,
+                                        lambda value: self.set(bucket_key, digest, tokens, value), on_chunk)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "size": sum(len(bucket) for bucket in self._buckets.values()),
+            "buckets": len(self._buckets),
+            "hits": self.hits,
+            "nearHits": self.near_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hitRate": round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0
+        }
+
+
+class RefillingPool:
+    """
+    Per-key pool of pre-generated, single-use items (e.g. mini-challenges).
+
+    take() pops an item immediately when one is available. An empty pool is filled by
+    one batch call that concurrent callers share, run in the first caller's lane and
+    under its deadline; each caller stops waiting at its own deadline. Whenever a pool
+    drops below low_watermark after a take, and ahead of time through ensure(), the
+    next batch is generated in the background (in the scheduler's background lane,
+    without the triggering request's deadline). A caller never waits on a background
+    batch: if the pool runs empty while one is in flight, it starts its own.
+    """
+
+    def __init__(self, name: str, max_keys: int, low_watermark: int, ttl: float):
+        self.name = name
+        self.max_keys = max_keys
+        self.low_watermark = low_watermark
+        self.ttl = ttl
+        # key -> deque of (expires_at, item)
+        self._pools: "OrderedDict[Hashable, deque]" = OrderedDict()
+        # (key, background) -> 补充任务；学生在等待的补充与后台补充分开记录
+        self._refills: Dict[Tuple[Hashable, bool], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_failures = 0
+        CACHES[name] = self
+
+    def _size(self, key: Hashable) -> int:
+        pool = self._pools.get(key)
+        if pool is None:
+            return 0
+        now = time.monotonic()
+        while pool and pool[0][0] < now:
+            pool.popleft()
+        return len(pool)
+
+    def _pop(self, key: Hashable) -> Any:
+        if self._size(key) == 0:
+            return _MISSING
+        self._pools.move_to_end(key)
+        return self._pools[key].popleft()[1]
+
+    def _add(self, key: Hashable, items: List[Any]) -> None:
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = deque()
+        self._pools.move_to_end(key)
+        expires_at = time.monotonic() + self.ttl
+        pool.extend((expires_at, item) for item in items)
+        while len(self._pools) > self.max_keys:
+            self._pools.popitem(last=False)
+
+    def _refill(self, key: Hashable, generate: Callable[[], Awaitable[List[Any]]],
+                background: bool = False) -> asyncio.Task:
+        task = self._refills.get((key, background))
+        if task is None:
+            task = asyncio.create_task(self._run_refill(key, generate, background))
+            # 后台补充没有等待者时也要取走异常
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._refills[(key, background)] = task
+        return task
+
+    async def _run_refill(self, key: Hashable, generate: Callable[[], Awaitable[List[Any]]], background: bool) -> None:
+        try:
+            if background:
+                # 任务复制了触发它的请求的上下文：去掉该请求的截止时间，并降到 background 通道，
+                # 不与学生正在等待的请求竞争
+                with lane(PRIORITY_BACKGROUND), no_deadline():
+                    items = await generate()
+            else:
+                items = await generate()
+            self.refills += 1
+            self._add(key, items)
+        except Exception as e:
+            self.refill_failures += 1
+            print(f"Failed to refill pool {self.name}: {e}")
+            raise
+        finally:
+            self._refills.pop((key, background), None)
+
+    @staticmethod
+    async def _wait(task: asyncio.Task) -> None:
+        """Wait for a shared refill, giving up at the caller's own deadline."""
+        left = remaining()
+        if left is None:
+            await asyncio.shield(task)
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), max(left, 0))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Request deadline exceeded") from None
+
+    async def take(self, key: Hashable, generate: Callable[[], Awaitable[List[Any]]]) -> Any:
+        """
+        Pop one item for key, generating a batch first if the pool is empty.
+
+        Args:
+            key: Pool key
+            generate: Coroutine function returning a non-empty list of new items
+
+        Returns:
+            One item; items are never handed out twice
+        """
+        item = self._pop(key)
+        if item is _MISSING:
+            self.misses += 1
+            # 并发的调用者可能在补充完成后先取走了所有条目，此时再补充一批
+            for _ in range(3):
+                await self._wait(self._refill(key, generate))
+                item = self._pop(key)
+                if item is not _MISSING:
+                    break
+            else:
+                raise ValueError(f"Pool {self.name} could not be refilled")
+        else:
+            self.hits += 1
+
+        # 正在为等待者生成的一批会补充池子，不再另起后台补充
+        if self._size(key) < self.low_watermark and (key, False) not in self._refills:
+            self._refill(key, generate, background=True)
+        return item
+
+    async def ensure(self, key: Hashable, generate: Callable[[], Awaitable[List[Any]]]) -> None:
+        """Fill the pool for key up to the watermark ahead of the first take(), in the background lane."""
+        if self._size(key) < self.low_watermark:
+            await self._wait(self._refills.get((key, False)) or self._refill(key, generate, background=True))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": sum(len(pool) for pool in self._pools.values()),
+            "keys": len(self._pools),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refills": self.refills,
+            "refillFailures": self.refill_failures,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+async def acache_stats() -> Dict[str, Dict[str, Any]]:
+    """cache_stats() with persisted row counts refreshed off the event loop."""
+    return {name: await cache.astats() if isinstance(cache, PersistentTTLCache) else cache.stats()
+            for name, cache in CACHES.items()}
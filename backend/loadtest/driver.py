@@ -0,0 +1,169 @@
+# backend/loadtest/driver.py
+"""
+压测驱动：并发打开 N 个会话，每个会话通过 WebSocket 进行若干轮对话，
+最后报告各阶段延迟的 p50/p95/p99 和吞吐量。
+
+用法（在 backend 目录下运行，后端已启动并指向 mock_openrouter.py）：
+
+    python loadtest/driver.py --url http://127.0.0.1:8000 --sessions 50 --turns 5 --ramp-up 10
+
+统计的指标：
+    start_session   POST /api/start_session 的总耗时（包含初始引导生成）
+    first_chunk     WebSocket 每轮从发送消息到收到第一个分块的时间
+    turn            WebSocket 每轮从发送消息到收到结束标记的时间
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+MESSAGES = [
+    "I think the input is a list of integers and I need to return the largest sum.",
+    "Should I sort the list first?",
+    "What happens if all the numbers are negative?",
+    "I wrote a loop that keeps a running total, is that the right idea?",
+    "How would I test this with an empty list?",
+]
+
+
+class LoadReport:
+    """Latency samples and error counts collected during one run."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    def record(self, metric: str, seconds: float) -> None:
+        self.samples.setdefault(metric, []).append(seconds)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    @staticmethod
+    def percentile(values: List[float], q: float) -> float:
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self) -> Dict[str, object]:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        metrics = {}
+        for metric, values in self.samples.items():
+            if not values:
+                continue
+            metrics[metric] = {
+                "count": len(values),
+                "p50": round(self.percentile(values, 0.50), 3),
+                "p95": round(self.percentile(values, 0.95), 3),
+                "p99": round(self.percentile(values, 0.99), 3),
+                "max": round(max(values), 3),
+            }
+        return {
+            "elapsedSeconds": round(elapsed, 2),
+            "sessionsPerSecond": round(len(self.samples.get("start_session", [])) / elapsed, 3),
+            "turnsPerSecond": round(len(self.samples.get("turn", [])) / elapsed, 3),
+            "latency": metrics,
+            "errors": self.errors,
+        }
+
+
+def print_report(summary: Dict[str, object], as_json: bool = False) -> None:
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"Elapsed: {summary['elapsedSeconds']}s, "
+          f"{summary['sessionsPerSecond']} sessions/s, {summary['turnsPerSecond']} turns/s")
+    width = max([15] + [len(metric) + 2 for metric in summary["latency"]])
+    print(f"{'metric':<{width}}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for metric, stats in summary["latency"].items():
+        print(f"{metric:<{width}}{stats['count']:>7}{stats['p50']:>9}{stats['p95']:>9}"
+              f"{stats['p99']:>9}{stats['max']:>9}")
+    if summary["errors"]:
+        print(f"Errors: {summary['errors']}")
+
+
+async def run_session(client: httpx.AsyncClient, ws_url: str, args: argparse.Namespace, report: LoadReport) -> None:
+    started = time.perf_counter()
+    try:
+        response = await client.post("/api/start_session", json={
+            "problem": args.problem,
+            "language": args.language,
+            "skillLevel": args.skill_level,
+            "model": args.model,
+        })
+    except httpx.HTTPError as e:
+        report.error(f"start_session:{type(e).__name__}")
+        return
+    if response.status_code != 200:
+        report.error(f"start_session:{response.status_code}")
+        return
+    report.record("start_session", time.perf_counter() - started)
+    session_id = response.json()["sessionId"]
+
+    try:
+        async with websockets.connect(f"{ws_url}/ws/chat/{session_id}", open_timeout=args.timeout) as ws:
+            for turn in range(args.turns):
+                await asyncio.sleep(random.uniform(0, args.think_time))
+                turn_started = time.perf_counter()
+                first_chunk = None
+                await ws.send(MESSAGES[turn % len(MESSAGES)])
+                while True:
+                    message = json.loads(await asyncio.wait_for(ws.recv(), timeout=args.timeout))
+                    if message["type"] == "chunk" and first_chunk is None:
+                        first_chunk = time.perf_counter() - turn_started
+                    elif message["type"] == "end":
+                        break
+                    elif message["type"] == "error":
+                        report.error("turn:error")
+                        return
+                if first_chunk is not None:
+                    report.record("first_chunk", first_chunk)
+                report.record("turn", time.perf_counter() - turn_started)
+    except asyncio.TimeoutError:
+        report.error("turn:timeout")
+    except (OSError, websockets.WebSocketException) as e:
+        report.error(f"websocket:{type(e).__name__}")
+
+
+async def run(args: argparse.Namespace) -> LoadReport:
+    report = LoadReport()
+    ws_url = "ws" + args.url[len("http"):] if args.url.startswith("http") else args.url
+    limits = httpx.Limits(max_connections=args.sessions, max_keepalive_connections=args.sessions)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        async def staggered(index: int) -> None:
+            # 在 ramp-up 时间内均匀启动会话，避免所有会话在同一瞬间打到后端
+            await asyncio.sleep(args.ramp_up * index / max(1, args.sessions))
+            await run_session(client, ws_url, args, report)
+
+        await asyncio.gather(*[staggered(i) for i in range(args.sessions)])
+    report.finished = time.perf_counter()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Drive concurrent tutoring sessions against the backend.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Backend base URL")
+    parser.add_argument("--sessions", type=int, default=20, help="Concurrent sessions")
+    parser.add_argument("--turns", type=int, default=3, help="WebSocket chat turns per session")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="Seconds over which sessions are started")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Max random pause before each turn")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument("--model", default="anthropic/claude-3.7-sonnet")
+    parser.add_argument("--language", default="Python")
+    parser.add_argument("--skill-level", default="Beginner")
+    parser.add_argument("--problem", default="Given an array of integers, find the contiguous subarray "
+                                             "with the largest sum and return that sum.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    print_report(asyncio.run(run(args)).summary(), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# backend/loadtest/mock_openrouter.py
+"""
+本地模拟的 OpenRouter chat/completions 接口，用于压测，不消耗真实额度。
+
+支持流式（SSE）和非流式响应，可以配置首 token 延迟、输出速度和错误注入。
+用法（在 backend 目录下运行）：
+
+    python loadtest/mock_openrouter.py --port 8100 --ttft 0.8 --tokens-per-second 40 --error-rate 0.02
+
+然后让后端指向它：
+
+    OPENROUTER_BASE_URL=http://127.0.0.1:8100/api/v1 OPENROUTER_API_KEY=mock python main.py
+
+运行期间可以通过 GET/POST /mock/config 查看或修改配置（例如压测中途注入故障），
+GET /mock/stats 返回按状态码统计的请求数。
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Any, AsyncIterator, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("let's think about the problem step by step first consider what the input looks like "
+         "and what the output should be then try a small example by hand before writing any code").split()
+
+
+class MockConfig:
+    """Latency and failure behaviour of the mock upstream; every field can be changed at runtime."""
+
+    def __init__(self, ttft: float = 0.5, ttft_jitter: float = 0.2, tokens_per_second: float = 50.0,
+                 response_tokens: int = 120, error_rate: float = 0.0, error_status: int = 503,
+                 retry_after: float = 0.0, stream_abort_rate: float = 0.0):
+        self.ttft = ttft
+        self.ttft_jitter = ttft_jitter
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.stream_abort_rate = stream_abort_rate
+
+    def update(self, values: Dict[str, Any]) -> None:
+        for key, value in values.items():
+            if not hasattr(self, key):
+                raise ValueError(f"Unknown mock setting: {key}")
+            setattr(self, key, type(getattr(self, key))(value))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+CONFIG = MockConfig()
+STATS: Dict[str, int] = {}
+
+app = FastAPI()
+
+
+def _count(outcome: str) -> None:
+    STATS[outcome] = STATS.get(outcome, 0) + 1
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    # content 可以是字符串，也可以是带 cache_control 的内容块列表
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def _first_token_delay() -> float:
+    return max(0.0, random.gauss(CONFIG.ttft, CONFIG.ttft_jitter))
+
+
+def _text_tokens(count: int) -> List[str]:
+    # 每个 “token” 是一个单词加空格，足够让后端的 token 计数和速率统计有意义
+    return [random.choice(WORDS) + " " for _ in range(count)]
+
+
+def _challenge_tokens(prompt: str) -> List[str]:
+    # 挑战请求带 json_schema：返回一批符合 MiniChallengeBatch 的挑战，按字符切成若干块
+    match = re.search(r"Create (\d+) mini-challenges", prompt)
+    count = int(match.group(1)) if match else 1
+    batch = {"challenges": [
+        {
+            "challenge": f"Mock challenge {i + 1}: what is the time complexity of a single loop over n items?\n"
+                         "A) O(1)\nB) O(n)\nC) O(n^2)",
+            "correct_answer": "B",
+            "explanation": "The loop body runs once per item."
+        }
+        for i in range(count)
+    ]}
+    text = json.dumps(batch)
+    return [text[i:i + 8] for i in range(0, len(text), 8)]
+
+
+def _response_tokens(payload: Dict[str, Any]) -> List[str]:
+    prompt = "\n".join(_message_text(message) for message in payload.get("messages", []))
+    if (payload.get("response_format") or {}).get("type") == "json_schema":
+        return _challenge_tokens(prompt)
+    return _text_tokens(max(1, int(random.gauss(CONFIG.response_tokens, CONFIG.response_tokens * 0.2))))
+
+
+def _usage(payload: Dict[str, Any], tokens: List[str]) -> Dict[str, int]:
+    prompt_chars = sum(len(_message_text(message)) for message in payload.get("messages", []))
+    prompt_tokens = prompt_chars // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens)}
+
+
+def _error_response() -> JSONResponse:
+    headers = {"Retry-After": str(CONFIG.retry_after)} if CONFIG.retry_after > 0 else None
+    _count(str(CONFIG.error_status))
+    return JSONResponse({"error": {"code": CONFIG.error_status, "message": "Injected mock failure"}},
+                        status_code=CONFIG.error_status, headers=headers)
+
+
+async def _stream(payload: Dict[str, Any], tokens: List[str]) -> AsyncIterator[str]:
+    completion_id = f"gen-mock-{random.getrandbits(48):x}"
+    model = payload.get("model", "mock")
+    abort_at = random.randrange(len(tokens)) if random.random() < CONFIG.stream_abort_rate else None
+    # OpenRouter 在首个 token 之前会发送注释行保持连接
+    yield ": OPENROUTER PROCESSING\n\n"
+    await asyncio.sleep(_first_token_delay())
+    interval = 1.0 / CONFIG.tokens_per_second if CONFIG.tokens_per_second > 0 else 0.0
+    for i, token in enumerate(tokens):
+        if i == abort_at:
+            _count("stream_aborted")
+            raise ConnectionResetError("Injected mock stream abort")
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                 "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        if interval:
+            await asyncio.sleep(interval)
+    final = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+             "usage": _usage(payload, tokens)}
+    yield f"data: {json.dumps(final)}\n\n"
+    yield "data: [DONE]\n\n"
+    _count("200")
+
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    if random.random() < CONFIG.error_rate:
+        # 错误响应也有一点延迟，模拟上游排队后才失败
+        await asyncio.sleep(_first_token_delay() / 2)
+        return _error_response()
+
+    tokens = _response_tokens(payload)
+    if payload.get("stream"):
+        return StreamingResponse(_stream(payload, tokens), media_type="text/event-stream")
+
+    generation = len(tokens) / CONFIG.tokens_per_second if CONFIG.tokens_per_second > 0 else 0.0
+    await asyncio.sleep(_first_token_delay() + generation)
+    _count("200")
+    return {
+        "id": f"gen-mock-{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                     "finish_reason": "stop"}],
+        "usage": _usage(payload, tokens)
+    }
+
+
+@app.head("/")
+async def warm_up_target():
+    # http_pool.warm_up 会对上游根地址发 HEAD 请求
+    return JSONResponse({})
+
+
+@app.get("/mock/config")
+async def get_config():
+    return CONFIG.to_dict()
+
+
+@app.post("/mock/config")
+async def set_config(request: Request):
+    try:
+        CONFIG.update(await request.json())
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return CONFIG.to_dict()
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    return STATS
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenRouter chat/completions server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Mean seconds before the first token")
+    parser.add_argument("--ttft-jitter", type=float, default=0.2, help="Standard deviation of the TTFT")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Output speed (0 = unlimited)")
+    parser.add_argument("--response-tokens", type=int, default=120, help="Mean response length in tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="Status code of injected errors")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="Retry-After seconds on injected errors")
+    parser.add_argument("--stream-abort-rate", type=float, default=0.0,
+                        help="Fraction of streams cut off after a random number of tokens")
+    args = parser.parse_args()
+
+    CONFIG.update({
+        "ttft": args.ttft,
+        "ttft_jitter": args.ttft_jitter,
+        "tokens_per_second": args.tokens_per_second,
+        "response_tokens": args.response_tokens,
+        "error_rate": args.error_rate,
+        "error_status": args.error_status,
+        "retry_after": args.retry_after,
+        "stream_abort_rate": args.stream_abort_rate,
+    })
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
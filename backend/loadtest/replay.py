@@ -0,0 +1,173 @@
+# backend/loadtest/replay.py
+"""
+回放 recorder.py 录制的会话，用真实的请求组合测量后端的延迟和吞吐量。
+
+用法（在 backend 目录下运行）：
+
+    python loadtest/replay.py recordings/ --url http://127.0.0.1:8000 --speed 10
+
+每个录制文件是一个会话：先用录制的参数调用 /api/start_session 得到新的 session_id，
+再按录制顺序发送提示、代码反馈、挑战、阶段转换、WebSocket 对话消息等请求。
+会话之间并发，会话内部按顺序执行（与学生的实际操作一致）。
+
+节奏：
+    --speed 1   按录制时的原始时间间隔回放
+    --speed 10  所有间隔缩短为 1/10
+    --speed 0   不等待，每个会话尽快执行完
+
+后端可以指向 mock_openrouter.py（OPENROUTER_BASE_URL）测量后端自身的开销，也可以在
+已预热缓存的情况下回放（pii 模式下题目和代码原样保留，缓存命中情况与录制时一致）。
+同一份录制在改动前后各回放一次，比较两次的报告即可发现延迟回归。
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+
+import httpx
+import websockets
+
+from driver import LoadReport, print_report
+
+
+def load_recordings(paths: List[str]) -> List[List[Dict[str, Any]]]:
+    """Load session recordings (files or directories of .jsonl files), keeping replayable ones."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".jsonl"))
+        else:
+            files.append(path)
+
+    sessions = []
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            events = sorted((json.loads(line) for line in f if line.strip()), key=lambda event: event["ts"])
+        # 录制开始之前就已存在的会话没有开始事件，无法回放
+        start = next((i for i, event in enumerate(events) if event.get("endpoint") == "start_session"), None)
+        if start is None:
+            print(f"Skipping {file}: no start_session event")
+            continue
+        sessions.append(events[start:])
+    return sessions
+
+
+class SessionReplay:
+    """Replays one recorded session against the backend."""
+
+    def __init__(self, events: List[Dict[str, Any]], client: httpx.AsyncClient, ws_url: str,
+                 report: LoadReport, timeout: float):
+        self.events = events
+        self.client = client
+        self.ws_url = ws_url
+        self.report = report
+        self.timeout = timeout
+        self.session_id: Optional[str] = None
+        self.ws = None
+
+    async def run(self, schedule_at) -> None:
+        try:
+            for event in self.events:
+                await schedule_at(event["ts"])
+                if event["kind"] == "ws":
+                    await self._chat(event)
+                elif not await self._http(event):
+                    return
+        except (httpx.HTTPError, OSError, websockets.WebSocketException) as e:
+            self.report.error(f"connection:{type(e).__name__}")
+        except asyncio.TimeoutError:
+            self.report.error("timeout")
+        finally:
+            if self.ws is not None:
+                await self.ws.close()
+
+    def _path(self, event: Dict[str, Any]) -> str:
+        params = {key: quote(str(value), safe="") for key, value in event.get("params", {}).items()}
+        return event["route"].format(session_id=self.session_id, **params)
+
+    async def _http(self, event: Dict[str, Any]) -> bool:
+        """Send one recorded HTTP request; returns False when the session cannot continue."""
+        endpoint = event["endpoint"]
+        path = self._path(event) if self.session_id else event["route"]
+        started = time.perf_counter()
+        first_chunk = None
+        chunks = []
+        async with self.client.stream(event["method"], path, json=event.get("body")) as response:
+            async for chunk in response.aiter_raw():
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                chunks.append(chunk)
+        if response.status_code != 200:
+            self.report.error(f"{endpoint}:{response.status_code}")
+            return endpoint != "start_session"
+        self.report.record(endpoint, time.perf_counter() - started)
+        if path.endswith("/stream") and first_chunk is not None:
+            self.report.record(f"{endpoint}:first_chunk", first_chunk)
+        if endpoint == "start_session":
+            self.session_id = json.loads(b"".join(chunks))["sessionId"]
+        return True
+
+    async def _chat(self, event: Dict[str, Any]) -> None:
+        if self.ws is None:
+            self.ws = await websockets.connect(f"{self.ws_url}{self._path(event)}", open_timeout=self.timeout)
+        started = time.perf_counter()
+        first_chunk = None
+        await self.ws.send(event["message"])
+        while True:
+            message = json.loads(await asyncio.wait_for(self.ws.recv(), timeout=self.timeout))
+            if message["type"] == "chunk" and first_chunk is None:
+                first_chunk = time.perf_counter() - started
+            elif message["type"] == "end":
+                break
+            elif message["type"] == "error":
+                self.report.error("turn:error")
+                return
+        if first_chunk is not None:
+            self.report.record("first_chunk", first_chunk)
+        self.report.record("turn", time.perf_counter() - started)
+
+
+async def replay(sessions: List[List[Dict[str, Any]]], url: str, speed: float, timeout: float) -> LoadReport:
+    report = LoadReport()
+    ws_url = "ws" + url[len("http"):] if url.startswith("http") else url
+    recorded_start = min(events[0]["ts"] for events in sessions)
+    replay_start = time.monotonic()
+
+    async def schedule_at(ts: float) -> None:
+        # 按绝对时间表等待：前一个请求比录制时慢时不再额外等待，保持整体节奏
+        if speed > 0:
+            delay = (ts - recorded_start) / speed - (time.monotonic() - replay_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    limits = httpx.Limits(max_connections=len(sessions), max_keepalive_connections=len(sessions))
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        await asyncio.gather(*[SessionReplay(events, client, ws_url, report, timeout).run(schedule_at)
+                               for events in sessions])
+    report.finished = time.perf_counter()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded tutoring sessions against the backend.")
+    parser.add_argument("recordings", nargs="+", help="Recording files or directories (SESSION_RECORD_DIR)")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Backend base URL")
+    parser.add_argument("--speed", type=float, default=1.0, help="Pacing factor (1 = original, 0 = no waiting)")
+    parser.add_argument("--limit", type=int, help="Replay at most this many sessions")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    sessions = load_recordings(args.recordings)[:args.limit]
+    if not sessions:
+        print("No replayable sessions found")
+        return
+    print(f"Replaying {len(sessions)} sessions at speed {args.speed}")
+    print_report(asyncio.run(replay(sessions, args.url, args.speed, args.timeout)).summary(), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# backend/loadtest/sse_benchmark.py
+"""
+流式路径的 SSE 解码微基准：比较逐块解码的开销。
+
+模拟大量并发的上游流（与 OpenRouter 相同的格式：注释行、每个 token 一个 data 事件、
+最后是带 usage 的分块和 [DONE]），把每个流切成随机大小的网络读取，在同一个事件循环
+中交错解码，统计每个分块（data 事件）的平均耗时。
+
+对比的实现：
+    lines    原来的做法：字节增量解码为 str、按行切分、逐行 json.loads、字符串 += 累积
+    sse      sse.SSEDecoder：直接在字节上切分和解析（有 orjson 时使用 orjson），列表累积
+    loop     只迭代读取、不做解码，作为事件循环本身的开销基线
+
+用法（在 backend 目录下运行）：
+
+    python loadtest/sse_benchmark.py --streams 500 --tokens 400 --read-size 256
+"""
+import os
+import sys
+import json
+import time
+import codecs
+import random
+import asyncio
+import argparse
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import SSEDecoder, _loads  # noqa: E402
+
+WORDS = ("the loop visits every item once so the running time grows linearly with the input size "
+         "consider what happens when the list is empty 你可以先想一想边界情况").split()
+
+
+def build_stream(tokens: int, rng: random.Random) -> bytes:
+    """One upstream response in OpenRouter's SSE format."""
+    parts = [": OPENROUTER PROCESSING\n\n"]
+    for _ in range(tokens):
+        chunk = {"id": "gen-bench", "object": "chat.completion.chunk", "model": "bench/model",
+                 "choices": [{"index": 0, "delta": {"role": "assistant", "content": rng.choice(WORDS) + " "},
+                              "finish_reason": None}]}
+        parts.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    final = {"id": "gen-bench", "object": "chat.completion.chunk", "model": "bench/model",
+             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+             "usage": {"prompt_tokens": 1200, "completion_tokens": tokens, "total_tokens": 1200 + tokens}}
+    parts.append(f"data: {json.dumps(final)}\n\n")
+    parts.append("data: [DONE]\n\n")
+    return "".join(parts).encode("utf-8")
+
+
+def split_reads(stream: bytes, read_size: int, rng: random.Random) -> List[bytes]:
+    """Cut a stream into reads of random size, splitting events (and UTF-8 sequences) anywhere."""
+    reads = []
+    pos = 0
+    while pos < len(stream):
+        size = max(1, int(rng.expovariate(1.0 / read_size)))
+        reads.append(stream[pos:pos + size])
+        pos += size
+    return reads
+
+
+def _content(event: Dict[str, Any]) -> Optional[str]:
+    choices = event.get("choices") or []
+    return (choices[0].get("delta") or {}).get("content") if choices else None
+
+
+class LinesDecoder:
+    """The previous path: str decoding, line splitting and a json.loads per line (as aiter_lines + json)."""
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._pending = ""
+        self.full_response = ""
+
+    def feed(self, chunk: bytes) -> int:
+        text = self._pending + self._text.decode(chunk)
+        lines = text.split("\n")
+        self._pending = lines.pop()
+        count = 0
+        for line in lines:
+            line = line.rstrip("\r")
+            if not line:
+                continue
+            if line.startswith("data: "):
+                line = line[6:]
+            if not line.strip() or line.strip() == "[DONE]":
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            count += 1
+            content = _content(event)
+            if content:
+                self.full_response += content
+        return count
+
+    def result(self) -> str:
+        return self.full_response
+
+
+class BytesDecoder:
+    """The new path: SSEDecoder on bytes with list accumulation."""
+
+    def __init__(self):
+        self._decoder = SSEDecoder()
+        self._parts: List[str] = []
+
+    def feed(self, chunk: bytes) -> int:
+        events = self._decoder.feed_json(chunk)
+        for event in events:
+            content = _content(event)
+            if content:
+                self._parts.append(content)
+        return len(events)
+
+    def result(self) -> str:
+        self._decoder.flush_json()
+        return "".join(self._parts)
+
+
+class NullDecoder:
+    def feed(self, chunk: bytes) -> int:
+        return 0
+
+    def result(self) -> str:
+        return ""
+
+
+DECODERS: Dict[str, Callable[[], Any]] = {"loop": NullDecoder, "lines": LinesDecoder, "sse": BytesDecoder}
+
+
+async def run(factory: Callable[[], Any], streams: List[List[bytes]]) -> float:
+    """Decode all streams concurrently, yielding to the event loop after every read; returns seconds."""
+    async def consume(reads: List[bytes]) -> str:
+        decoder = factory()
+        for chunk in reads:
+            decoder.feed(chunk)
+            await asyncio.sleep(0)
+        return decoder.result()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[consume(reads) for reads in streams])
+    elapsed = time.perf_counter() - started
+    if factory is not NullDecoder and any(not text for text in results):
+        raise RuntimeError("decoder produced an empty response")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmark of SSE decoding under concurrent streams.")
+    parser.add_argument("--streams", type=int, default=500, help="Concurrent streams")
+    parser.add_argument("--tokens", type=int, default=400, help="Content chunks per stream")
+    parser.add_argument("--read-size", type=int, default=256, help="Mean bytes per network read")
+    parser.add_argument("--rounds", type=int, default=3, help="Repetitions; the best round is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    streams = [split_reads(build_stream(args.tokens, rng), args.read_size, rng) for _ in range(args.streams)]
+    chunks = args.streams * (args.tokens + 1)
+    reads = sum(len(reads) for reads in streams)
+    parser_name = "orjson" if _loads is not json.loads else "json"
+    print(f"{args.streams} streams x {args.tokens} chunks, {reads} reads (mean {args.read_size} B), "
+          f"SSEDecoder JSON parser: {parser_name}")
+
+    best: Dict[str, float] = {}
+    for _ in range(args.rounds):
+        for name, factory in DECODERS.items():
+            elapsed = asyncio.run(run(factory, streams))
+            best[name] = min(best.get(name, elapsed), elapsed)
+
+    print(f"{'decoder':<8} {'total s':>9} {'us/chunk':>9} {'us/chunk - loop':>16}")
+    for name, elapsed in best.items():
+        per_chunk = elapsed / chunks * 1e6
+        net = (elapsed - best["loop"]) / chunks * 1e6
+        print(f"{name:<8} {elapsed:>9.3f} {per_chunk:>9.2f} {net:>16.2f}")
+    if best["sse"] > best["loop"]:
+        speedup = (best["lines"] - best["loop"]) / (best["sse"] - best["loop"])
+        print(f"decoding overhead: sse is {speedup:.2f}x faster than lines")
+
+
+if __name__ == "__main__":
+    main()
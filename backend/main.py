@@ -2,16 +2,33 @@
 import uvicorn
 import uuid  # For generating unique session IDs
 import os
+import time
 import asyncio
 from dotenv import load_dotenv
-from typing import Dict
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
-from basic import InteractiveLearningAssistant # Import core class from basic.py
-
+# 在导入本地模块之前加载 .env：OPENROUTER_BASE_URL、调度和路由等配置在模块导入时读取
 load_dotenv() # Load environment variables from .env file
+
+from session import Session, LEARNING_STAGES, FOCUS_AREAS, DEFAULT_FOCUS_AREA
+from session_store import create_session_store
+import http_pool
+from streaming import run_streaming, sse_events, emit_text
+from prefetch import Prefetcher
+from llm_cache import cache_stats, acache_stats
+from scheduler import SCHEDULER
+from routing import ROUTER
+from tracing import TRACER, TracingMiddleware, span
+from recorder import RECORDER, RecordingMiddleware
+from usage import USAGE
+from metrics import (MetricsMiddleware, Counter, Gauge, render_metrics, WEBSOCKET_CONNECTIONS,
+                     WEBSOCKET_TURN_DURATION)
+from resilience import (UpstreamUnavailable, DeadlineExceeded, with_deadline, deadline, endpoint_deadline,
+                        breaker_stats)
+
 app = FastAPI()
 
 # 1. Configure CORS
@@ -29,6 +46,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 1.1. 每个路由的请求耗时（Prometheus 直方图，从 /metrics 导出）和采样追踪的根 span
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+@app.on_event("startup")
+async def start_tracing():
+    app.state.trace_exporter = TRACER.start()
+
+@app.on_event("shutdown")
+async def stop_tracing():
+    if app.state.trace_exporter is not None:
+        app.state.trace_exporter.cancel()
+    await TRACER.shutdown()
+
+# 1.2. 可选的会话录制（SESSION_RECORD_DIR），供 loadtest/replay.py 回放
+app.add_middleware(RecordingMiddleware)
+
+@app.on_event("startup")
+async def start_session_recorder():
+    app.state.session_recorder = RECORDER.start()
+
+@app.on_event("shutdown")
+async def stop_session_recorder():
+    if app.state.session_recorder is not None:
+        app.state.session_recorder.cancel()
+    await RECORDER.shutdown()
+
+# 1.5. 进程级 HTTP 连接池：启动时预热，关闭时释放
+@app.on_event("startup")
+async def warm_up_http_pool():
+    await http_pool.warm_up()
+
+@app.on_event("shutdown")
+async def close_http_pool():
+    await http_pool.aclose()
+
 # 2. Define data models
 class SessionStartRequest(BaseModel):
     problem: str
@@ -46,20 +99,56 @@ class ChallengeCheckRequest(BaseModel):
     answer: str
 
 # 3. Session state management (upgraded version)
-class Session:
-    """Independent session object for each user"""
-    def __init__(self, api_key: str, model: str = "anthropic/claude-3.7-sonnet"):
-        self.assistant = InteractiveLearningAssistant(
-            api_key=api_key,
-            model=model
-        )
-        self.problem_context: dict = {}
-
-# Use dictionary to store all sessions, key is session_id (string), value is Session object
-SESSIONS: Dict[str, Session] = {}
+# 会话存储可插拔：默认在内存中（有上限，空闲会话写入磁盘），
+# SESSION_BACKEND=sqlite 时所有 worker 共享同一个数据库。修改会话后需调用 await SESSIONS.asave
+SESSIONS = create_session_store()
+
+# 推测式预取下一阶段的过渡消息和当前阶段的挑战（ENABLE_PREFETCH=1 时开启）
+PREFETCHER = Prefetcher()
+
+# 3.1. 导出时才读取的指标：会话数、缓存命中和调度队列
+Gauge("codecoach_active_sessions", "Sessions held by this worker's session store.",
+      callback=lambda: [((), len(SESSIONS))])
+Counter("codecoach_cache_lookups_total", "LLM cache lookups by result.", ["cache", "result"],
+        callback=lambda: [((name, result), stats.get(key, 0))
+                          for name, stats in cache_stats().items()
+                          for key, result in (("hits", "hit"), ("nearHits", "near_hit"), ("misses", "miss"),
+                                              ("coalesced", "coalesced"))
+                          if key in stats])
+Gauge("codecoach_cache_hit_ratio", "LLM cache hit ratio since start.", ["cache"],
+      callback=lambda: [((name,), stats["hitRate"]) for name, stats in cache_stats().items()])
+Gauge("codecoach_cache_entries", "Entries held by each LLM cache.", ["cache"],
+      callback=lambda: [((name,), stats["size"]) for name, stats in cache_stats().items()])
+Gauge("codecoach_llm_active_calls", "LLM calls holding a scheduler slot.", ["model"],
+      callback=lambda: [((model, ), stats["active"]) for model, stats in SCHEDULER.stats().items()])
+Gauge("codecoach_llm_parked_streams", "Streams waiting on a slow client with their scheduler slot lent out.",
+      ["model"], callback=lambda: [((model, ), stats["parked"]) for model, stats in SCHEDULER.stats().items()])
+Gauge("codecoach_llm_queue_depth", "LLM calls waiting for a scheduler slot.", ["model", "lane"],
+      callback=lambda: [((model, lane), depth) for model, stats in SCHEDULER.stats().items()
+                        for lane, depth in stats["queued"].items()])
+
+@app.on_event("startup")
+async def start_session_sweeper():
+    app.state.session_sweeper = asyncio.create_task(SESSIONS.run_sweeper())
+
+@app.on_event("shutdown")
+async def stop_session_sweeper():
+    app.state.session_sweeper.cancel()
+    SESSIONS.close()
+
+def http_error(e: Exception) -> HTTPException:
+    """上游不可用（熔断或重试耗尽）返回 503，超过截止时间返回 504，其余错误返回 500。"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, UpstreamUnavailable):
+        return HTTPException(status_code=503, detail=str(e))
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=str(e))
+    return HTTPException(status_code=500, detail=str(e))
 
 # 4. HTTP endpoint: Start new session
 @app.post("/api/start_session")
+@with_deadline("start_session")
 async def start_session(request: SessionStartRequest):
     try:
         # Read API Key from environment variable
@@ -70,7 +159,7 @@ async def start_session(request: SessionStartRequest):
         session_id = str(uuid.uuid4())
 
         # Create Session using the read key and selected model
-        new_session = Session(api_key=api_key, model=request.model)
+        new_session = Session(api_key=api_key, model=request.model, session_id=session_id)
         
         # Initialize problem context
         new_session.problem_context = {
@@ -82,7 +171,7 @@ async def start_session(request: SessionStartRequest):
         }
         
         # Get initial guidance
-        initial_guidance = new_session.assistant.get_initial_guidance(
+        initial_guidance = await new_session.assistant.aget_initial_guidance(
             problem=request.problem,
             language=request.language,
             skill_level=request.skillLevel
@@ -92,7 +181,8 @@ async def start_session(request: SessionStartRequest):
         new_session.problem_context["conversation_history"].append({"role": "assistant", "content": initial_guidance})
         
         # Store new session in global session dictionary
-        SESSIONS[session_id] = new_session
+        await SESSIONS.asave(new_session)
+        PREFETCHER.schedule(new_session, SESSIONS.asave)
         
         print(f"Session started, ID: {session_id}")
         # 将 session_id 和初始消息一起返回给前端
@@ -100,41 +190,166 @@ async def start_session(request: SessionStartRequest):
     
     except Exception as e:
         print(f"Failed to start session: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
+# 4.4. 流式响应的公共部分：JSON 端点与 SSE 端点共用同一段生成逻辑
+async def get_session_or_404(session_id: str) -> Session:
+    current_session = await SESSIONS.aget(session_id)
+    if not current_session:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    return current_session
+
+def sse_response(produce) -> StreamingResponse:
+    """把一个接收 streaming_callback 的生成函数包装成 SSE 响应。"""
+    return StreamingResponse(
+        sse_events(produce),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@with_deadline("explain")
+async def run_explain_concept(current_session: Session, concept: str, streaming_callback=None) -> dict:
+    # 从当前会话的上下文中获取必要的信息
+    ctx = current_session.problem_context
+
+    # 调用 assistant 的 explain_concept 方法
+    explanation = await current_session.assistant.aexplain_concept(
+        concept=concept,
+        language=ctx["language"],
+        skill_level=ctx["skill_level"],
+        problem=ctx["problem"],
+        streaming_callback=streaming_callback
+    )
+
+    # 将用户的请求和AI的解释都添加到对话历史中，以便上下文连续
+    ctx["conversation_history"].append({"role": "user", "content": f"请你解释一下“{concept}”这个概念。"})
+    ctx["conversation_history"].append({"role": "assistant", "content": explanation})
+    await SESSIONS.asave(current_session)
+
+    return {"success": True, "explanation": explanation}
+
+@with_deadline("hint")
+async def run_request_hint(current_session: Session, hint_request: str, streaming_callback=None) -> dict:
+    ctx = current_session.problem_context
+
+    # 1. 获取当前的进度总结（增量更新，只合并上次总结之后的新消息）
+    progress_summary = await current_session.get_progress_summary()
+
+    # 2. 调用 assistant 的 generate_hint 方法（只有提示本身需要流式输出）
+    hint = await current_session.assistant.agenerate_hint(
+        problem=ctx["problem"],
+        language=ctx["language"],
+        skill_level=ctx["skill_level"],
+        current_stage=ctx["current_stage"],
+        hint_request=hint_request,
+        progress_summary=progress_summary,
+        streaming_callback=streaming_callback
+    )
+
+    # 3. 将用户的请求和AI的提示添加到对话历史
+    ctx["conversation_history"].append({"role": "user", "content": f"I'm stuck and need a hint: {hint_request}"})
+    ctx["conversation_history"].append({"role": "assistant", "content": hint})
+    await SESSIONS.asave(current_session)
+
+    return {"success": True, "hint": hint}
+
+@with_deadline("code_feedback")
+async def run_code_feedback(current_session: Session, code: str, streaming_callback=None) -> dict:
+    ctx = current_session.problem_context
+    # 更新当前阶段状态（如果需要）
+    ctx["current_stage"] = "implementation"
+
+    feedback = await current_session.assistant.aprovide_direct_code_feedback(
+        problem=ctx["problem"],
+        language=ctx["language"],
+        skill_level=ctx["skill_level"],
+        current_stage=ctx["current_stage"],
+        student_code=code,
+        streaming_callback=streaming_callback
+    )
+
+    # 将代码和反馈都存入对话历史
+    user_code_submission_text = f"Here is my code attempt, please give some feedback:\n```{ctx['language'].lower()}\n{code}\n```"
+    ctx["conversation_history"].append({"role": "user", "content": user_code_submission_text})
+    ctx["conversation_history"].append({"role": "assistant", "content": feedback})
+    await SESSIONS.asave(current_session)
+
+    return {"success": True, "feedback": feedback}
+
+def next_learning_stage(ctx: dict):
+    """返回下一个学习阶段；已经在最后一个阶段时返回 None。"""
+    try:
+        current_index = LEARNING_STAGES.index(ctx["current_stage"])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid current stage.")
+
+    if current_index >= len(LEARNING_STAGES) - 1:
+        return None
+    return LEARNING_STAGES[current_index + 1]
+
+@with_deadline("stage_transition")
+async def run_stage_transition(current_session: Session, new_stage: str, streaming_callback=None) -> dict:
+    ctx = current_session.problem_context
+    previous_stage = ctx["current_stage"]
+
+    # 1. 预取的过渡消息仍然有效（阶段和对话历史都没变）时直接使用
+    transition_message = PREFETCHER.take_stage_transition(current_session, new_stage)
+    if transition_message is not None:
+        await emit_text(streaming_callback, transition_message)
+    else:
+        # 2. 获取进度总结（增量更新），调用AI生成阶段过渡消息
+        progress_summary = await current_session.get_progress_summary()
+        transition_message = await current_session.assistant.agenerate_stage_transition(
+            problem=ctx["problem"], language=ctx["language"], skill_level=ctx["skill_level"],
+            previous_stage=previous_stage, new_stage=new_stage, progress_summary=progress_summary,
+            streaming_callback=streaming_callback
+        )
+
+    # 3. 更新后端的会话状态
+    ctx["current_stage"] = new_stage
+
+    # 4. 将过渡消息添加到对话历史
+    ctx["conversation_history"].append({"role": "assistant", "content": transition_message})
+    await SESSIONS.asave(current_session)
+    PREFETCHER.schedule(current_session, SESSIONS.asave)
+
+    # 5. 检查新阶段是否为最后一个阶段
+    new_stage_index = LEARNING_STAGES.index(new_stage)
+    is_last_stage = new_stage_index >= len(LEARNING_STAGES) - 1
+
+    # 直接返回过渡消息，不再进行不必要的 continue_conversation 调用
+    return {
+        "success": True,
+        "transitionMessage": transition_message,
+        "newStage": new_stage,
+        "isLastStage": is_last_stage,
+        "stageIndex": new_stage_index,
+        "totalStages": len(LEARNING_STAGES)
+    }
+
 # 4.5. HTTP 端点：解释一个概念
 @app.get("/api/session/{session_id}/explain/{concept}")
 async def explain_concept(session_id: str, concept: str):
     """
     根据会话ID和概念名称，调用AI生成解释。
     """
-    current_session = SESSIONS.get(session_id)
-    if not current_session:
-        raise HTTPException(status_code=404, detail="Session not found.")
+    current_session = await get_session_or_404(session_id)
 
     try:
-        # 从当前会话的上下文中获取必要的信息
-        ctx = current_session.problem_context
-        
-        # 调用 assistant 的 explain_concept 方法
-        # 注意：这是一个非流式的、一次性的请求
-        explanation = current_session.assistant.explain_concept(
-            concept=concept,
-            language=ctx["language"],
-            skill_level=ctx["skill_level"],
-            problem=ctx["problem"]
-        )
-        
-        # 将用户的请求和AI的解释都添加到对话历史中，以便上下文连续
-        ctx["conversation_history"].append({"role": "user", "content": f"请你解释一下“{concept}”这个概念。"})
-        ctx["conversation_history"].append({"role": "assistant", "content": explanation})
-        
-        return {"success": True, "explanation": explanation}
+        return await run_explain_concept(current_session, concept)
 
     except Exception as e:
         print(f"Failed to explain concept, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+@app.get("/api/session/{session_id}/explain/{concept}/stream")
+async def explain_concept_stream(session_id: str, concept: str):
+    """
+    流式版本：以 SSE 逐块返回解释，最后的 end 事件包含与非流式端点相同的字段。
+    """
+    current_session = await get_session_or_404(session_id)
+    return sse_response(lambda streaming_callback: run_explain_concept(current_session, concept, streaming_callback))
 
 
 # 4.6. HTTP 端点：请求一个提示
@@ -143,41 +358,22 @@ async def request_hint(session_id: str, request: HintRequest):
     """
     根据用户卡住的具体问题，生成一个提示。
     """
-    current_session = SESSIONS.get(session_id)
-    if not current_session:
-        raise HTTPException(status_code=404, detail="Session not found.")
+    current_session = await get_session_or_404(session_id)
 
     try:
-        ctx = current_session.problem_context
-
-        # 1. 生成当前的进度总结，为生成提示提供更丰富的上下文
-        history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in ctx["conversation_history"]])
-        progress_summary = current_session.assistant.summarize_progress(
-            problem=ctx["problem"],
-            language=ctx["language"],
-            skill_level=ctx["skill_level"],
-            conversation_history=history_text
-        )
-
-        # 2. 调用 assistant 的 generate_hint 方法
-        hint = current_session.assistant.generate_hint(
-            problem=ctx["problem"],
-            language=ctx["language"],
-            skill_level=ctx["skill_level"],
-            current_stage=ctx["current_stage"],
-            hint_request=request.hintRequest,
-            progress_summary=progress_summary
-        )
-
-        # 3. 将用户的请求和AI的提示添加到对话历史
-        ctx["conversation_history"].append({"role": "user", "content": f"I'm stuck and need a hint: {request.hintRequest}"})
-        ctx["conversation_history"].append({"role": "assistant", "content": hint})
-
-        return {"success": True, "hint": hint}
+        return await run_request_hint(current_session, request.hintRequest)
 
     except Exception as e:
         print(f"Failed to generate hint, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+@app.post("/api/session/{session_id}/hint/stream")
+async def request_hint_stream(session_id: str, request: HintRequest):
+    """
+    流式版本：以 SSE 逐块返回提示。
+    """
+    current_session = await get_session_or_404(session_id)
+    return sse_response(lambda streaming_callback: run_request_hint(current_session, request.hintRequest, streaming_callback))
 
 # 4.7. HTTP 端点：获取代码反馈
 @app.post("/api/session/{session_id}/feedback")
@@ -185,33 +381,22 @@ async def get_code_feedback(session_id: str, request: CodeFeedbackRequest):
     """
     接收用户提交的代码，并返回AI的反馈。
     """
-    current_session = SESSIONS.get(session_id)
-    if not current_session:
-        raise HTTPException(status_code=404, detail="Session not found.")
+    current_session = await get_session_or_404(session_id)
 
     try:
-        ctx = current_session.problem_context
-        # 更新当前阶段状态（如果需要）
-        ctx["current_stage"] = "implementation"
-
-        feedback = current_session.assistant.provide_direct_code_feedback(
-            problem=ctx["problem"],
-            language=ctx["language"],
-            skill_level=ctx["skill_level"],
-            current_stage=ctx["current_stage"],
-            student_code=request.code
-        )
-
-        # 将代码和反馈都存入对话历史
-        user_code_submission_text = f"Here is my code attempt, please give some feedback:\n```{ctx['language'].lower()}\n{request.code}\n```"
-        ctx["conversation_history"].append({"role": "user", "content": user_code_submission_text})
-        ctx["conversation_history"].append({"role": "assistant", "content": feedback})
-
-        return {"success": True, "feedback": feedback}
+        return await run_code_feedback(current_session, request.code)
 
     except Exception as e:
         print(f"Failed to get code feedback, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+@app.post("/api/session/{session_id}/feedback/stream")
+async def get_code_feedback_stream(session_id: str, request: CodeFeedbackRequest):
+    """
+    流式版本：以 SSE 逐块返回代码反馈。
+    """
+    current_session = await get_session_or_404(session_id)
+    return sse_response(lambda streaming_callback: run_code_feedback(current_session, request.code, streaming_callback))
 
 # 4.8. HTTP 端点：转换到下一个学习阶段
 @app.post("/api/session/{session_id}/stage/next")
@@ -219,89 +404,56 @@ async def transition_to_next_stage(session_id: str):
     """
     处理学习阶段的转换，并由AI生成过渡消息。
     """
-    current_session = SESSIONS.get(session_id)
-    if not current_session:
-        raise HTTPException(status_code=404, detail="Session not found.")
+    current_session = await get_session_or_404(session_id)
 
     try:
         ctx = current_session.problem_context
-        
-        # 定义学习阶段的顺序
-        learning_stages = ["problem_analysis", "solution_design", "implementation", "testing_refinement", "reflection"]
-        
-        try:
-            current_index = learning_stages.index(ctx["current_stage"])
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid current stage.")
 
-        if current_index >= len(learning_stages) - 1:
+        new_stage = next_learning_stage(ctx)
+        if new_stage is None:
             return {"success": False, "message": "Already at the last learning stage.", "newStage": ctx["current_stage"]}
 
-        previous_stage = ctx["current_stage"]
-        new_stage = learning_stages[current_index + 1]
-
-        # 1. 生成进度总结
-        history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in ctx["conversation_history"]])
-        progress_summary = current_session.assistant.summarize_progress(
-            problem=ctx["problem"], language=ctx["language"], skill_level=ctx["skill_level"], conversation_history=history_text
-        )
-
-        # 2. 调用AI生成阶段过渡消息
-        transition_message = current_session.assistant.generate_stage_transition(
-            problem=ctx["problem"], language=ctx["language"], skill_level=ctx["skill_level"],
-            previous_stage=previous_stage, new_stage=new_stage, progress_summary=progress_summary
-        )
-        
-        # 3. 更新后端的会话状态
-        ctx["current_stage"] = new_stage
-        
-        # 4. 将过渡消息添加到对话历史
-        ctx["conversation_history"].append({"role": "assistant", "content": transition_message})
-        
-        # 5. 检查新阶段是否为最后一个阶段
-        new_stage_index = learning_stages.index(new_stage)
-        is_last_stage = new_stage_index >= len(learning_stages) - 1
-        
-        # 直接返回过渡消息，不再进行不必要的 continue_conversation 调用
-        return {
-            "success": True, 
-            "transitionMessage": transition_message, 
-            "newStage": new_stage,
-            "isLastStage": is_last_stage,
-            "stageIndex": new_stage_index,
-            "totalStages": len(learning_stages)
-        }
+        return await run_stage_transition(current_session, new_stage)
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Failed to transition stage, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+@app.post("/api/session/{session_id}/stage/next/stream")
+async def transition_to_next_stage_stream(session_id: str):
+    """
+    流式版本：以 SSE 逐块返回阶段过渡消息。已在最后阶段时直接返回 JSON。
+    """
+    current_session = await get_session_or_404(session_id)
+    ctx = current_session.problem_context
+
+    new_stage = next_learning_stage(ctx)
+    if new_stage is None:
+        return {"success": False, "message": "Already at the last learning stage.", "newStage": ctx["current_stage"]}
+
+    return sse_response(lambda streaming_callback: run_stage_transition(current_session, new_stage, streaming_callback))
 
 # 4.9. HTTP 端点：创建一个微型挑战
 @app.post("/api/session/{session_id}/challenge")
+@with_deadline("challenge")
 async def create_mini_challenge(session_id: str):
     """
     根据当前会话状态，生成一个微型挑战。
     """
-    current_session = SESSIONS.get(session_id)
+    current_session = await SESSIONS.aget(session_id)
     if not current_session:
         raise HTTPException(status_code=404, detail="Session not found.")
 
     try:
         ctx = current_session.problem_context
-        
-        # 定义每个阶段对应的挑战焦点领域
-        focus_areas = {
-            "problem_analysis": "problem understanding and input/output analysis",
-            "solution_design": "algorithm design and data structure selection",
-            "implementation": "coding implementation and syntax",
-            "testing_refinement": "edge cases and error handling",
-            "reflection": "code optimization and best practices"
-        }
-        focus_area = focus_areas.get(ctx["current_stage"], "general programming concepts")
 
-        # 调用 assistant 的 create_mini_challenge 方法
+        focus_area = FOCUS_AREAS.get(ctx["current_stage"], DEFAULT_FOCUS_AREA)
+
+        # 调用 assistant 的 create_mini_challenge 方法（从共享的挑战池中取用，池空时成批生成）
         # 这个方法会返回一个包含 'challenge', 'correct_answer', 'explanation' 的字典
-        challenge_data = current_session.assistant.create_mini_challenge(
+        challenge_data = await current_session.assistant.acreate_mini_challenge(
             problem=ctx["problem"],
             language=ctx["language"],
             skill_level=ctx["skill_level"],
@@ -311,20 +463,22 @@ async def create_mini_challenge(session_id: str):
         
         # 存储挑战数据到session中，以便后续检查答案
         ctx["current_challenge"] = challenge_data
+        await SESSIONS.asave(current_session)
         
         return {"success": True, "challengeData": challenge_data}
 
     except Exception as e:
         print(f"Failed to create mini challenge, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 # 4.8.1. HTTP 端点：完成学习
 @app.post("/api/session/{session_id}/complete")
+@with_deadline("complete")
 async def complete_learning(session_id: str):
     """
     完成当前问题的学习，生成学习总结，并为开始新问题做准备。
     """
-    current_session = SESSIONS.get(session_id)
+    current_session = await SESSIONS.aget(session_id)
     if not current_session:
         raise HTTPException(status_code=404, detail="Session not found.")
 
@@ -339,7 +493,7 @@ async def complete_learning(session_id: str):
         history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in ctx["conversation_history"]])
         
         # 调用AI生成学习总结
-        learning_summary = current_session.assistant.generate_learning_summary(
+        learning_summary = await current_session.assistant.agenerate_learning_summary(
             problem=ctx["problem"],
             language=ctx["language"],
             skill_level=ctx["skill_level"],
@@ -352,6 +506,7 @@ async def complete_learning(session_id: str):
         # 标记学习状态为已完成
         ctx["learning_completed"] = True
         ctx["completion_time"] = asyncio.get_event_loop().time()
+        await SESSIONS.asave(current_session)
         
         return {
             "success": True, 
@@ -362,7 +517,7 @@ async def complete_learning(session_id: str):
 
     except Exception as e:
         print(f"Failed to complete learning, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 # 4.8.2. HTTP 端点：检查学习状态
 @app.get("/api/session/{session_id}/status")
@@ -370,29 +525,26 @@ async def get_learning_status(session_id: str):
     """
     获取当前学习会话的状态信息。
     """
-    current_session = SESSIONS.get(session_id)
+    current_session = await SESSIONS.aget(session_id)
     if not current_session:
         raise HTTPException(status_code=404, detail="Session not found.")
 
     try:
         ctx = current_session.problem_context
         
-        # 定义学习阶段的顺序
-        learning_stages = ["problem_analysis", "solution_design", "implementation", "testing_refinement", "reflection"]
-        
         try:
-            current_index = learning_stages.index(ctx["current_stage"])
+            current_index = LEARNING_STAGES.index(ctx["current_stage"])
         except ValueError:
             current_index = 0
 
-        is_last_stage = current_index >= len(learning_stages) - 1
+        is_last_stage = current_index >= len(LEARNING_STAGES) - 1
         learning_completed = ctx.get("learning_completed", False)
         
         return {
             "success": True,
             "currentStage": ctx["current_stage"],
             "currentStageIndex": current_index,
-            "totalStages": len(learning_stages),
+            "totalStages": len(LEARNING_STAGES),
             "isLastStage": is_last_stage,
             "learningCompleted": learning_completed,
             "canTransitionNext": not is_last_stage and not learning_completed,
@@ -401,7 +553,16 @@ async def get_learning_status(session_id: str):
 
     except Exception as e:
         print(f"Failed to get learning status, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+# 4.8.3. HTTP 端点：本会话各条链的 token 用量、费用和上游耗时（当前 worker 的统计）
+@app.get("/api/session/{session_id}/usage")
+async def get_session_usage(session_id: str):
+    usage = USAGE.session_stats(session_id)
+    if usage is None:
+        await get_session_or_404(session_id)
+        usage = {"total": {}, "chains": {}}
+    return {"success": True, **usage}
 
 # 5. WebSocket 端点：现在路径中包含 session_id
 @app.websocket("/ws/chat/{session_id}")
@@ -409,50 +570,76 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
     await websocket.accept()
     
     # 根据 session_id 从字典中查找对应的会话
-    current_session = SESSIONS.get(session_id)
+    current_session = await SESSIONS.aget(session_id)
     
     if not current_session:
         await websocket.send_json({"type": "error", "content": "Invalid session ID. Please restart."})
         await websocket.close()
         return
 
+    # 有活跃连接的会话不会被淘汰到磁盘
+    current_session.active_connections += 1
+    WEBSOCKET_CONNECTIONS.inc()
     try:
         while True:
             user_message = await websocket.receive_text()
+            turn_started = time.perf_counter()
+
+            # 每轮重新读取会话：使用共享存储时其他 worker 可能已经更新了它
+            current_session = await SESSIONS.aget(session_id) or current_session
             
             # 使用当前会话的上下文
             ctx = current_session.problem_context
             ctx["conversation_history"].append({"role": "user", "content": user_message})
 
-            async def streaming_callback(chunk: str):
-                if chunk:
-                    await websocket.send_json({"type": "chunk", "content": chunk})
-
-            current_session.assistant.set_streaming_callback(streaming_callback)
-            
-            history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in ctx["conversation_history"][:-1]])
-
-            ai_full_response = current_session.assistant.continue_conversation(
-                problem=ctx["problem"],
-                language=ctx["language"],
-                skill_level=ctx["skill_level"],
-                current_stage=ctx["current_stage"],
-                conversation_history=history_text,
-                student_response=user_message
-            )
+            # 按 token 预算构建多轮历史消息（不含刚收到的这条消息），长会话中提示长度保持稳定，
+            # 且每轮请求的前缀与上一轮相同，可以命中上游的提示缓存
+            history_messages = current_session.build_conversation_messages(end=len(ctx["conversation_history"]) - 1)
+
+            async def send_chunk(chunk: str):
+                await websocket.send_json({"type": "chunk", "content": chunk})
+
+            # 生产者把分块写入有界队列，这里按顺序发送；客户端变慢时上游读取随之暂停
+            with deadline(endpoint_deadline("chat")), \
+                    span("handler websocket_chat_turn", session_id=session_id,
+                         message_chars=len(user_message),
+                         history_chars=sum(len(msg["content"]) for msg in history_messages)) as turn_span:
+                ai_full_response = await run_streaming(
+                    lambda streaming_callback: current_session.assistant.acontinue_conversation(
+                        problem=ctx["problem"],
+                        language=ctx["language"],
+                        skill_level=ctx["skill_level"],
+                        current_stage=ctx["current_stage"],
+                        conversation_history=history_messages,
+                        student_response=user_message,
+                        streaming_callback=streaming_callback
+                    ),
+                    send_chunk
+                )
+                turn_span.set_attribute("response_chars", len(ai_full_response))
             
             ctx["conversation_history"].append({"role": "assistant", "content": ai_full_response})
+            await SESSIONS.asave(current_session)
 
-            # 添加小的延迟确保所有流式内容都已发送
-            await asyncio.sleep(0.1)
+            # 所有分块都已发送完毕，直接发送结束标记
             await websocket.send_json({"type": "end"})
+            WEBSOCKET_TURN_DURATION.observe(time.perf_counter() - turn_started)
+
+            # 在学生阅读回复时后台更新进度总结，之后的提示和阶段转换可以直接使用
+            current_session.refresh_progress_summary_in_background(SESSIONS.asave)
+            # 预取依赖最新的历史长度，因此每轮之后重新调度（已有预取在进行时跳过）
+            PREFETCHER.schedule(current_session, SESSIONS.asave)
 
     except WebSocketDisconnect:
         print(f"Client disconnected, Session ID: {session_id}")
-        # 可以在这里添加清理逻辑，比如一段时间后从 SESSIONS 字典中移除这个会话
     except Exception as e:
         print(f"WebSocket error, Session ID: {session_id}, Error: {e}")
         await websocket.send_json({"type": "error", "content": str(e)})
+    finally:
+        # 断开后会话进入空闲计时，超时后由 SESSIONS 的后台清理写入磁盘
+        current_session.active_connections -= 1
+        WEBSOCKET_CONNECTIONS.dec()
+        current_session.touch()
 
 # 4.10. HTTP 端点：检查挑战答案
 @app.post("/api/session/{session_id}/challenge/check")
@@ -460,7 +647,7 @@ async def check_challenge_answer(session_id: str, request: ChallengeCheckRequest
     """
     检查学生提交的挑战答案是否正确
     """
-    current_session = SESSIONS.get(session_id)
+    current_session = await SESSIONS.aget(session_id)
     if not current_session:
         raise HTTPException(status_code=404, detail="Session not found.")
 
@@ -512,7 +699,28 @@ async def check_challenge_answer(session_id: str, request: ChallengeCheckRequest
         
     except Exception as e:
         print(f"Failed to check challenge answer, Session ID: {session_id}, Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+# 4.11. HTTP 端点：缓存命中统计，用于调整缓存容量
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    return {"success": True, "caches": await acache_stats(), "prefetch": PREFETCHER.stats()}
+
+# 4.12. HTTP 端点：LLM 调度器的并发、各优先级通道的排队深度、熔断器状态和路由延迟统计
+@app.get("/api/scheduler/stats")
+async def get_scheduler_stats():
+    return {"success": True, "models": SCHEDULER.stats(), "circuitBreakers": breaker_stats(),
+            "routing": ROUTER.stats()}
+
+# 4.12.1. HTTP 端点：按链汇总的 token 用量、费用、上游耗时和截断次数
+@app.get("/api/usage/stats")
+async def get_usage_stats():
+    return {"success": True, **USAGE.stats()}
+
+# 4.13. Prometheus 指标
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 # 添加 OPTIONS 处理器
 @app.options("/{path:path}")
@@ -521,4 +729,12 @@ async def options_handler(request: Request, path: str):
 
 # 启动服务器的代码
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # 多个 worker 需要共享会话存储（SESSION_BACKEND=sqlite）
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and os.getenv("SESSION_BACKEND", "memory").lower() == "memory":
+        print("WEB_CONCURRENCY > 1 requires SESSION_BACKEND=sqlite; falling back to a single worker")
+        workers = 1
+    if workers > 1:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,239 @@
+# backend/metrics.py
+"""
+进程内指标，按 Prometheus 文本格式从 /metrics 导出。
+
+只实现用到的三种类型（Counter、Gauge、Histogram），不依赖 prometheus_client。
+记录一次观测只是一次字典查找和 bisect，可以在生产环境中常开。Counter 和 Gauge 可以传入
+回调，在导出时再读取（例如会话数、缓存命中率），平时没有任何开销。
+
+多个 worker 时每个进程各自导出自己的指标，由 Prometheus 按实例聚合。
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+LLM_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0)
+RATE_BUCKETS = (5.0, 10.0, 20.0, 30.0, 50.0, 75.0, 100.0, 150.0, 200.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        REGISTRY.append(self)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _SimpleMetric(_Metric):
+    """Counter/gauge storage: values set in place, or read from a callback at scrape time."""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 callback: Optional[Callable[[], Iterable[Tuple[LabelValues, float]]]] = None):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        values = self._values.items()
+        if self.callback is not None:
+            try:
+                values = list(self.callback())
+            except Exception as e:
+                print(f"Failed to collect metric {self.name}: {e}")
+                values = []
+        for label_values, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_SimpleMetric):
+    kind = "counter"
+
+
+class Gauge(_SimpleMetric):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values: str) -> None:
+        self._values[label_values] = value
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [每个桶的计数..., 总和, 次数]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, *label_values: str) -> "_Timer":
+        return _Timer(self, label_values)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for values, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, values)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, values)} {series[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: LabelValues):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+REGISTRY: List[_Metric] = []
+
+
+_ROUTE_PATHS: Dict[object, str] = {}
+
+
+def route_path(scope) -> str:
+    """Route template of a routed request (e.g. /api/session/{session_id}/hint), or 'unmatched'."""
+    # 路由匹配后 Starlette 会把 endpoint 写回 scope；用路由模板做标签，避免 session_id 撑爆序列数
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _ROUTE_PATHS.get(endpoint)
+    if path is None:
+        path = next((route.path for route in scope["app"].routes
+                     if getattr(route, "endpoint", None) is endpoint), "unmatched")
+        _ROUTE_PATHS[endpoint] = path
+    return path
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request, labelled by route template rather than raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, scope["method"], route_path(scope), status)
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---- 各模块共用的指标 ----
+
+HTTP_REQUEST_DURATION = Histogram(
+    "codecoach_http_request_duration_seconds", "HTTP request duration by route (streams until the last byte).",
+    ["method", "route", "status"]
+)
+WEBSOCKET_CONNECTIONS = Gauge("codecoach_websocket_connections", "Open WebSocket connections.")
+WEBSOCKET_TURN_DURATION = Histogram(
+    "codecoach_websocket_turn_duration_seconds", "Duration of one chat turn over the WebSocket.",
+    buckets=LLM_LATENCY_BUCKETS
+)
+
+CHAIN_DURATION = Histogram(
+    "codecoach_chain_duration_seconds",
+    "Duration of InteractiveLearningAssistant chain calls, including queuing, retries and hedging.",
+    ["chain", "outcome"], buckets=LLM_LATENCY_BUCKETS
+)
+UPSTREAM_DURATION = Histogram(
+    "codecoach_upstream_duration_seconds", "Duration of one upstream attempt per model.",
+    ["chain", "model", "outcome"], buckets=LLM_LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "codecoach_time_to_first_token_seconds", "Time from starting a streaming call to its first chunk.",
+    ["chain", "model"], buckets=LLM_LATENCY_BUCKETS
+)
+STREAM_TOKENS_PER_SECOND = Histogram(
+    "codecoach_stream_tokens_per_second", "Output tokens per second after the first chunk of a stream.",
+    ["chain", "model"], buckets=RATE_BUCKETS
+)
+UPSTREAM_RESPONSES = Counter(
+    "codecoach_upstream_responses_total", "OpenRouter responses by status code ('error' for transport errors).",
+    ["model", "status"]
+)
+LLM_TOKENS = Counter(
+    "codecoach_llm_tokens_total", "Tokens per chain and model (kind: prompt, completion, cached prompt tokens).",
+    ["chain", "model", "kind"]
+)
+LLM_COST = Counter("codecoach_llm_cost_usd_total", "Upstream cost reported by OpenRouter.", ["chain", "model"])
+TRUNCATED_COMPLETIONS = Counter(
+    "codecoach_truncated_completions_total",
+    "Completions cut short: at the output token limit (max_tokens by the upstream, early_stop by the "
+    "backend) or by cancellation (cancelled, e.g. a losing hedge).",
+    ["chain", "reason"]
+)
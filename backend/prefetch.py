@@ -0,0 +1,98 @@
+# backend/prefetch.py
+"""
+推测式预取：学习阶段的顺序和每个阶段的挑战焦点都是确定的，因此在学生仍在
+当前阶段学习时，就可以在后台提前生成下一阶段的过渡消息，并填充当前阶段的微型挑战池。
+
+过渡消息只保存在进程内的会话对象上，并带有过期检查：它依赖进度总结，只有在
+阶段未变且对话历史没有新增时才可使用。微型挑战进入共享的 CHALLENGE_POOL，
+由挑战端点直接取用。
+
+默认关闭（会增加上游调用），设置 ENABLE_PREFETCH=1 开启。
+"""
+import os
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from session import Session, LEARNING_STAGES, FOCUS_AREAS, DEFAULT_FOCUS_AREA
+from scheduler import lane, PRIORITY_BACKGROUND
+from resilience import no_deadline
+from tracing import span
+
+
+class Prefetcher:
+    """Generates the next stage transition and fills the mini-challenge pool ahead of time."""
+
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = enabled if enabled is not None else os.getenv("ENABLE_PREFETCH", "0") == "1"
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def schedule(self, session: Session, on_done: Optional[Callable[[Session], Awaitable[None]]] = None) -> None:
+        """Start a background prefetch for the session's current stage (no-op when disabled)."""
+        if not self.enabled:
+            return
+        if session.prefetch_task is not None and not session.prefetch_task.done():
+            return
+        session.prefetch_task = asyncio.create_task(self._run(session, on_done))
+
+    async def _run(self, session: Session, on_done: Optional[Callable[[Session], Awaitable[None]]]) -> None:
+        try:
+            stage = session.problem_context["current_stage"]
+            jobs = [self._prefetch_challenges(session, stage)]
+            try:
+                stage_index = LEARNING_STAGES.index(stage)
+            except ValueError:
+                stage_index = len(LEARNING_STAGES) - 1
+            if stage_index < len(LEARNING_STAGES) - 1:
+                jobs.append(self._prefetch_stage_transition(session, stage, LEARNING_STAGES[stage_index + 1]))
+            # 预取的调用都走 background 通道，不与学生正在等待的请求竞争
+            with lane(PRIORITY_BACKGROUND), no_deadline(), span("prefetch", session_id=session.session_id, stage=stage):
+                await asyncio.gather(*jobs)
+            if on_done is not None:
+                await on_done(session)
+        except Exception as e:
+            print(f"Prefetch failed, Session ID: {session.session_id}, Error: {e}")
+
+    async def _prefetch_stage_transition(self, session: Session, stage: str, new_stage: str) -> None:
+        ctx = session.problem_context
+        history_len = len(ctx["conversation_history"])
+        progress_summary = await session.get_progress_summary()
+        message = await session.assistant.agenerate_stage_transition(
+            problem=ctx["problem"], language=ctx["language"], skill_level=ctx["skill_level"],
+            previous_stage=stage, new_stage=new_stage, progress_summary=progress_summary
+        )
+        session.prefetched["stage_transition"] = {
+            "stage": stage,
+            "new_stage": new_stage,
+            "history_len": history_len,
+            "message": message
+        }
+
+    async def _prefetch_challenges(self, session: Session, stage: str) -> None:
+        # 池已经高于水位时不会产生上游调用
+        ctx = session.problem_context
+        await session.assistant.aprefill_mini_challenges(
+            problem=ctx["problem"],
+            language=ctx["language"],
+            skill_level=ctx["skill_level"],
+            current_stage=stage,
+            focus_area=FOCUS_AREAS.get(stage, DEFAULT_FOCUS_AREA)
+        )
+
+    def take_stage_transition(self, session: Session, new_stage: str) -> Optional[str]:
+        """Return the prefetched transition message if it is still fresh, consuming it."""
+        entry = session.prefetched.pop("stage_transition", None)
+        ctx = session.problem_context
+        if entry is None:
+            self.misses += 1
+            return None
+        if (entry["stage"] != ctx["current_stage"] or entry["new_stage"] != new_stage
+                or entry["history_len"] != len(ctx["conversation_history"])):
+            self.stale += 1
+            return None
+        self.hits += 1
+        return entry["message"]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses, "stale": self.stale}
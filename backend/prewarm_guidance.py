@@ -0,0 +1,95 @@
+# backend/prewarm_guidance.py
+"""
+上课前预热初始引导缓存。
+
+用法（在 backend 目录下运行）：
+    python prewarm_guidance.py problems.jsonl --language Python --skill-level Beginner \
+        --model anthropic/claude-3.7-sonnet
+
+题目文件可以是：
+    - JSONL：每行一个对象，包含 "problem"，可选 "language"、"skillLevel"
+    - 纯文本：题目之间用单独一行 "---" 分隔
+
+对每道题和每个 (语言, 水平, 模型) 组合生成一次初始引导，写入 GUIDANCE_CACHE_PATH
+指定的持久化缓存；之后启动的 worker 会直接命中这些条目。
+"""
+import os
+import json
+import asyncio
+import argparse
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+
+def load_problems(path: str) -> List[Dict[str, str]]:
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        if path.endswith(".json"):
+            items = json.loads(content)
+        else:
+            items = [json.loads(line) for line in content.splitlines() if line.strip()]
+        return [item if isinstance(item, dict) else {"problem": item} for item in items]
+
+    blocks = [block.strip() for block in content.split("\n---\n")]
+    return [{"problem": block} for block in blocks if block]
+
+
+async def prewarm(problems: List[Dict[str, str]], languages: List[str], skill_levels: List[str],
+                  models: List[str], concurrency: int) -> None:
+    # 在 load_dotenv 之后再导入，保证缓存路径等环境变量生效
+    from basic import InteractiveLearningAssistant, GUIDANCE_CACHE
+
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise ValueError("OPENROUTER_API_KEY environment variable not found")
+
+    jobs = []
+    for item in problems:
+        for language in ([item["language"]] if item.get("language") else languages):
+            for skill_level in ([item["skillLevel"]] if item.get("skillLevel") else skill_levels):
+                for model in models:
+                    jobs.append((item["problem"], language, skill_level, model))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def run(problem: str, language: str, skill_level: str, model: str) -> None:
+        nonlocal done
+        async with semaphore:
+            assistant = InteractiveLearningAssistant(api_key=api_key, model=model)
+            try:
+                await assistant.aget_initial_guidance(problem=problem, language=language, skill_level=skill_level)
+            except Exception as e:
+                print(f"Failed to prewarm ({language}, {skill_level}, {model}): {e}")
+            done += 1
+            print(f"[{done}/{len(jobs)}] {language} / {skill_level} / {model}: {problem[:60]!r}")
+
+    await asyncio.gather(*[run(*job) for job in jobs])
+    print(f"Guidance cache: {await GUIDANCE_CACHE.astats()}")
+    GUIDANCE_CACHE.close()
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Pre-warm the initial guidance cache from a problem list.")
+    parser.add_argument("problems", help="JSONL/JSON file or text file with problems separated by '---' lines")
+    parser.add_argument("--language", action="append", help="Programming language (repeatable)")
+    parser.add_argument("--skill-level", action="append", help="Skill level (repeatable)")
+    parser.add_argument("--model", action="append", help="Model (repeatable)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel upstream calls")
+    args = parser.parse_args()
+
+    asyncio.run(prewarm(
+        load_problems(args.problems),
+        args.language or ["Python"],
+        args.skill_level or ["Beginner"],
+        args.model or ["anthropic/claude-3.7-sonnet"],
+        args.concurrency
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# backend/recorder.py
+"""
+可选的会话录制：把每个会话的请求序列写成匿名化的 JSONL，供 loadtest/replay.py 回放，
+用真实的流量组合做延迟回归测试。
+
+设置 SESSION_RECORD_DIR 后开启。RecordingMiddleware 在 ASGI 层记录所有会话相关的请求
+（开始会话、对话消息、提示、代码反馈、挑战、阶段转换、完成等），每个会话一个文件：
+
+    {"ts": 1718000000.12, "kind": "http", "endpoint": "request_hint", "method": "POST",
+     "route": "/api/session/{session_id}/hint", "params": {}, "body": {"hintRequest": "..."},
+     "status": 200, "durationMs": 1834.2}
+    {"ts": 1718000003.40, "kind": "ws", "endpoint": "websocket_endpoint",
+     "route": "/ws/chat/{session_id}", "params": {}, "message": "..."}
+
+匿名化：
+    - 文件名和记录中不出现 session_id，文件名是 session_id 的 SHA-256 前缀
+      （多个 worker 的记录会写入同一个文件）
+    - 学生输入的文本（请求体中的字符串和对话消息）按 SESSION_RECORD_REDACT 处理：
+        pii（默认）  去掉邮箱、URL、IP 地址和长数字串，其余原样保留，回放时缓存命中情况与线上一致
+        mask        所有字母和数字替换为 x/0，只保留长度和结构
+
+事件先放入内存缓冲区，由后台任务定期在线程中批量追加到文件，不阻塞事件循环。
+
+配置（环境变量）：
+    SESSION_RECORD_DIR             录制目录，不设置时关闭
+    SESSION_RECORD_REDACT          pii | mask（默认 pii）
+    SESSION_RECORD_FLUSH_INTERVAL  写入间隔秒数（默认 2）
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import route_path
+
+# 只录制会话流量，统计、指标等端点不录制
+RECORDED_PREFIXES = ("/api/start_session", "/api/session/", "/ws/chat/")
+
+_PII_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "<email>"),
+    (re.compile(r"https?://\S+"), "<url>"),
+    (re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}\b"), "<ip>"),
+    (re.compile(r"\b\d{7,}\b"), "<number>"),
+]
+_MASK_LETTERS = re.compile(r"[^\W\d_]")
+_MASK_DIGITS = re.compile(r"\d")
+
+
+def anonymize_text(text: str, mode: str) -> str:
+    if mode == "mask":
+        return _MASK_DIGITS.sub("0", _MASK_LETTERS.sub("x", text))
+    for pattern, replacement in _PII_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _anonymize(value: Any, mode: str) -> Any:
+    if isinstance(value, str):
+        return anonymize_text(value, mode)
+    if isinstance(value, dict):
+        return {key: _anonymize(item, mode) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_anonymize(item, mode) for item in value]
+    return value
+
+
+def session_file_key(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:16]
+
+
+class SessionRecorder:
+    """Buffers anonymized session events and appends them to one JSONL file per session."""
+
+    def __init__(self, directory: Optional[str], redact: str = "pii", flush_interval: float = 2.0):
+        self.directory = directory
+        self.redact = redact
+        self.flush_interval = flush_interval
+        self.buffer: "deque[Tuple[str, Dict[str, Any]]]" = deque()
+        self.recorded = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionRecorder":
+        return cls(
+            os.getenv("SESSION_RECORD_DIR") or None,
+            redact=os.getenv("SESSION_RECORD_REDACT", "pii"),
+            flush_interval=float(os.getenv("SESSION_RECORD_FLUSH_INTERVAL", "2"))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def record(self, session_id: str, event: Dict[str, Any]) -> None:
+        """Queue one event; strings in its body/message are anonymized here."""
+        for field in ("body", "message", "params"):
+            if field in event:
+                event[field] = _anonymize(event[field], self.redact)
+        self.buffer.append((session_file_key(session_id), event))
+
+    def flush(self) -> None:
+        """Append everything buffered to the session files (blocking)."""
+        batch: Dict[str, List[str]] = {}
+        while self.buffer:
+            key, event = self.buffer.popleft()
+            batch.setdefault(key, []).append(json.dumps(event, ensure_ascii=False))
+        if not batch:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for key, lines in batch.items():
+                # 每个文件一次追加写入，多个 worker 同时追加时各自的行不会交错
+                with open(os.path.join(self.directory, f"{key}.jsonl"), "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+                self.recorded += len(lines)
+        except OSError as e:
+            print(f"Failed to write session recordings: {e}")
+
+    async def run(self) -> None:
+        """Background loop flushing the buffer every flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.buffer:
+                await asyncio.to_thread(self.flush)
+
+    def start(self) -> Optional[asyncio.Task]:
+        """Start the background writer (call from the running event loop)."""
+        if not self.enabled:
+            return None
+        return asyncio.create_task(self.run())
+
+    async def shutdown(self) -> None:
+        if self.enabled:
+            await asyncio.to_thread(self.flush)
+
+
+RECORDER = SessionRecorder.from_env()
+
+
+def _decode_json(body: bytes) -> Any:
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def _route_params(scope) -> Dict[str, Any]:
+    return {key: value for key, value in scope.get("path_params", {}).items() if key != "session_id"}
+
+
+class RecordingMiddleware:
+    """ASGI middleware feeding session HTTP requests and WebSocket chat messages to RECORDER."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] not in ("http", "websocket") or not RECORDER.enabled
+                or not scope["path"].startswith(RECORDED_PREFIXES) or scope.get("method") == "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+        if scope["type"] == "websocket":
+            await self._websocket(scope, receive, send)
+        else:
+            await self._http(scope, receive, send)
+
+    async def _http(self, scope, receive, send):
+        started = time.time()
+        request_body: List[bytes] = []
+        response_body: List[bytes] = []
+        status = 500
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                request_body.append(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and "session_id" not in scope.get("path_params", {}):
+                # 开始会话的 session_id 只出现在响应体中
+                response_body.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            session_id = scope.get("path_params", {}).get("session_id")
+            if session_id is None:
+                session_id = (_decode_json(b"".join(response_body)) or {}).get("sessionId")
+            if session_id:
+                endpoint = scope.get("endpoint")
+                RECORDER.record(session_id, {
+                    "ts": round(started, 3),
+                    "kind": "http",
+                    "endpoint": getattr(endpoint, "__name__", None),
+                    "method": scope["method"],
+                    "route": route_path(scope),
+                    "params": _route_params(scope),
+                    "body": _decode_json(b"".join(request_body)),
+                    "status": status,
+                    "durationMs": round((time.time() - started) * 1000, 1)
+                })
+
+    async def _websocket(self, scope, receive, send):
+        async def receive_wrapper():
+            message = await receive()
+            session_id = scope.get("path_params", {}).get("session_id")
+            if message["type"] == "websocket.receive" and message.get("text") is not None and session_id:
+                RECORDER.record(session_id, {
+                    "ts": round(time.time(), 3),
+                    "kind": "ws",
+                    "endpoint": getattr(scope.get("endpoint"), "__name__", None),
+                    "route": route_path(scope),
+                    "params": _route_params(scope),
+                    "message": message["text"]
+                })
+            return message
+
+        await self.app(scope, receive_wrapper, send)
@@ -0,0 +1,331 @@
+# backend/resilience.py
+"""
+上游 LLM 调用的容错：重试、截止时间（deadline）传递和按模型的熔断器。
+
+- 截止时间保存在 contextvar 中，由端点用 deadline(seconds) 设置；上游请求的超时会
+  缩短到剩余时间，超过截止时间时抛出 DeadlineExceeded（映射为 HTTP 504）。
+- 幂等的请求（非流式调用，以及尚未输出任何内容的流式调用）在连接错误、超时、
+  429 和 5xx 时按带抖动的指数退避重试，退避时间不会超过剩余的截止时间。
+- 每个模型有一个熔断器：连续失败达到阈值后在冷却期内直接失败
+  （UpstreamUnavailable，映射为 HTTP 503），冷却期结束后放行一个探测请求。
+
+配置（环境变量）：
+    LLM_RETRY_ATTEMPTS          最多尝试次数（含第一次，默认 3）
+    LLM_RETRY_BASE_DELAY        退避基数秒数（默认 0.5）
+    LLM_RETRY_MAX_DELAY         单次退避上限秒数（默认 4）
+    CIRCUIT_FAILURE_THRESHOLD   打开熔断器的连续失败次数（默认 5）
+    CIRCUIT_RESET_SECONDS       熔断器打开后的冷却秒数（默认 30）
+    ENDPOINT_DEADLINES          按端点覆盖的截止时间，JSON，例如 {"hint": 20}
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# 各端点默认的截止时间（秒）
+DEFAULT_DEADLINES = {
+    "start_session": 60.0,
+    "chat": 120.0,
+    "explain": 60.0,
+    "hint": 60.0,
+    "code_feedback": 90.0,
+    "stage_transition": 60.0,
+    "challenge": 60.0,
+    "complete": 120.0,
+}
+
+
+class UpstreamStatusError(ValueError):
+    """OpenRouter answered with a non-2xx status."""
+
+    def __init__(self, status_code: int, body: str, retry_after: Optional[float] = None):
+        super().__init__(f"Error: {status_code}, {body}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailable(ValueError):
+    """The upstream is failing (retries exhausted or circuit open); maps to HTTP 503."""
+
+
+class DeadlineExceeded(ValueError):
+    """The request's deadline passed before the upstream answered; maps to HTTP 504."""
+
+
+# ---- 截止时间 ----
+
+_deadline_var: contextvars.ContextVar = contextvars.ContextVar("llm_deadline", default=None)
+
+
+def endpoint_deadline(name: str) -> float:
+    """Return the deadline in seconds configured for an endpoint."""
+    overrides = os.getenv("ENDPOINT_DEADLINES")
+    if overrides:
+        try:
+            deadlines = json.loads(overrides)
+            if name in deadlines:
+                return float(deadlines[name])
+        except (ValueError, TypeError) as e:
+            print(f"Invalid ENDPOINT_DEADLINES: {e}")
+    return DEFAULT_DEADLINES.get(name, 60.0)
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """Bound every upstream call inside the block (and tasks it spawns); nested deadlines only shrink."""
+    expires_at = time.monotonic() + seconds
+    current = _deadline_var.get()
+    token = _deadline_var.set(expires_at if current is None else min(current, expires_at))
+    try:
+        yield
+    finally:
+        _deadline_var.reset(token)
+
+
+@contextmanager
+def no_deadline() -> Iterator[None]:
+    """Drop the inherited deadline, e.g. in a background task spawned by a request."""
+    token = _deadline_var.set(None)
+    try:
+        yield
+    finally:
+        _deadline_var.reset(token)
+
+
+def with_deadline(name: str) -> Callable:
+    """Decorator running an async endpoint (or helper) under endpoint_deadline(name)."""
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            with deadline(endpoint_deadline(name)):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def remaining() -> Optional[float]:
+    """Seconds left until the current deadline, or None when there is none."""
+    expires_at = _deadline_var.get()
+    return None if expires_at is None else expires_at - time.monotonic()
+
+
+def check_deadline() -> None:
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+def timeout_for(default: httpx.Timeout) -> httpx.Timeout:
+    """Shrink the default upstream timeout to the time left before the deadline."""
+    left = remaining()
+    if left is None:
+        return default
+    check_deadline()
+    return httpx.Timeout(
+        min(default.read or left, left),
+        connect=min(default.connect or left, left),
+        read=min(default.read or left, left),
+        write=min(default.write or left, left),
+        pool=min(default.pool or left, left),
+    )
+
+
+# ---- 熔断器 ----
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def reject_if_open(self) -> None:
+        """Fail fast while open without taking the half-open probe (e.g. before queuing)."""
+        if self.state == "open":
+            self.rejected += 1
+            raise UpstreamUnavailable(f"Model {self.name} is temporarily unavailable (circuit open)")
+
+    def before_call(self) -> None:
+        """Raise UpstreamUnavailable while the circuit is open (or a probe is already running)."""
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return
+        self.rejected += 1
+        raise UpstreamUnavailable(f"Model {self.name} is temporarily unavailable (circuit open)")
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probe_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Give up a half-open probe that ended without a verdict (e.g. a client error or cancellation)."""
+        self.probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    breaker = _BREAKERS.get(model)
+    if breaker is None:
+        breaker = _BREAKERS[model] = CircuitBreaker(
+            model,
+            failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            reset_seconds=float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+        )
+    return breaker
+
+
+def breaker_stats() -> Dict[str, Dict[str, Any]]:
+    return {model: breaker.stats() for model, breaker in _BREAKERS.items()}
+
+
+# ---- 重试 ----
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, UpstreamStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+def translate_error(error: Exception) -> Exception:
+    """Map a final upstream failure to the error type surfaced to the endpoints."""
+    if isinstance(error, (DeadlineExceeded, UpstreamUnavailable)):
+        return error
+    if isinstance(error, httpx.TimeoutException):
+        left = remaining()
+        if left is not None and left <= 0.05:
+            return DeadlineExceeded("Request deadline exceeded while waiting for the model")
+        return UpstreamUnavailable(f"OpenRouter API timed out: {error}")
+    if isinstance(error, httpx.TransportError):
+        return UpstreamUnavailable(f"Failed to connect to OpenRouter API: {error}")
+    if isinstance(error, UpstreamStatusError) and error.status_code in RETRYABLE_STATUS_CODES:
+        return UpstreamUnavailable(f"OpenRouter API is unavailable: {error}")
+    return error
+
+
+def retry_attempts() -> int:
+    return max(1, int(os.getenv("LLM_RETRY_ATTEMPTS", "3")))
+
+
+def backoff_delay(attempt: int, error: BaseException) -> Optional[float]:
+    """
+    Full-jitter exponential backoff before retry number `attempt` (starting at 1).
+
+    Returns None when the remaining deadline does not leave room for the wait.
+    """
+    base = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+    cap = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+    delay = random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+    if isinstance(error, UpstreamStatusError) and error.retry_after is not None:
+        delay = max(delay, min(error.retry_after, cap))
+    left = remaining()
+    if left is not None and delay >= left:
+        return None
+    return delay
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def resilient_call(model: str, send: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run an idempotent upstream request with the model's circuit breaker and jittered retries.
+
+    Args:
+        model: Model name, selects the circuit breaker
+        send: Performs one attempt; should use timeout_for() for its timeout
+
+    Returns:
+        The result of the first successful attempt
+    """
+    breaker = get_breaker(model)
+    attempts = retry_attempts()
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        try:
+            check_deadline()
+            result = await send()
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.release_probe()
+                raise translate_error(e)
+            breaker.record_failure()
+            delay = backoff_delay(attempt, e) if attempt < attempts else None
+            if delay is None:
+                raise translate_error(e)
+            print(f"Retrying {model} after error ({attempt}/{attempts - 1}): {e}")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+    raise AssertionError("unreachable")
+
+
+def resilient_call_sync(model: str, send: Callable[[], T]) -> T:
+    """Blocking variant of resilient_call for the synchronous code path."""
+    breaker = get_breaker(model)
+    attempts = retry_attempts()
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        try:
+            check_deadline()
+            result = send()
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.release_probe()
+                raise translate_error(e)
+            breaker.record_failure()
+            delay = backoff_delay(attempt, e) if attempt < attempts else None
+            if delay is None:
+                raise translate_error(e)
+            print(f"Retrying {model} after error ({attempt}/{attempts - 1}): {e}")
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+    raise AssertionError("unreachable")
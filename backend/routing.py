@@ -0,0 +1,215 @@
+# backend/routing.py
+"""
+按请求类型的模型路由。
+
+每条链（或链所属的类别）映射到一个有序的候选模型列表，由 MODEL_ROUTES 配置：
+
+    MODEL_ROUTES='{"summary": ["openai/gpt-4o-mini", "google/gemini-flash-1.5"],
+                   "challenge": ["openai/gpt-4o-mini"],
+                   "hint": ["openai/gpt-4o-mini"]}'
+
+键可以是链名（如 "progress_summary"）或类别名（见 ROUTE_GROUPS）。学生选择的
+会话模型在对话、提示等“面向学生”的类别中始终排在第一位，配置的模型只作为备用；
+其他类别只在配置的候选中选择，按观测到的延迟 p95 和错误率排序。没有配置的链
+只使用会话模型。
+
+非流式调用在主模型超过 ROUTE_HEDGE_AFTER 秒（或设为 "p95" 时使用主模型观测到的
+p95）仍未返回时，向下一个候选模型发出对冲请求，采用先成功的结果。流式调用不对冲，
+只在还没有输出任何内容时因上游不可用而切换到下一个候选。
+"""
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from resilience import UpstreamUnavailable, get_breaker
+
+T = TypeVar("T")
+
+# 类别 -> 链名
+ROUTE_GROUPS = {
+    "conversation": ["initial_guidance", "conversation_continuation", "stage_transition"],
+    "hint": ["hint_generation"],
+    "explanation": ["concept_explanation"],
+    "feedback": ["code_feedback"],
+    "summary": ["progress_summary", "progress_summary_update"],
+    "challenge": ["mini_challenge"],
+    "learning_summary": ["learning_summary"],
+}
+
+# 学生直接面对的类别：会话模型始终优先
+PINNED_GROUPS = {"conversation", "hint", "explanation", "feedback"}
+
+_CHAIN_GROUPS = {chain: group for group, chains in ROUTE_GROUPS.items() for chain in chains}
+
+
+class LatencyWindow:
+    """Sliding window of recent call outcomes for one model."""
+
+    def __init__(self, size: int):
+        self.samples: "deque[float]" = deque(maxlen=size)
+        self.outcomes: "deque[bool]" = deque(maxlen=size)
+
+    def record(self, latency: Optional[float], ok: bool) -> None:
+        if latency is not None:
+            self.samples.append(latency)
+        self.outcomes.append(ok)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+
+class ModelRouter:
+    """Chooses candidate models per chain from configuration and observed latency/error rates."""
+
+    def __init__(self, routes: Dict[str, List[str]], hedge_after: str, window: int, min_samples: int):
+        self.routes = routes
+        self.hedge_after = hedge_after
+        self.window = window
+        self.min_samples = min_samples
+        self.windows: Dict[str, LatencyWindow] = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        routes: Dict[str, List[str]] = {}
+        config = os.getenv("MODEL_ROUTES")
+        if config:
+            try:
+                routes = {name: list(models) for name, models in json.loads(config).items()}
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"Invalid MODEL_ROUTES: {e}")
+        return cls(
+            routes,
+            hedge_after=os.getenv("ROUTE_HEDGE_AFTER", "10"),
+            window=int(os.getenv("ROUTE_LATENCY_WINDOW", "200")),
+            min_samples=int(os.getenv("ROUTE_MIN_SAMPLES", "20"))
+        )
+
+    def _window(self, model: str) -> LatencyWindow:
+        window = self.windows.get(model)
+        if window is None:
+            window = self.windows[model] = LatencyWindow(self.window)
+        return window
+
+    def record(self, model: str, latency: Optional[float], ok: bool) -> None:
+        """Record one call: latency is time to first chunk for streams, total time otherwise."""
+        self._window(model).record(latency, ok)
+
+    def _score(self, model: str) -> float:
+        window = self._window(model)
+        if len(window.outcomes) < self.min_samples:
+            # 样本不足的模型先试用，积累观测数据
+            return 0.0
+        p95 = window.percentile(0.95) or 0.0
+        return p95 * (1 + 4 * window.error_rate)
+
+    def candidates(self, chain_name: str, session_model: str) -> List[str]:
+        """Return the models to try for a chain, best first."""
+        group = _CHAIN_GROUPS.get(chain_name)
+        configured = self.routes.get(chain_name) or (self.routes.get(group) if group else None) or []
+        if group in PINNED_GROUPS or not configured:
+            fallbacks = [model for model in configured if model != session_model]
+            models = [session_model] + sorted(fallbacks, key=self._score)
+        else:
+            # 稳定排序：分数相同时保持配置顺序
+            models = sorted(dict.fromkeys(configured), key=self._score)
+        # 熔断器打开的模型排到最后
+        return sorted(models, key=lambda model: get_breaker(model).state == "open")
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        if self.hedge_after == "p95":
+            p95 = self._window(model).percentile(0.95)
+            return max(1.0, p95) if p95 is not None else None
+        delay = float(self.hedge_after)
+        return delay if delay > 0 else None
+
+    async def call(self, candidates: List[str], invoke: Callable[[str], Awaitable[T]]) -> T:
+        """
+        Run a non-streaming call on the first candidate, hedging to the next one when it is slow
+        and failing over when it is unavailable.
+        """
+        primary = asyncio.create_task(invoke(candidates[0]))
+        tasks = [primary]
+        try:
+            delay = self._hedge_delay(candidates[0]) if len(candidates) > 1 else None
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if primary in done:
+                error = primary.exception()
+                if error is None:
+                    return primary.result()
+                if not isinstance(error, UpstreamUnavailable) or len(candidates) == 1:
+                    raise error
+                self.failovers += 1
+                return await self.call(candidates[1:], invoke)
+
+            # 主模型太慢：向备用模型发出对冲请求，采用先成功的结果
+            self.hedges += 1
+            backup = asyncio.create_task(invoke(candidates[1]))
+            tasks.append(backup)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": self.routes,
+            "hedges": self.hedges,
+            "hedgeWins": self.hedge_wins,
+            "failovers": self.failovers,
+            "models": {
+                model: {
+                    "samples": len(window.outcomes),
+                    "p50": window.percentile(0.5),
+                    "p95": window.percentile(0.95),
+                    "errorRate": round(window.error_rate, 4)
+                }
+                for model, window in self.windows.items()
+            }
+        }
+
+
+ROUTER = ModelRouter.from_env()
+
+
+class LatencyTimer:
+    """Measures one call for the router: total time, or time to the first streamed chunk."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_chunk: Optional[float] = None
+
+    def mark_chunk(self) -> None:
+        if self.first_chunk is None:
+            self.first_chunk = time.monotonic() - self.started
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def latency(self) -> float:
+        return self.first_chunk if self.first_chunk is not None else self.elapsed()
@@ -0,0 +1,245 @@
+# backend/scheduler.py
+"""
+进程级的 LLM 请求调度器，位于所有异步上游调用之前。
+
+- 每个模型有独立的并发上限，超出的请求排队等待；
+- 队列分为三个优先级通道：interactive（实时对话、提示等学生正在等待的请求）、
+  normal 和 background（进度总结、预取等），空出的名额总是先给高优先级通道；
+- 同一通道内按会话轮转（round-robin），一个频繁请求的会话不会饿死其他会话；
+- 流式调用在等待慢客户端时（输出队列已满，见 streaming.TokenStream）把名额借给排队的
+  请求，自己转入单独的 backpressure 预算；客户端跟上后立即收回名额继续输出，不重新排队；
+- stats() 报告每个模型的活跃数、借出数和各通道的排队深度。
+
+配置（环境变量）：
+    LLM_CONCURRENCY             每个模型默认的并发上限（默认 64）
+    LLM_CONCURRENCY_PER_MODEL   按模型覆盖，JSON，例如 {"anthropic/claude-3.7-sonnet": 32}
+    LLM_BACKPRESSURE_SLOTS      每个模型最多同时借出名额的流数（默认 256），超出时慢客户端的流
+                                继续占用名额
+
+如何设置并发上限：名额限制的是同时在生成的上游请求数。按 Little 定律，需要的名额约为
+目标吞吐 × 上游平均耗时，例如每秒 8 轮对话、每轮平均 6 秒，约需 48 个；再以提供商对该
+模型的并发/速率限制为上限（超过后只会换来 429）。等待慢客户端的流不计入上限，所以不必
+为它们预留名额。/api/scheduler/stats 中 avgWaitSeconds 持续升高说明上限偏低，上游 429 或
+延迟明显上升说明偏高。
+"""
+import os
+import json
+import time
+import asyncio
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+LANE_NAMES = ["interactive", "normal", "background"]
+
+# 当前任务中所有 LLM 调用的最低优先级（例如后台任务中的调用都降为 background）
+_priority_floor_var: contextvars.ContextVar = contextvars.ContextVar("llm_priority_floor", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def lane(priority: int) -> Iterator[None]:
+    """Run every LLM call made inside the block (and tasks it spawns) at no more than this priority."""
+    token = _priority_floor_var.set(max(priority, _priority_floor_var.get()))
+    try:
+        yield
+    finally:
+        _priority_floor_var.reset(token)
+
+
+def effective_priority(priority: int) -> int:
+    return max(priority, _priority_floor_var.get())
+
+
+class _Lease:
+    """The slot held by the current call, so backpressure() can lend it out."""
+
+    __slots__ = ("scheduler", "model", "parked")
+
+    def __init__(self, scheduler: "LLMScheduler", model: str):
+        self.scheduler = scheduler
+        self.model = model
+        self.parked = False
+
+
+# 当前任务持有的名额（由 LLMScheduler.slot 设置）
+_lease_var: contextvars.ContextVar = contextvars.ContextVar("llm_slot_lease", default=None)
+
+
+@asynccontextmanager
+async def backpressure() -> AsyncIterator[None]:
+    """
+    Lend the current call's slot to queued requests while the block waits on a slow client.
+
+    No-op outside a slot or when the model's backpressure budget is used up.
+    """
+    lease = _lease_var.get()
+    if lease is None or lease.parked or not lease.scheduler.park(lease):
+        yield
+        return
+    try:
+        yield
+    finally:
+        lease.scheduler.resume(lease)
+
+
+class _ModelQueue:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        # 每个通道：session_id -> 该会话的等待者，按会话轮转
+        self.lanes: List["OrderedDict[str, deque]"] = [OrderedDict() for _ in LANE_NAMES]
+        self.waits = 0
+        self.wait_seconds = 0.0
+        # 等待慢客户端、暂时借出名额的流
+        self.parked = 0
+        self.parks = 0
+
+
+class LLMScheduler:
+    """Per-model concurrency limiter with priority lanes and per-session round-robin."""
+
+    def __init__(self, default_limit: int, limits: Optional[Dict[str, int]] = None, backpressure_slots: int = 256):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.backpressure_slots = backpressure_slots
+        self._queues: Dict[str, _ModelQueue] = {}
+
+    @classmethod
+    def from_env(cls) -> "LLMScheduler":
+        limits: Dict[str, int] = {}
+        overrides = os.getenv("LLM_CONCURRENCY_PER_MODEL")
+        if overrides:
+            try:
+                limits = {model: int(limit) for model, limit in json.loads(overrides).items()}
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"Invalid LLM_CONCURRENCY_PER_MODEL: {e}")
+        return cls(int(os.getenv("LLM_CONCURRENCY", "64")), limits,
+                   int(os.getenv("LLM_BACKPRESSURE_SLOTS", "256")))
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(self.limits.get(model, self.default_limit))
+        return queue
+
+    async def acquire(self, model: str, priority: int = PRIORITY_NORMAL, session_id: str = "") -> None:
+        """Wait for a slot for model; slots are granted by priority, then round-robin across sessions."""
+        queue = self._queue(model)
+        if queue.active < queue.limit and queue.waiting == 0:
+            queue.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiters = queue.lanes[priority].setdefault(session_id, deque())
+        waiters.append(future)
+        queue.waiting += 1
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已经分配但调用方被取消，交还给下一个等待者
+                self.release(model)
+            else:
+                self._remove_waiter(queue, priority, session_id, future)
+            raise
+        queue.waits += 1
+        queue.wait_seconds += time.monotonic() - started
+
+    def release(self, model: str) -> None:
+        queue = self._queue(model)
+        queue.active -= 1
+        self._dispatch(queue)
+
+    def _dispatch(self, queue: _ModelQueue) -> None:
+        while queue.active < queue.limit and queue.waiting:
+            future = self._next_waiter(queue)
+            if future.done():
+                continue
+            queue.active += 1
+            future.set_result(None)
+
+    def park(self, lease: _Lease) -> bool:
+        """Lend lease's slot to the next waiters; returns False when the backpressure budget is full."""
+        queue = self._queue(lease.model)
+        if queue.parked >= self.backpressure_slots:
+            return False
+        lease.parked = True
+        queue.parked += 1
+        queue.parks += 1
+        queue.active -= 1
+        self._dispatch(queue)
+        return True
+
+    def resume(self, lease: _Lease) -> None:
+        """Take the slot back without queueing; the model may briefly run over its limit."""
+        queue = self._queue(lease.model)
+        lease.parked = False
+        queue.parked -= 1
+        queue.active += 1
+
+    @staticmethod
+    def _next_waiter(queue: _ModelQueue) -> asyncio.Future:
+        for lane_waiters in queue.lanes:
+            if lane_waiters:
+                session_id, waiters = next(iter(lane_waiters.items()))
+                future = waiters.popleft()
+                if waiters:
+                    # 该会话还有其他请求：排到本通道末尾，先服务其他会话
+                    lane_waiters.move_to_end(session_id)
+                else:
+                    del lane_waiters[session_id]
+                queue.waiting -= 1
+                return future
+        raise RuntimeError("No waiter to dispatch")
+
+    @staticmethod
+    def _remove_waiter(queue: _ModelQueue, priority: int, session_id: str, future: asyncio.Future) -> None:
+        waiters = queue.lanes[priority].get(session_id)
+        if waiters is None or future not in waiters:
+            return
+        waiters.remove(future)
+        if not waiters:
+            del queue.lanes[priority][session_id]
+        queue.waiting -= 1
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_NORMAL, session_id: str = "") -> AsyncIterator[None]:
+        """
+        Hold a slot for model for the duration of the block (including the whole stream,
+        except while backpressure() lends it out).
+        """
+        await self.acquire(model, priority, session_id)
+        token = _lease_var.set(_Lease(self, model))
+        try:
+            yield
+        finally:
+            _lease_var.reset(token)
+            self.release(model)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "limit": queue.limit,
+                "active": queue.active,
+                "parked": queue.parked,
+                "parks": queue.parks,
+                "queued": {
+                    name: sum(len(waiters) for waiters in queue.lanes[index].values())
+                    for index, name in enumerate(LANE_NAMES)
+                },
+                "queuedSessions": len(set().union(*(lane_waiters.keys() for lane_waiters in queue.lanes))),
+                "waits": queue.waits,
+                "avgWaitSeconds": round(queue.wait_seconds / queue.waits, 4) if queue.waits else 0.0
+            }
+            for model, queue in self._queues.items()
+        }
+
+
+SCHEDULER = LLMScheduler.from_env()
@@ -0,0 +1,174 @@
+# backend/session.py
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from basic import InteractiveLearningAssistant
+from context_window import ContextWindow, get_context_budget
+from scheduler import lane, PRIORITY_BACKGROUND
+from resilience import no_deadline
+from tracing import span
+
+DEFAULT_MODEL = "anthropic/claude-3.7-sonnet"
+
+# 定义学习阶段的顺序
+LEARNING_STAGES = ["problem_analysis", "solution_design", "implementation", "testing_refinement", "reflection"]
+
+# 定义每个阶段对应的挑战焦点领域
+FOCUS_AREAS = {
+    "problem_analysis": "problem understanding and input/output analysis",
+    "solution_design": "algorithm design and data structure selection",
+    "implementation": "coding implementation and syntax",
+    "testing_refinement": "edge cases and error handling",
+    "reflection": "code optimization and best practices"
+}
+DEFAULT_FOCUS_AREA = "general programming concepts"
+
+
+class Session:
+    """Independent session object for each user"""
+    def __init__(self, api_key: str, model: str = DEFAULT_MODEL, session_id: str = ""):
+        self.assistant = InteractiveLearningAssistant(
+            api_key=api_key,
+            model=model
+        )
+        self.session_id = session_id
+        self.problem_context: dict = {}
+        # 运行时状态，不会被序列化
+        self.last_access = time.monotonic()
+        self.active_connections = 0
+        self.context_window = ContextWindow()
+        self.summary_task: Optional[asyncio.Task] = None
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self.prefetched: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def session_id(self) -> str:
+        return self._session_id
+
+    @session_id.setter
+    def session_id(self, value: str) -> None:
+        # 同步给 assistant，调度器按会话公平排队
+        self._session_id = value
+        self.assistant.session_id = value
+
+    def touch(self) -> None:
+        self.last_access = time.monotonic()
+
+    @staticmethod
+    def format_history(messages: List[Dict[str, str]]) -> str:
+        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+
+    def build_conversation_context(self, end: Optional[int] = None) -> str:
+        """
+        Render conversation_history[:end] within the model's token budget.
+
+        Recent turns are kept verbatim; older ones are replaced by the rolling progress
+        summary or condensed, so the prompt stays roughly constant on long sessions.
+        """
+        ctx = self.problem_context
+        return self.context_window.render(
+            ctx["conversation_history"],
+            get_context_budget(self.assistant.model),
+            end=end,
+            summary_state=ctx.get("progress_summary_state")
+        )
+
+    def build_conversation_messages(self, end: Optional[int] = None) -> List[Dict[str, str]]:
+        """Like build_conversation_context, but as multi-turn chat messages for the conversation chain."""
+        ctx = self.problem_context
+        return self.context_window.render_messages(
+            ctx["conversation_history"],
+            get_context_budget(self.assistant.model),
+            end=end,
+            summary_state=ctx.get("progress_summary_state")
+        )
+
+    async def get_progress_summary(self) -> str:
+        """
+        Return an up-to-date progress summary, folding in only the messages added since
+        the last summary and reusing the cached one when nothing changed.
+
+        The rolling state lives in problem_context["progress_summary_state"], so it is
+        persisted together with the rest of the session.
+        """
+        with span("progress_summary", session_id=self.session_id) as summary_span:
+            return await self._get_progress_summary(summary_span)
+
+    async def _get_progress_summary(self, summary_span: Any) -> str:
+        # 后台刷新正在进行时先等它完成，避免重复调用；随后只需合并剩余的新消息
+        task = self.summary_task
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            await asyncio.shield(task)
+
+        ctx = self.problem_context
+        history = ctx["conversation_history"]
+        state = ctx.setdefault("progress_summary_state", {"text": "", "covered": 0})
+        covered_to = len(history)
+
+        if state["text"] and state["covered"] == covered_to:
+            summary_span.set_attribute("cached", True)
+            return state["text"]
+        summary_span.set_attributes(cached=False, new_messages=covered_to - state["covered"])
+
+        new_messages = self.format_history(history[state["covered"]:covered_to])
+        if not state["text"]:
+            summary = await self.assistant.asummarize_progress(
+                problem=ctx["problem"],
+                language=ctx["language"],
+                skill_level=ctx["skill_level"],
+                conversation_history=new_messages
+            )
+        else:
+            summary = await self.assistant.aupdate_progress_summary(
+                problem=ctx["problem"],
+                language=ctx["language"],
+                skill_level=ctx["skill_level"],
+                previous_summary=state["text"],
+                new_messages=new_messages
+            )
+
+        # 只记录本次总结实际覆盖到的位置，等待期间新增的消息留给下一次合并
+        if covered_to >= state["covered"]:
+            state["text"] = summary
+            state["covered"] = covered_to
+        return summary
+
+    def refresh_progress_summary_in_background(
+            self, on_done: Optional[Callable[["Session"], Awaitable[None]]] = None) -> None:
+        """
+        Bring the progress summary up to date in a background task, so a later hint or
+        stage transition can use it without waiting for an extra LLM round trip.
+
+        Args:
+            on_done: Awaited with the session after a successful refresh (e.g. to persist it)
+        """
+        if self.summary_task is not None and not self.summary_task.done():
+            return
+        self.summary_task = asyncio.create_task(self._refresh_progress_summary(on_done))
+
+    async def _refresh_progress_summary(self, on_done: Optional[Callable[["Session"], Awaitable[None]]]) -> None:
+        try:
+            # 后台任务不受触发它的请求的截止时间约束
+            with lane(PRIORITY_BACKGROUND), no_deadline():
+                await self.get_progress_summary()
+            if on_done is not None:
+                await on_done(self)
+        except Exception as e:
+            print(f"Background progress summary failed, Session ID: {self.session_id}, Error: {e}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the persistent part of the session (everything except runtime state)."""
+        return {
+            "model": self.assistant.model,
+            "problem_context": self.problem_context
+        }
+
+    @classmethod
+    def from_dict(cls, session_id: str, data: Dict[str, Any]) -> "Session":
+        """Rebuild a session serialized by to_dict, using the API key from the environment."""
+        session = cls(api_key=os.getenv("OPENROUTER_API_KEY", ""), model=data.get("model", DEFAULT_MODEL),
+                      session_id=session_id)
+        session.problem_context = data.get("problem_context", {})
+        return session
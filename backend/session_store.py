@@ -0,0 +1,523 @@
+# backend/session_store.py
+"""
+可插拔的会话存储。
+
+- MemorySessionStore：单进程使用。内存中按 LRU 保存活跃会话，空闲超时或
+  超出上限的会话被压缩写入磁盘，下次请求该会话时透明地重新加载。压缩和文件读写
+  在专用线程中执行，不阻塞事件循环。
+- SQLiteSessionStore：多个 uvicorn worker 共享同一个 SQLite（WAL 模式）数据库，
+  任何 worker 都能读到其他 worker 写入的 problem_context 和 conversation_history。
+  对话历史按轮追加写入 turns 表，每次保存只写入新增的消息；数据库读写都在专用线程中
+  执行，不阻塞事件循环。
+
+异步处理函数通过 await aget(session_id) 读取会话，修改后必须 await asave(session)，
+共享存储才能看到最新状态。同步的 get/save 供脚本使用，会在调用线程中直接访问存储。
+
+配置（环境变量）：
+    SESSION_BACKEND          memory（默认）或 sqlite
+    SESSION_SQLITE_PATH      SQLite 数据库文件（默认 ./sessions.db）
+    SESSION_MAX_IN_MEMORY    内存中最多保留的会话数（默认 1000）
+    SESSION_IDLE_TTL         空闲多少秒后移出内存（默认 1800）
+    SESSION_SWEEP_INTERVAL   后台清理间隔秒数（默认 60）
+    SESSION_SPILL_DIR        磁盘目录（默认 ./session_spill）
+    SESSION_DISK_TTL         持久化会话的保留秒数（默认 7 天）
+"""
+import os
+import json
+import time
+import uuid
+import zlib
+import sqlite3
+import asyncio
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from session import Session
+
+
+def _is_valid_session_id(session_id: str) -> bool:
+    # session_id 来自 URL，只接受 UUID，防止路径穿越等问题
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        return False
+    return True
+
+
+def _dumps(session: Session) -> bytes:
+    return json.dumps(session.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class BaseSessionStore(ABC):
+    """Interface shared by all session backends."""
+
+    def __init__(self, idle_ttl: Optional[float] = None, disk_ttl: Optional[float] = None):
+        self.idle_ttl = idle_ttl or float(os.getenv("SESSION_IDLE_TTL", "1800"))
+        self.disk_ttl = disk_ttl or float(os.getenv("SESSION_DISK_TTL", str(7 * 24 * 3600)))
+        # 单线程执行器：存储的磁盘或数据库 I/O 都在这个线程中按提交顺序执行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+
+    async def _run(self, func, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Session]:
+        """Return the session, or None if it does not exist."""
+
+    @abstractmethod
+    def save(self, session: Session) -> None:
+        """Persist a session after its state was modified."""
+
+    @abstractmethod
+    def sweep(self) -> None:
+        """Release idle sessions and expire old persisted ones."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of sessions currently held in this process's memory."""
+
+    def __setitem__(self, session_id: str, session: Session) -> None:
+        session.session_id = session_id
+        self.save(session)
+
+    # 默认的异步接口直接调用同步实现（内存操作）；需要磁盘或数据库 I/O 的存储覆盖它们
+    async def aget(self, session_id: str) -> Optional[Session]:
+        """Async variant of get, for request handlers."""
+        return self.get(session_id)
+
+    async def asave(self, session: Session) -> None:
+        """Async variant of save, for request handlers."""
+        self.save(session)
+
+    async def asweep(self) -> None:
+        self.sweep()
+
+    def close(self) -> None:
+        """Flush state before the process exits."""
+
+    async def run_sweeper(self, interval: Optional[float] = None) -> None:
+        interval = interval or float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.asweep()
+            except Exception as e:
+                print(f"Session sweep failed: {e}")
+
+
+class MemorySessionStore(BaseSessionStore):
+    """
+    In-memory LRU session store with idle TTL and spill-to-disk.
+
+    The async interface compresses, writes and reads spilled sessions on the store's
+    I/O thread. An evicted session stays reachable until its write has finished; if it
+    is requested again in the meantime it is taken back into memory.
+    """
+
+    def __init__(self,
+                 max_in_memory: Optional[int] = None,
+                 idle_ttl: Optional[float] = None,
+                 spill_dir: Optional[str] = None,
+                 disk_ttl: Optional[float] = None):
+        super().__init__(idle_ttl, disk_ttl)
+        self.max_in_memory = max_in_memory or int(os.getenv("SESSION_MAX_IN_MEMORY", "1000"))
+        self.spill_dir = spill_dir or os.getenv("SESSION_SPILL_DIR", "session_spill")
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        # 已移出内存、写盘还在排队的会话
+        self._spilling: Dict[str, Session] = {}
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+    def _call(self, func, *args) -> Any:
+        # 同步接口也在 I/O 线程中执行，与排队中的异步写入保持顺序
+        return self._executor.submit(func, *args).result()
+
+    # --- 读取 ---
+
+    def _held(self, session_id: str) -> Optional[Session]:
+        """Return the session if this process still holds it, in memory or waiting to be written."""
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._spilling.pop(session_id, None)
+            if session is not None:
+                # 写盘完成后删除文件，会话留在内存中
+                self._executor.submit(self._remove_file, session_id)
+        return session
+
+    def _rehydrate(self, session_id: str, data: Optional[Dict[str, Any]]) -> Optional[Session]:
+        if data is None:
+            return None
+        print(f"Session rehydrated from disk, ID: {session_id}")
+        return Session.from_dict(session_id, data)
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Return the session, rehydrating it from disk if it was spilled."""
+        session = self._held(session_id)
+        if session is None:
+            session = self._rehydrate(session_id, self._call(self._read_file, session_id))
+            if session is None:
+                return None
+        return self._admit(session, self._spill)
+
+    async def aget(self, session_id: str) -> Optional[Session]:
+        session = self._held(session_id)
+        if session is None:
+            data = await self._run(self._read_file, session_id)
+            # 读盘期间同一会话可能已被另一个请求加载（文件只能被读取一次）
+            session = self._held(session_id) or self._rehydrate(session_id, data)
+            if session is None:
+                return None
+        return self._admit(session, self._spill_later)
+
+    # --- 写入 ---
+
+    def _reclaim(self, session: Session) -> None:
+        # 请求处理期间会话可能已被淘汰到磁盘，放回内存以免丢失这次修改，并删除磁盘上的旧副本
+        if self._sessions.get(session.session_id) is not session:
+            self._spilling.pop(session.session_id, None)
+            self._executor.submit(self._remove_file, session.session_id)
+
+    def save(self, session: Session) -> None:
+        self._reclaim(session)
+        self._admit(session, self._spill)
+
+    async def asave(self, session: Session) -> None:
+        self._reclaim(session)
+        self._admit(session, self._spill_later)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    # --- 淘汰与落盘 ---
+
+    def _admit(self, session: Session, spill: Callable[[str], None]) -> Session:
+        """Make session the most recently used one and spill others to respect the cap."""
+        session_id = session.session_id
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        session.touch()
+        if len(self._sessions) > self.max_in_memory:
+            # 有 WebSocket 连接的会话正在使用中，不能淘汰；刚取出的会话马上就要使用（连接数还没有增加），也不淘汰
+            for sid in [sid for sid, s in self._sessions.items() if s.active_connections == 0 and sid != session_id]:
+                if len(self._sessions) <= self.max_in_memory:
+                    break
+                spill(sid)
+        return session
+
+    def _spill(self, session_id: str) -> None:
+        """Move a session out of memory and write it to disk before returning."""
+        session = self._sessions.pop(session_id)
+        self._call(self._write_file, session_id, _dumps(session))
+
+    def _spill_later(self, session_id: str) -> None:
+        """Move a session out of memory and queue its write on the I/O thread."""
+        session = self._sessions.pop(session_id)
+        # 序列化在事件循环中完成（会话只在这个线程中被修改），压缩和写盘在 I/O 线程中完成
+        self._spilling[session_id] = session
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._write_file, session_id, _dumps(session)
+        )
+        future.add_done_callback(lambda f: self._spilled(session_id, session, f))
+
+    def _spilled(self, session_id: str, session: Session, future: "asyncio.Future") -> None:
+        if self._spilling.get(session_id) is not session:
+            return  # 写盘期间已被重新取回
+        del self._spilling[session_id]
+        if not future.cancelled() and future.exception() is not None:
+            # 写盘失败时放回内存，不丢失会话
+            print(f"Failed to spill session {session_id}: {future.exception()}")
+            self._sessions[session_id] = session
+
+    # --- 磁盘文件（在 I/O 线程中执行） ---
+
+    def _path(self, session_id: str) -> Optional[str]:
+        if not _is_valid_session_id(session_id):
+            return None
+        return os.path.join(self.spill_dir, f"{session_id}.json.z")
+
+    def _write_file(self, session_id: str, raw: bytes) -> None:
+        path = self._path(session_id)
+        if path is None:
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(raw))
+        os.replace(tmp_path, path)
+
+    def _read_file(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Read and delete a spilled session; None if there is none or it cannot be decoded."""
+        path = self._path(session_id)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        except (OSError, zlib.error, ValueError) as e:
+            print(f"Failed to load spilled session {session_id}: {e}")
+            return None
+        os.remove(path)
+        return data
+
+    def _remove_file(self, session_id: str) -> None:
+        path = self._path(session_id)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def _delete_expired(self) -> None:
+        cutoff = time.time() - self.disk_ttl
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    # --- 清理 ---
+
+    def _spill_idle(self, spill: Callable[[str], None]) -> None:
+        now = time.monotonic()
+        idle = [sid for sid, s in self._sessions.items()
+                if s.active_connections == 0 and now - s.last_access > self.idle_ttl]
+        for session_id in idle:
+            spill(session_id)
+        if idle:
+            print(f"Spilled {len(idle)} idle sessions to disk")
+
+    def sweep(self) -> None:
+        """Spill idle sessions and delete spilled sessions past the disk TTL."""
+        self._spill_idle(self._spill)
+        self._call(self._delete_expired)
+
+    async def asweep(self) -> None:
+        self._spill_idle(self._spill_later)
+        await self._run(self._delete_expired)
+
+    def close(self) -> None:
+        """Write every in-memory session to disk so a restarted worker can pick them up."""
+        # 先等待排队中的写入完成，再直接写入内存中剩下的会话
+        self._executor.shutdown(wait=True)
+        for session_id, session in self._sessions.items():
+            self._write_file(session_id, _dumps(session))
+        self._sessions.clear()
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """
+    Session store shared by every worker process through a SQLite database in WAL mode.
+
+    A session is stored as a small state row (everything but the conversation history)
+    plus one row per message in the turns table; a save rewrites the state row and
+    appends only the messages added since the last save. Every database call of the
+    async interface runs on a single dedicated thread, which also keeps writes in order.
+
+    Each state row carries a version number. A worker keeps the sessions it used recently
+    in memory and only re-reads a session when another worker has saved a newer version,
+    fetching just the turns it has not seen. Conversation history is append-only;
+    concurrent writes to the same session from different workers are last-writer-wins.
+    """
+
+    def __init__(self, path: Optional[str] = None, idle_ttl: Optional[float] = None,
+                 disk_ttl: Optional[float] = None):
+        super().__init__(idle_ttl, disk_ttl)
+        self.path = path or os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+            "PRIMARY KEY (session_id, seq))"
+        )
+        # session_id -> (version, Session, 已写入 turns 表的消息数)
+        self._local: Dict[str, Tuple[int, Session, int]] = {}
+
+    # --- 读取 ---
+
+    def _fetch(self, session_id: str, cached_version: Optional[int], from_seq: int) -> Optional[Tuple]:
+        """Database part of get: None if missing, (version,) if unchanged, else (version, data, turns)."""
+        row = self._conn.execute("SELECT version, data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        if row[0] == cached_version:
+            return (row[0],)
+        turns = self._conn.execute(
+            "SELECT role, content FROM turns WHERE session_id = ? AND seq >= ? ORDER BY seq", (session_id, from_seq)
+        ).fetchall()
+        return row[0], row[1], turns
+
+    def _apply(self, session_id: str, fetched: Optional[Tuple]) -> Optional[Session]:
+        # 在调用方（事件循环）线程中更新本地副本，会话对象只在这个线程中被修改
+        cached = self._local.get(session_id)
+        if fetched is None:
+            self._local.pop(session_id, None)
+            return None
+        if len(fetched) == 1:
+            session = cached[1]
+        else:
+            version, payload, turns = fetched
+            data = json.loads(zlib.decompress(payload).decode("utf-8"))
+            context = data.get("problem_context", {})
+            messages = [{"role": role, "content": content} for role, content in turns]
+            legacy_history = context.pop("conversation_history", None)
+            if legacy_history is not None:
+                # 旧格式：历史保存在状态行中，下次保存时整体写入 turns 表
+                history, persisted = legacy_history + messages, 0
+            elif cached is not None:
+                history = cached[1].problem_context.get("conversation_history", [])[:cached[2]] + messages
+                persisted = len(history)
+            else:
+                history, persisted = messages, len(messages)
+            context["conversation_history"] = history
+
+            if cached is not None:
+                # 保留本进程中的运行时状态（活跃连接数、上下文窗口缓存、后台任务）
+                session = cached[1]
+                session.assistant.update_model(data.get("model", session.assistant.model))
+                session.problem_context = context
+            else:
+                session = Session.from_dict(session_id, {**data, "problem_context": context})
+            self._local[session_id] = (version, session, persisted)
+        session.touch()
+        return session
+
+    def _fetch_args(self, session_id: str) -> Tuple[Optional[int], int]:
+        cached = self._local.get(session_id)
+        return (None, 0) if cached is None else (cached[0], cached[2])
+
+    def get(self, session_id: str) -> Optional[Session]:
+        if not _is_valid_session_id(session_id):
+            return None
+        return self._apply(session_id, self._fetch(session_id, *self._fetch_args(session_id)))
+
+    async def aget(self, session_id: str) -> Optional[Session]:
+        if not _is_valid_session_id(session_id):
+            return None
+        return self._apply(session_id, await self._run(self._fetch, session_id, *self._fetch_args(session_id)))
+
+    # --- 写入 ---
+
+    def _snapshot(self, session: Session) -> Tuple[bytes, int, List[Tuple[str, str]]]:
+        """Encode the state row and collect the messages not yet written, on the caller's thread."""
+        session.touch()
+        data = session.to_dict()
+        context = dict(data["problem_context"])
+        history = context.pop("conversation_history", [])
+        data["problem_context"] = context
+        payload = zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+        cached = self._local.get(session.session_id)
+        persisted = cached[2] if cached is not None and cached[1] is session else 0
+        # 历史变短（被替换）时整体重写
+        start = persisted if persisted <= len(history) else 0
+        turns = [(msg["role"], msg["content"]) for msg in history[start:]]
+        version = cached[0] if cached is not None else 0
+        # 先记下新的写入位置，之后并发的保存只会写入更新的消息
+        self._local[session.session_id] = (version, session, len(history))
+        return payload, start, turns
+
+    def _write(self, session_id: str, payload: bytes, start: int, turns: List[Tuple[str, str]]) -> int:
+        """Database part of save; returns the new version."""
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO sessions (id, version, data, updated_at) VALUES (?, 1, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET version = version + 1, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                (session_id, payload, time.time())
+            )
+            if start == 0:
+                conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO turns (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, start + i, role, content) for i, (role, content) in enumerate(turns)]
+            )
+            version = conn.execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return version
+
+    def _saved(self, session: Session, version: int) -> None:
+        cached = self._local.get(session.session_id)
+        if cached is not None and cached[1] is session and version > cached[0]:
+            self._local[session.session_id] = (version, session, cached[2])
+
+    def _save_failed(self, session: Session) -> None:
+        # 不确定哪些消息已经写入：下次保存时整体重写
+        cached = self._local.get(session.session_id)
+        if cached is not None and cached[1] is session:
+            self._local[session.session_id] = (cached[0], session, 0)
+
+    def save(self, session: Session) -> None:
+        payload, start, turns = self._snapshot(session)
+        try:
+            version = self._write(session.session_id, payload, start, turns)
+        except Exception:
+            self._save_failed(session)
+            raise
+        self._saved(session, version)
+
+    async def asave(self, session: Session) -> None:
+        payload, start, turns = self._snapshot(session)
+        try:
+            version = await self._run(self._write, session.session_id, payload, start, turns)
+        except Exception:
+            self._save_failed(session)
+            raise
+        self._saved(session, version)
+
+    def __len__(self) -> int:
+        return len(self._local)
+
+    # --- 清理 ---
+
+    def _evict_idle(self) -> None:
+        now = time.monotonic()
+        for session_id in [sid for sid, (_, s, _) in self._local.items()
+                           if s.active_connections == 0 and now - s.last_access > self.idle_ttl]:
+            del self._local[session_id]
+
+    def _delete_expired(self) -> None:
+        cutoff = time.time() - self.disk_ttl
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "DELETE FROM turns WHERE session_id IN (SELECT id FROM sessions WHERE updated_at < ?)", (cutoff,)
+            )
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def sweep(self) -> None:
+        self._evict_idle()
+        self._delete_expired()
+
+    async def asweep(self) -> None:
+        self._evict_idle()
+        await self._run(self._delete_expired)
+
+    def close(self) -> None:
+        # 等待排队中的写入完成
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+
+def create_session_store() -> BaseSessionStore:
+    """Build the session store selected by SESSION_BACKEND."""
+    backend = os.getenv("SESSION_BACKEND", "memory").lower()
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend != "memory":
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    return MemorySessionStore()
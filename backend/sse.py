@@ -0,0 +1,109 @@
+# backend/sse.py
+"""
+面向上游流式响应的增量 SSE 解码器。
+
+直接处理从连接读到的原始字节：按行切分时只在字节层面查找换行，不会把整块数据
+解码为 str；data 字段原样以 bytes 交给 orjson 解析（requirements.txt 中的依赖；
+只在没有安装它的开发环境中退回标准库 json，两者都直接接受 bytes）。
+
+按 SSE 规范处理：
+    - 以 ":" 开头的注释行（OpenRouter 在排队时发送 ": OPENROUTER PROCESSING"）被忽略
+    - 一个事件可以有多行 data:，按规范用 "\\n" 拼接
+    - 空行结束一个事件；跨越多次读取的半行会保留到下一次 feed
+    - 支持 \\n 和 \\r\\n 换行（不支持只用 \\r 的换行，OpenRouter 不使用）
+    - event、id、retry 字段 OpenRouter 不使用，直接忽略
+"""
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # 部署时总会安装 orjson，这里只照顾没有安装依赖的开发环境
+    _loads = json.loads
+
+DONE = b"[DONE]"
+
+
+def parse_event(data: bytes) -> Optional[Dict[str, Any]]:
+    """Parse the JSON payload of one event; [DONE] and malformed payloads return None."""
+    if data == DONE:
+        return None
+    try:
+        event = _loads(data)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+
+class SSEDecoder:
+    """Incremental decoder from raw response bytes to the data payloads of server-sent events."""
+
+    __slots__ = ("_buffer", "_data")
+
+    def __init__(self):
+        self._buffer = b""
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """Consume bytes read from the connection and return the data of every event they complete."""
+        buffer = self._buffer + chunk if self._buffer else chunk
+        events: List[bytes] = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                # 空行：分发已累积的事件
+                if self._data:
+                    events.append(self._data[0] if len(self._data) == 1 else b"\n".join(self._data))
+                    self._data = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b" ") else value)
+            # 其余是注释（":" 开头）或不使用的字段
+        self._buffer = buffer[start:]
+        return events
+
+    def flush(self) -> List[bytes]:
+        """
+        Return the event left at the end of the stream.
+
+        The specification drops an event that is not followed by a blank line; we are
+        lenient and dispatch it, since some upstreams end with a bare "data: [DONE]".
+        """
+        if self._buffer:
+            self.feed(b"\n")
+        if not self._data:
+            return []
+        data = b"\n".join(self._data)
+        self._data = []
+        return [data]
+
+    def feed_json(self, chunk: bytes) -> List[Dict[str, Any]]:
+        """feed() followed by parse_event(), skipping [DONE] and malformed payloads."""
+        return [event for event in map(parse_event, self.feed(chunk)) if event is not None]
+
+    def flush_json(self) -> List[Dict[str, Any]]:
+        return [event for event in map(parse_event, self.flush()) if event is not None]
+
+
+def iter_event_batches(chunks: Iterable[bytes]) -> Iterator[List[Dict[str, Any]]]:
+    """Decode a byte stream into parsed events, one (possibly empty) batch per read."""
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield decoder.feed_json(chunk)
+    yield decoder.flush_json()
+
+
+async def aiter_event_batches(chunks: AsyncIterable[bytes]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Async version of iter_event_batches; batching keeps the async generator overhead per read, not per event."""
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        yield decoder.feed_json(chunk)
+    yield decoder.flush_json()
@@ -0,0 +1,155 @@
+# backend/streaming.py
+"""
+LLM 流式输出与客户端之间的生产者/消费者管道。
+
+生产者（OpenRouterLLM 的 SSE 读取循环）通过 TokenStream.put 写入增量文本，
+消费者（WebSocket 发送循环）用 async for 按顺序读取。队列有上限：客户端
+发送变慢时 put 会挂起，从而把背压一直传递到上游的 SSE 读取（挂起期间把调度器名额
+借给排队的请求，见 scheduler.backpressure）；生产者结束后
+调用 close 写入结束标记，消费者据此确定地结束，无需任何 sleep。
+"""
+import os
+import json
+import asyncio
+import inspect
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+from scheduler import backpressure
+
+T = TypeVar("T")
+
+# 每个流允许缓冲的最大块数，超过后生产者会等待消费者
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+
+_END_OF_STREAM = object()
+
+
+async def emit_text(callback: Optional[Callable[[str], Any]], text: str) -> None:
+    """Deliver a complete (e.g. cached or prefetched) response through a streaming callback in one chunk."""
+    if callback is None or not text:
+        return
+    if inspect.iscoroutinefunction(callback):
+        await callback(text)
+    else:
+        callback(text)
+
+
+class TokenStream:
+    """Bounded, ordered single-producer/single-consumer stream of text chunks."""
+
+    def __init__(self, maxsize: int = STREAM_QUEUE_SIZE):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._closed = False
+        self._end_pending = False
+
+    async def put(self, chunk: str) -> None:
+        """Enqueue a chunk, waiting while the queue is full (lending the scheduler slot meanwhile)."""
+        if self._closed:
+            raise RuntimeError("Cannot put into a closed TokenStream")
+        if not chunk:
+            return
+        if self._queue.full():
+            async with backpressure():
+                await self._queue.put(chunk)
+        else:
+            self._queue.put_nowait(chunk)
+
+    def close(self) -> None:
+        """
+        Mark the end of the stream; the consumer stops after draining what is queued.
+
+        Never blocks, so it is safe to call from a cancelled producer.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put_nowait(_END_OF_STREAM)
+        except asyncio.QueueFull:
+            # 队列已满时消费者不可能阻塞在空队列上，排空后由 __aiter__ 检查该标记
+            self._end_pending = True
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        while True:
+            if self._end_pending and self._queue.empty():
+                return
+            chunk = await self._queue.get()
+            if chunk is _END_OF_STREAM:
+                return
+            yield chunk
+
+
+async def run_streaming(
+        produce: Callable[[Callable[[str], Awaitable[None]]], Awaitable[T]],
+        consume: Callable[[str], Awaitable[None]],
+        maxsize: int = STREAM_QUEUE_SIZE,
+) -> T:
+    """
+    Run a streaming LLM call and forward every chunk to the consumer in order.
+
+    Args:
+        produce: Coroutine function receiving the streaming callback; returns the full response
+        consume: Coroutine function called for every chunk (e.g. a WebSocket send)
+        maxsize: Maximum number of buffered chunks before the producer is paused
+
+    Returns:
+        Whatever produce returns, once every chunk has been consumed
+    """
+    stream = TokenStream(maxsize)
+
+    async def _producer() -> T:
+        try:
+            return await produce(stream.put)
+        finally:
+            stream.close()
+
+    producer_task = asyncio.create_task(_producer())
+    try:
+        async for chunk in stream:
+            await consume(chunk)
+        return await producer_task
+    finally:
+        if not producer_task.done():
+            producer_task.cancel()
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """Encode one event as a Server-Sent Events frame."""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+async def sse_events(
+        produce: Callable[[Callable[[str], Awaitable[None]]], Awaitable[Dict[str, Any]]],
+        maxsize: int = STREAM_QUEUE_SIZE,
+) -> AsyncIterator[str]:
+    """
+    Run a streaming LLM call and yield it as SSE frames.
+
+    Emits {"type": "chunk", "content": ...} for every chunk, then a single
+    {"type": "end", ...} carrying the dict returned by produce (the same body
+    the non-streaming endpoint returns), or {"type": "error", "content": ...}.
+    The HTTP response is the consumer, so a slow client pauses the upstream read.
+    """
+    stream = TokenStream(maxsize)
+
+    async def _producer() -> Dict[str, Any]:
+        try:
+            return await produce(stream.put)
+        finally:
+            stream.close()
+
+    producer_task = asyncio.create_task(_producer())
+    try:
+        async for chunk in stream:
+            yield format_sse({"type": "chunk", "content": chunk})
+        try:
+            result = await producer_task
+        except Exception as e:
+            print(f"Streaming request failed: {e}")
+            yield format_sse({"type": "error", "content": str(e)})
+        else:
+            yield format_sse({"type": "end", **result})
+    finally:
+        if not producer_task.done():
+            producer_task.cancel()
+
@@ -0,0 +1,6 @@
+# backend/tests/conftest.py
+"""测试从 backend 目录导入模块（与 main.py 的运行方式一致）。"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+# backend/tests/test_feedback_cache.py
+"""代码反馈缓存：规范化后的精确匹配，以及按长度收紧的可选近似匹配。"""
+import pytest
+
+from code_normalizer import normalize_code, code_digest
+from llm_cache import SimilarityCache
+
+TWO_SUM = '''def two_sum(nums, target):
+    seen = {}
+    for i in range(len(nums)):
+        need = target - nums[i]
+        if need in seen:
+            return [seen[need], i]
+        seen[nums[i]] = i
+    return []
+'''
+
+# 只改了一个 token，但逻辑不同，需要不同的反馈
+ONE_TOKEN_CHANGES = [
+    TWO_SUM.replace("range(len(nums))", "range(len(nums) - 1)"),
+    TWO_SUM.replace("return [seen[need], i]", "return [i, i]"),
+]
+
+
+def _key(code: str, language: str = "python"):
+    canonical, tokens = normalize_code(code, language)
+    return "bucket", code_digest(canonical), tokens
+
+
+@pytest.mark.parametrize("threshold", [1.0, 0.95])
+@pytest.mark.parametrize("changed", ONE_TOKEN_CHANGES)
+def test_one_token_logic_change_is_a_miss(threshold, changed):
+    cache = SimilarityCache("test_feedback_miss", max_buckets=4, bucket_size=8, ttl=60, threshold=threshold)
+    cache.set(*_key(TWO_SUM), "feedback for the original")
+    assert cache.get(*_key(changed)) is None
+
+
+def test_renamed_and_commented_code_is_an_exact_hit():
+    cache = SimilarityCache("test_feedback_hit", max_buckets=4, bucket_size=8, ttl=60)
+    cache.set(*_key(TWO_SUM), "feedback")
+    renamed = TWO_SUM.replace("seen", "index_of").replace("need", "complement") + "# done\n"
+    assert cache.get(*_key(renamed)) == "feedback"
+    assert cache.stats()["hits"] == 1
+
+
+def test_near_match_threshold_tightens_for_short_code():
+    cache = SimilarityCache("test_feedback_ratio", max_buckets=1, bucket_size=1, ttl=60, threshold=0.95,
+                            full_length=400)
+    assert cache.required_ratio(400) == pytest.approx(0.95)
+    assert cache.required_ratio(40) == pytest.approx(0.995)
+
+
+def test_unparsable_python_strips_hash_comments_and_keeps_floor_division():
+    broken = "def f(a, b)\n    return a // b  # floor\n"
+    canonical, tokens = normalize_code(broken, "python")
+    assert "floor" not in tokens
+    assert tokens.count("/") == 2
+    assert canonical == normalize_code("def f(a, b)\n    return a // b\n", "python")[0]
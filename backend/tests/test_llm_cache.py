@@ -0,0 +1,134 @@
+# backend/tests/test_llm_cache.py
+"""llm_cache 的 single-flight 合并与缓存行为。"""
+import time
+import asyncio
+import threading
+
+import pytest
+
+from llm_cache import AsyncTTLCache, PersistentTTLCache, RefillingPool
+from resilience import DeadlineExceeded, deadline, remaining
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, effective_priority
+
+
+def test_cancelled_first_caller_does_not_cancel_waiters():
+    cache = AsyncTTLCache("test_cancelled_first_caller", maxsize=10, ttl=60)
+    received = {"first": [], "waiter": []}
+
+    async def compute(emit):
+        for chunk in ("a", "b", "c"):
+            if emit is not None:
+                await emit(chunk)
+            await asyncio.sleep(0.01)
+        return "abc"
+
+    async def slow_reader(chunk):
+        received["first"].append(chunk)
+        await asyncio.sleep(10)
+
+    async def waiter_reader(chunk):
+        received["waiter"].append(chunk)
+
+    async def scenario():
+        first = asyncio.create_task(cache.get_or_compute("key", compute, slow_reader))
+        await asyncio.sleep(0.005)
+        waiter = asyncio.create_task(cache.get_or_compute("key", compute, waiter_reader))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        # 读得慢的第一个请求既不会取消、也不会拖慢其他等待者
+        return await asyncio.wait_for(waiter, timeout=1)
+
+    assert asyncio.run(scenario()) == "abc"
+    assert received["waiter"] == ["a", "b", "c"]
+    assert cache.get("key") == "abc"
+    assert cache.stats()["coalesced"] == 1
+
+
+def test_persistent_cache_keeps_expiry_and_purges_expired_rows(tmp_path):
+    path = str(tmp_path / "cache.db")
+    writer = PersistentTTLCache("test_persistent_writer", maxsize=10, ttl=100, path=path)
+    writer.set(("fresh",), "a")
+    writer.set(("stale",), "b")
+    # 把两行的写入时间往前移：fresh 还剩 10 秒，stale 已经过期
+    writer._conn.execute("UPDATE cache SET created_at = created_at - 90 WHERE key = ?", (writer._db_key(("fresh",)),))
+    writer._conn.execute("UPDATE cache SET created_at = created_at - 200 WHERE key = ?", (writer._db_key(("stale",)),))
+
+    reader = PersistentTTLCache("test_persistent_reader", maxsize=10, ttl=100, path=path)
+    assert reader.stats()["purged"] == 1
+    assert reader.get(("stale",)) is None
+    assert reader.get(("fresh",)) == "a"
+    # 复制回内存时保留原来的过期时间，而不是重新给满 TTL
+    assert reader._data[("fresh",)][0] - time.monotonic() < 11
+    assert reader.stats()["persisted"] == 1
+
+
+def test_persistent_cache_reads_and_writes_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "cache.db")
+    calls = []
+
+    def recording(cache, name):
+        method = getattr(cache, name)
+
+        def wrapper(*args):
+            calls.append((name, threading.current_thread() is threading.main_thread()))
+            return method(*args)
+
+        setattr(cache, name, wrapper)
+
+    async def compute(emit):
+        return "guidance"
+
+    async def scenario():
+        writer = PersistentTTLCache("test_persistent_async_writer", maxsize=10, ttl=100, path=path)
+        recording(writer, "_read")
+        recording(writer, "_write")
+        assert await writer.get_or_compute(("key",), compute) == "guidance"
+        writer.close()
+
+        # 另一个 worker 从磁盘命中，不再调用 compute
+        reader = PersistentTTLCache("test_persistent_async_reader", maxsize=10, ttl=100, path=path)
+        recording(reader, "_read")
+        value = await reader.get_or_compute(("key",), None)
+        stats = await reader.astats()
+        reader.close()
+        return value, stats
+
+    value, stats = asyncio.run(scenario())
+    assert value == "guidance"
+    assert stats["hits"] == 1 and stats["persisted"] == 1
+    # 读盘和写盘都不在事件循环（主）线程中执行
+    assert calls == [("_read", False), ("_write", False), ("_read", False)]
+
+
+def test_empty_pool_take_does_not_wait_on_background_refill():
+    pool = RefillingPool("test_pool_interactive", max_keys=10, low_watermark=1, ttl=60)
+    contexts = {}
+
+    async def scenario():
+        released = {"background": asyncio.Event(), "interactive": asyncio.Event(), "unused": asyncio.Event()}
+
+        def generator(name, items):
+            async def generate():
+                contexts[name] = (effective_priority(PRIORITY_INTERACTIVE), remaining() is not None)
+                await released[name].wait()
+                return items
+            return generate
+
+        prefill = asyncio.create_task(pool.ensure("key", generator("background", ["b"])))
+        await asyncio.sleep(0)
+        with deadline(5):
+            first = asyncio.create_task(pool.take("key", generator("interactive", ["i"])))
+        await asyncio.sleep(0)
+        # 共享同一次生成的等待者在自己的截止时间放弃等待
+        with deadline(0.01), pytest.raises(DeadlineExceeded):
+            await pool.take("key", generator("unused", ["x"]))
+        # 后台补充还没有完成，等待中的学生已经拿到自己这一批
+        released["interactive"].set()
+        item = await asyncio.wait_for(first, timeout=1)
+        released["background"].set()
+        await prefill
+        return item
+
+    assert asyncio.run(scenario()) == "i"
+    # 等待中的学生在自己的通道和截止时间下生成，而不是加入后台补充
+    assert contexts == {"background": (PRIORITY_BACKGROUND, False), "interactive": (PRIORITY_INTERACTIVE, True)}
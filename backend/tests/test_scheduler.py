@@ -0,0 +1,58 @@
+# backend/tests/test_scheduler.py
+"""调度器：等待慢客户端的流把名额借给排队的请求。"""
+import asyncio
+
+from scheduler import LLMScheduler, PRIORITY_INTERACTIVE
+from streaming import TokenStream
+
+
+def test_stream_blocked_on_slow_client_lends_its_slot():
+    scheduler = LLMScheduler(1)
+    stream = TokenStream(maxsize=1)
+
+    async def slow_client_stream():
+        async with scheduler.slot("model", PRIORITY_INTERACTIVE, "slow"):
+            await stream.put("a")
+            await stream.put("b")  # 队列已满：等待客户端
+            await stream.put("c")
+
+    async def other_session():
+        async with scheduler.slot("model", PRIORITY_INTERACTIVE, "other"):
+            return scheduler.stats()["model"]
+
+    async def scenario():
+        producer = asyncio.create_task(slow_client_stream())
+        await asyncio.sleep(0.01)
+        # 名额上限为 1，但被阻塞的流已借出名额，其他会话不必等它输出完
+        stats = await asyncio.wait_for(other_session(), timeout=1)
+        chunks = []
+        for _ in range(3):
+            chunks.append(await stream._queue.get())
+        await producer
+        return stats, chunks
+
+    stats, chunks = asyncio.run(scenario())
+    assert stats["parked"] == 1
+    assert chunks == ["a", "b", "c"]
+    final = scheduler.stats()["model"]
+    assert final["active"] == 0 and final["parked"] == 0
+
+
+def test_backpressure_budget_keeps_the_slot_when_full():
+    scheduler = LLMScheduler(1, backpressure_slots=0)
+    stream = TokenStream(maxsize=1)
+
+    async def scenario():
+        async def producer():
+            async with scheduler.slot("model"):
+                await stream.put("a")
+                await stream.put("b")
+
+        task = asyncio.create_task(producer())
+        await asyncio.sleep(0.01)
+        parked = scheduler.stats()["model"]["parked"]
+        await stream._queue.get()
+        await task
+        return parked
+
+    assert asyncio.run(scenario()) == 0
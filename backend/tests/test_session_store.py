@@ -0,0 +1,130 @@
+# backend/tests/test_session_store.py
+"""会话存储：SQLite 只写入新增的消息；磁盘和数据库访问不在事件循环线程中执行。"""
+import uuid
+import asyncio
+import threading
+
+from session import Session
+from session_store import MemorySessionStore, SQLiteSessionStore
+
+
+def _session(session_id: str) -> Session:
+    session = Session(api_key="test-key", model="openai/gpt-4o-mini", session_id=session_id)
+    session.problem_context = {
+        "problem": "Two sum",
+        "language": "python",
+        "skill_level": "beginner",
+        "current_stage": "problem_analysis",
+        "conversation_history": [{"role": "assistant", "content": "Let's start."}],
+    }
+    return session
+
+
+def test_saves_append_new_turns_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    session_id = str(uuid.uuid4())
+    writes = []
+
+    async def scenario():
+        store = SQLiteSessionStore(path)
+        write = store._write
+
+        def recording_write(sid, payload, start, turns):
+            writes.append((threading.current_thread() is threading.main_thread(), start, len(turns)))
+            return write(sid, payload, start, turns)
+
+        store._write = recording_write
+        session = _session(session_id)
+        await store.asave(session)
+        session.problem_context["conversation_history"].append({"role": "user", "content": "How do I begin?"})
+        await store.asave(session)
+        store.close()
+
+        # 另一个 worker 读到完整的历史，并且只取自己没见过的消息
+        other = SQLiteSessionStore(path)
+        loaded = await other.aget(session_id)
+        history = loaded.problem_context["conversation_history"]
+        loaded.problem_context["conversation_history"].append({"role": "assistant", "content": "Read the input."})
+        await other.asave(loaded)
+        other.close()
+        return history
+
+    history = asyncio.run(scenario())
+    assert [msg["content"] for msg in history] == ["Let's start.", "How do I begin?", "Read the input."]
+    # 第一次写入全部历史，之后每次只写入新增的一条；都不在事件循环（主）线程中执行
+    assert writes == [(False, 0, 1), (False, 1, 1)]
+
+
+def test_reloads_only_when_another_worker_saved(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    session_id = str(uuid.uuid4())
+
+    async def scenario():
+        first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+        session = _session(session_id)
+        await first.asave(session)
+        assert await first.aget(session_id) is session
+
+        remote = await second.aget(session_id)
+        remote.problem_context["current_stage"] = "solution_design"
+        await second.asave(remote)
+
+        reloaded = await first.aget(session_id)
+        first.close()
+        second.close()
+        return session, reloaded
+
+    session, reloaded = asyncio.run(scenario())
+    # 保留本进程中的会话对象（运行时状态），只更新其中的数据
+    assert reloaded is session
+    assert reloaded.problem_context["current_stage"] == "solution_design"
+    assert len(reloaded.problem_context["conversation_history"]) == 1
+
+
+def test_rehydrated_session_is_not_spilled_when_others_are_connected(tmp_path):
+    store = MemorySessionStore(max_in_memory=1, spill_dir=str(tmp_path))
+    connected, spilled = _session(str(uuid.uuid4())), _session(str(uuid.uuid4()))
+    store.save(spilled)
+    store.save(connected)
+    connected.active_connections = 1
+    assert store._sessions.keys() == {connected.session_id}
+
+    # 唯一能淘汰的就是刚加载的会话（WebSocket 在 get 之后才增加连接数），它不能被淘汰
+    loaded = store.get(spilled.session_id)
+    assert loaded.problem_context == spilled.problem_context
+    assert store._sessions.keys() == {connected.session_id, spilled.session_id}
+    store.close()
+
+
+def test_memory_store_spills_and_loads_off_the_event_loop(tmp_path):
+    store = MemorySessionStore(max_in_memory=1, spill_dir=str(tmp_path))
+    first, second = _session(str(uuid.uuid4())), _session(str(uuid.uuid4()))
+    calls = []
+
+    for name in ("_write_file", "_read_file"):
+        method = getattr(store, name)
+
+        def wrapper(*args, name=name, method=method):
+            calls.append((name, threading.current_thread() is threading.main_thread()))
+            return method(*args)
+
+        setattr(store, name, wrapper)
+
+    async def scenario():
+        await store.asave(first)
+        await store.asave(second)
+        # 第一个会话的写盘还在排队时再次请求，直接取回内存中的对象，不读盘
+        assert await store.aget(first.session_id) is first
+        await store._run(lambda: None)
+        await store.asave(second)
+        await store._run(lambda: None)
+        # 这次已经写入磁盘，在 I/O 线程中读回
+        loaded = await store.aget(first.session_id)
+        await store._run(lambda: None)
+        return loaded, list(calls)
+
+    loaded, io_calls = asyncio.run(scenario())
+    store.close()
+    assert loaded is not first and loaded.problem_context == first.problem_context
+    # 淘汰 first、淘汰 second、再次淘汰 first、读回 first 并淘汰 second；都不在事件循环（主）线程中执行
+    assert io_calls == [("_write_file", False)] * 3 + [("_read_file", False), ("_write_file", False)]
@@ -0,0 +1,67 @@
+# backend/tests/test_sync_chain.py
+"""同步链调用：通过 httpx.MockTransport 模拟 OpenRouter，不发出真实请求。"""
+import json
+
+import httpx
+import pytest
+
+import basic
+from usage import USAGE
+
+HINT_INPUTS = dict(problem="Two sum", language="python", skill_level="beginner", current_stage="understanding",
+                   hint_request="where do I start?", progress_summary="")
+
+
+def _completion(request: httpx.Request) -> httpx.Response:
+    payload = json.loads(request.content)
+    if payload.get("stream"):
+        body = (b": OPENROUTER PROCESSING\n\n"
+                b'data: {"choices": [{"delta": {"content": "Think about "}}]}\n\n'
+                b'data: {"choices": [{"delta": {"content": "a dictionary."}, "finish_reason": "stop"}],'
+                b' "usage": {"prompt_tokens": 50, "completion_tokens": 6}}\n\n'
+                b"data: [DONE]\n\n")
+        return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+    return httpx.Response(200, json={
+        "choices": [{"message": {"role": "assistant", "content": "Think about a dictionary."},
+                     "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 50, "completion_tokens": 6}
+    })
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    sent = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(json.loads(request.content))
+        return _completion(request)
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(basic, "get_sync_client", lambda: client)
+    yield sent
+    client.close()
+
+
+def test_sync_chain_returns_completion(requests):
+    assistant = basic.InteractiveLearningAssistant("test-key", model="openai/gpt-4o-mini")
+    assistant.session_id = "sync-chain-test"
+
+    assert assistant.generate_hint(**HINT_INPUTS) == "Think about a dictionary."
+    assert len(requests) == 1
+    payload = requests[0]
+    assert payload["model"] == "openai/gpt-4o-mini"
+    assert not payload.get("stream")
+    assert payload["messages"][0]["role"] == "system"
+    assert payload["max_tokens"] == basic.chain_max_tokens("hint_generation")
+    stats = USAGE.session_stats("sync-chain-test")
+    assert stats["chains"]["hint_generation"]["completionTokens"] == 6
+
+
+def test_sync_chain_streams_to_callback(requests):
+    chunks = []
+    assistant = basic.InteractiveLearningAssistant("test-key", model="openai/gpt-4o-mini")
+    assistant.set_streaming_callback(chunks.append)
+
+    assert assistant.generate_hint(**HINT_INPUTS) == "Think about a dictionary."
+    assert chunks == ["Think about ", "a dictionary."]
+    assert requests[0]["stream"] is True
@@ -0,0 +1,292 @@
+# backend/tracing.py
+"""
+基于 span 的轻量级追踪。
+
+当前 span 保存在 contextvar 中，子 span（包括在子任务中创建的）自动挂到父 span 下。
+采样在根 span 处决定（head-based），未采样的请求只创建一个空对象，几乎没有开销；
+子 span 继承父 span 的采样结果，因此一条 trace 要么完整保留，要么完全不记录。
+
+结束的 span 先放入内存缓冲区，由后台任务分批导出（导出在线程中执行，不阻塞事件循环）。
+
+配置（环境变量）：
+    TRACE_EXPORTER        jsonl | otlp，不设置时关闭追踪
+    TRACE_SAMPLE_RATE     根 span 的采样率（默认 0.1）
+    TRACE_JSONL_PATH      jsonl 导出的文件路径（默认 traces.jsonl）
+    TRACE_OTLP_ENDPOINT   OTLP/HTTP JSON 接收地址（默认 http://localhost:4318/v1/traces）
+    TRACE_FLUSH_INTERVAL  导出间隔秒数（默认 5）
+    TRACE_MAX_BUFFER      缓冲区最多保留的 span 数，超出时丢弃最旧的（默认 10000）
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+SERVICE_NAME = "codecoach-backend"
+
+
+class Span:
+    """One timed operation; attributes describe sizes, models, status codes and so on."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+
+    sampled = True
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class _NoopSpan:
+    """Stand-in for spans of unsampled traces."""
+
+    sampled = False
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, **attributes: Any) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("trace_span", default=None)
+
+
+class SpanExporter:
+    """Buffers finished spans and writes them in batches to a JSONL file or an OTLP collector."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.path = os.getenv("TRACE_JSONL_PATH", "traces.jsonl")
+        self.endpoint = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+        self.flush_interval = float(os.getenv("TRACE_FLUSH_INTERVAL", "5"))
+        self.buffer: "deque[Span]" = deque(maxlen=int(os.getenv("TRACE_MAX_BUFFER", "10000")))
+        self.exported = 0
+        self.failed = 0
+
+    def add(self, span: Span) -> None:
+        self.buffer.append(span)
+
+    def _drain(self) -> List[Span]:
+        batch = list(self.buffer)
+        self.buffer.clear()
+        return batch
+
+    def flush(self) -> None:
+        """Export everything buffered (blocking)."""
+        batch = self._drain()
+        if not batch:
+            return
+        try:
+            if self.kind == "otlp":
+                self._export_otlp(batch)
+            else:
+                self._export_jsonl(batch)
+            self.exported += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Failed to export {len(batch)} spans: {e}")
+
+    async def run(self) -> None:
+        """Background loop exporting the buffer every flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.buffer:
+                await asyncio.to_thread(self.flush)
+
+    def _export_jsonl(self, batch: List[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in batch:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def _export_otlp(self, batch: List[Span]) -> None:
+        import httpx
+
+        response = httpx.post(self.endpoint, json=_otlp_payload(batch), timeout=10)
+        response.raise_for_status()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(batch: List[Span]) -> Dict[str, Any]:
+    # OTLP/HTTP 的 JSON 编码：https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+    spans = []
+    for span in batch:
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "codecoach"}, "spans": spans}]
+        }]
+    }
+
+
+class Tracer:
+    def __init__(self, exporter: Optional[SpanExporter], sample_rate: float):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        kind = os.getenv("TRACE_EXPORTER", "").lower()
+        exporter = SpanExporter(kind) if kind in ("jsonl", "otlp") else None
+        return cls(exporter, float(os.getenv("TRACE_SAMPLE_RATE", "0.1")))
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Any]:
+        """
+        Time the enclosed block as a span; a root span decides sampling for the whole trace.
+
+        Exceptions are recorded on the span and re-raised.
+        """
+        parent = _current_span.get()
+        if parent is None:
+            if not self.enabled or random.random() >= self.sample_rate:
+                # 根 span 未采样：整条 trace 都使用空对象
+                token = _current_span.set(NOOP_SPAN)
+                try:
+                    yield NOOP_SPAN
+                finally:
+                    _current_span.reset(token)
+                return
+            current = Span(name, "%032x" % random.getrandbits(128), None, attributes)
+        elif not parent.sampled:
+            yield NOOP_SPAN
+            return
+        else:
+            current = Span(name, parent.trace_id, parent.span_id, attributes)
+
+        token = _current_span.set(current)
+        try:
+            yield current
+        except BaseException as e:
+            current.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            current.end_ns = time.time_ns()
+            self.exporter.add(current)
+
+    def start_span(self, name: str, **attributes: Any) -> Any:
+        """
+        Start a child of the current span without making it current.
+
+        For code that cannot hold a context manager across its lifetime (e.g. async
+        generators, where the context may change between yields); finish with end_span.
+        """
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return NOOP_SPAN
+        return Span(name, parent.trace_id, parent.span_id, attributes)
+
+    def end_span(self, current: Any, error: Optional[BaseException] = None) -> None:
+        if not current.sampled:
+            return
+        if error is not None:
+            current.error = f"{type(error).__name__}: {error}"
+        current.end_ns = time.time_ns()
+        self.exporter.add(current)
+
+    def start(self) -> Optional[asyncio.Task]:
+        """Start the background exporter (call from the running event loop)."""
+        if self.exporter is None:
+            return None
+        return asyncio.create_task(self.exporter.run())
+
+    async def shutdown(self) -> None:
+        if self.exporter is not None:
+            await asyncio.to_thread(self.exporter.flush)
+
+
+TRACER = Tracer.from_env()
+
+
+def span(name: str, **attributes: Any):
+    """Shortcut for TRACER.span."""
+    return TRACER.span(name, **attributes)
+
+
+def current_span() -> Any:
+    return _current_span.get() or NOOP_SPAN
+
+
+class TracingMiddleware:
+    """ASGI middleware opening the root span of every HTTP request, named after the handler."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACER.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        with TRACER.span(f"{scope['method']} {scope['path']}", **{"http.method": scope["method"]}) as root:
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    root.set_attribute("http.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                endpoint = scope.get("endpoint")
+                if root.sampled and endpoint is not None:
+                    # 路由匹配后用处理函数名作为 span 名，路径参数（如 session_id）作为属性
+                    root.name = f"handler {endpoint.__name__}"
+                    root.set_attributes(**{f"http.path.{key}": value
+                                           for key, value in scope.get("path_params", {}).items()})
@@ -0,0 +1,127 @@
+# backend/usage.py
+"""
+按会话和链统计 token 用量和上游耗时。
+
+OpenRouter 在请求中带 usage: {"include": true} 时，会在响应（流式时是最后一个分块）
+中返回 prompt/completion token 数、缓存命中的 token 数和费用；每次上游调用结束后
+由 InteractiveLearningAssistant 记录到 USAGE。流式输出被提前截断、或调用被取消
+（例如对冲中落败的请求）时上游不再返回 usage，此时 token 数是本地估算的（estimated）。
+
+按链和模型的累计值同时导出为 Prometheus 指标；按会话的统计只保存在进程内存中
+（最多 USAGE_MAX_SESSIONS 个会话，超出时淘汰最久未更新的），多个 worker 时各自统计。
+"""
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from metrics import LLM_TOKENS, LLM_COST, TRUNCATED_COMPLETIONS
+
+
+class UsageTotals:
+    """Accumulated usage of a group of upstream calls."""
+
+    __slots__ = ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cost", "seconds",
+                 "truncated", "estimated")
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.seconds = 0.0
+        self.truncated = 0
+        self.estimated = 0
+
+    def add(self, usage: Dict[str, Any], seconds: float) -> None:
+        self.calls += 1
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+        self.cached_tokens += usage.get("cached_tokens", 0)
+        self.cost += usage.get("cost", 0.0)
+        self.seconds += seconds
+        self.truncated += 1 if usage.get("truncated") else 0
+        self.estimated += 1 if usage.get("estimated") else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "promptTokens": self.prompt_tokens,
+            "completionTokens": self.completion_tokens,
+            "cachedTokens": self.cached_tokens,
+            "cost": round(self.cost, 6),
+            "seconds": round(self.seconds, 3),
+            "truncated": self.truncated,
+            "estimated": self.estimated
+        }
+
+
+def normalize_usage(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Pick the fields we account for out of an OpenRouter usage block."""
+    details = raw.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": int(raw.get("prompt_tokens") or 0),
+        "completion_tokens": int(raw.get("completion_tokens") or 0),
+        "cached_tokens": int(details.get("cached_tokens") or 0),
+        "cost": float(raw.get("cost") or 0.0)
+    }
+
+
+class UsageTracker:
+    """Usage per chain (process-wide) and per session and chain (bounded LRU)."""
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self.chains: Dict[str, UsageTotals] = {}
+        self.sessions: "OrderedDict[str, Dict[str, UsageTotals]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "UsageTracker":
+        return cls(int(os.getenv("USAGE_MAX_SESSIONS", "10000")))
+
+    def record(self, session_id: str, chain_name: str, model: str, usage: Dict[str, Any], seconds: float) -> None:
+        """
+        Record one upstream call.
+
+        Args:
+            session_id: Session the call was made for ("" for calls outside a session)
+            chain_name: Chain that made the call
+            model: Model that answered
+            usage: Normalized usage (see normalize_usage), plus "truncated"/"estimated" flags
+            seconds: Upstream time of the call
+        """
+        self.chains.setdefault(chain_name, UsageTotals()).add(usage, seconds)
+        if session_id:
+            chains = self.sessions.get(session_id)
+            if chains is None:
+                chains = self.sessions[session_id] = {}
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(session_id)
+            chains.setdefault(chain_name, UsageTotals()).add(usage, seconds)
+
+        LLM_TOKENS.inc(chain_name, model, "prompt", amount=usage.get("prompt_tokens", 0))
+        LLM_TOKENS.inc(chain_name, model, "completion", amount=usage.get("completion_tokens", 0))
+        LLM_TOKENS.inc(chain_name, model, "cached", amount=usage.get("cached_tokens", 0))
+        LLM_COST.inc(chain_name, model, amount=usage.get("cost", 0.0))
+        if usage.get("truncated"):
+            TRUNCATED_COMPLETIONS.inc(chain_name, usage["truncated"])
+
+    @staticmethod
+    def _summarize(chains: Dict[str, UsageTotals]) -> Dict[str, Any]:
+        total = UsageTotals()
+        for totals in chains.values():
+            for field in UsageTotals.__slots__:
+                setattr(total, field, getattr(total, field) + getattr(totals, field))
+        return {"total": total.to_dict(), "chains": {name: totals.to_dict() for name, totals in chains.items()}}
+
+    def session_stats(self, session_id: str) -> Optional[Dict[str, Any]]:
+        chains = self.sessions.get(session_id)
+        return None if chains is None else self._summarize(chains)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._summarize(self.chains), "trackedSessions": len(self.sessions)}
+
+
+USAGE = UsageTracker.from_env()